@@ -31,6 +31,7 @@ from numina.flow.processing import BadPixelCorrector
 import emirdrp.processing.info
 import emirdrp.products as prods
 from emirdrp.datamodel import EmirDataModel
+from emirdrp.processing.cache import load_calibration
 
 _logger = logging.getLogger('numina.recipes.emir')
 
@@ -43,14 +44,14 @@ def get_corrector_p(rinput, meta):
 
     if info is not None:
         inputval = getattr(rinput, key)
-        with inputval.open() as hdul:
-            _logger.info('loading "%s"', key)
-            _logger.debug('info: %s', info)
-            corrector = corrector_class(
-                hdul[0].data,
-                datamodel=datamodel,
-                calibid=datamodel.get_imgid(hdul)
-            )
+        _logger.info('loading "%s"', key)
+        _logger.debug('info: %s', info)
+        calib = load_calibration(inputval, datamodel, kind='bpm')
+        corrector = corrector_class(
+            calib.data,
+            datamodel=datamodel,
+            calibid=calib.calibid
+        )
     else:
         _logger.info('"%s" not provided, ignored', key)
         corrector = IdNode()
@@ -77,15 +78,14 @@ def get_corrector_b(rinput, meta):
     # Loading calibrations
     if use_bias:
         bias_info = meta['master_bias']
-        with rinput.master_bias.open() as hdul:
-            _logger.info('loading bias')
-            _logger.debug('bias info: %s', bias_info)
-            mbias = hdul[0].data
-            bias_corrector = BiasCorrector(
-                mbias,
-                datamodel=datamodel,
-                calibid = datamodel.get_imgid(hdul)
-            )
+        _logger.info('loading bias')
+        _logger.debug('bias info: %s', bias_info)
+        calib = load_calibration(rinput.master_bias, datamodel, kind='bias')
+        bias_corrector = BiasCorrector(
+            calib.data,
+            datamodel=datamodel,
+            calibid=calib.calibid
+        )
     else:
         _logger.info('ignoring bias')
         bias_corrector = IdNode()
@@ -101,14 +101,14 @@ def get_corrector_s(rinput, meta):
     if sky_info is None:
         return IdNode()
     else:
-        with rinput.master_sky.open() as hdul:
-            _logger.info('loading sky')
-            _logger.debug('sky info: %s', sky_info)
-            sky_corrector = SkyCorrector(
-                hdul[0].data,
-                datamodel=datamodel,
-                calibid=datamodel.get_imgid(hdul)
-            )
+        _logger.info('loading sky')
+        _logger.debug('sky info: %s', sky_info)
+        calib = load_calibration(rinput.master_sky, datamodel, kind='sky')
+        sky_corrector = SkyCorrector(
+            calib.data,
+            datamodel=datamodel,
+            calibid=calib.calibid
+        )
         return sky_corrector
 
 
@@ -116,24 +116,33 @@ def get_corrector_f(rinput, meta):
     from emirdrp.processing.flatfield import FlatFieldCorrector
     flat_info = meta['master_flat']
     datamodel = EmirDataModel()
-    with rinput.master_flat.open() as hdul:
-        _logger.info('loading intensity flat')
-        _logger.debug('flat info: %s', flat_info)
-        mflat = hdul[0].data
-        # Check NaN and Ceros
-        mask1 = mflat < 0
-        mask2 = ~numpy.isfinite(mflat)
-        if numpy.any(mask1):
-            _logger.warning('flat has %d values below 0', mask1.sum())
-        if numpy.any(mask2):
-            _logger.warning('flat has %d NaN', mask2.sum())
-        flat_corrector = FlatFieldCorrector(mflat,
-                                            datamodel=datamodel,
-                                            calibid=datamodel.get_imgid(hdul))
+    _logger.info('loading intensity flat')
+    _logger.debug('flat info: %s', flat_info)
+    calib = load_calibration(rinput.master_flat, datamodel, kind='flat',
+                             prepare=prepare_flat)
+    # Check NaN and Ceros
+    if calib.stats['nneg'] > 0:
+        _logger.warning('flat has %d values below 0', calib.stats['nneg'])
+    if calib.stats['nnan'] > 0:
+        _logger.warning('flat has %d NaN', calib.stats['nnan'])
+    # the frames of the flow are not shared, correct them in place
+    flat_corrector = FlatFieldCorrector(calib.data,
+                                        datamodel=datamodel,
+                                        calibid=calib.calibid,
+                                        inplace=True)
 
     return flat_corrector
 
 
+def prepare_flat(mflat):
+    """Count invalid values in a flat and replace values <= 0 by 1."""
+    stats = {}
+    stats['nneg'] = int((mflat < 0).sum())
+    stats['nnan'] = int((~numpy.isfinite(mflat)).sum())
+    mflat[mflat <= 0] = 1.0  # To avoid NaN
+    return mflat, stats
+
+
 def get_corrector_d(rinput, meta):
     from numina.flow.processing import DarkCorrector
     key = 'master_dark'
@@ -145,16 +154,21 @@ def get_corrector_d(rinput, meta):
 
 def get_corrector_gen(rinput, datamodel, CorrectorClass, key):
     req = getattr(rinput, key)
-    with req.open() as hdul:
-        datac = hdul['primary'].data
-        corrector = CorrectorClass(
-            datac,
-            calibid=datamodel.get_imgid(hdul),
-            datamodel=datamodel
-        )
+    calib = load_calibration(req, datamodel, kind=key)
+    corrector = CorrectorClass(
+        calib.data,
+        calibid=calib.calibid,
+        datamodel=datamodel
+    )
     return corrector
 
 
+def get_corrector_distortion(rinput, meta):
+    from emirdrp.processing.distortion import DistortionCorrector
+    _logger.info('distortion correction enabled')
+    return DistortionCorrector(datamodel=EmirDataModel())
+
+
 def get_checker(rinput, meta):
     from emirdrp.processing.checkers import Checker
     return Checker()
@@ -184,6 +198,10 @@ class EmirRecipe(BaseRecipe):
     logger :
          recipe logger
 
+    correct_distortion : bool, False by default
+         if True, the frames are resampled to virtual pixels
+         at the end of the basic calibration flow
+
     datamodel : EmirDataModel
 
     """
@@ -192,6 +210,7 @@ class EmirRecipe(BaseRecipe):
     qc = Product(QualityControlProduct, destination='qc', default=QC.GOOD)
     logger = logging.getLogger('numina.recipes.emir')
     datamodel = EmirDataModel()
+    correct_distortion = False
 
     @classmethod
     def types_getter(cls):
@@ -221,6 +240,8 @@ class EmirRecipe(BaseRecipe):
                     break
             else:
                 pass
+        if cls.correct_distortion:
+            used_getters.append(get_corrector_distortion)
         return used_getters
 
     @classmethod
@@ -27,6 +27,7 @@ import numina.datamodel
 import astropy.wcs
 
 import emirdrp.instrument
+from emirdrp.processing.headers import dframe_headers
 
 
 _logger = logging.getLogger(__name__)
@@ -66,17 +67,18 @@ class EmirDataModel(numina.datamodel.DataModel):
             return super(EmirDataModel, self).get_imgid(img)
 
     def gather_info_dframe(self, img):
-        with img.open() as hdulist:
-            info = self.gather_info_hdu(hdulist)
-        return info
+        return self.gather_info_headers(dframe_headers(img))
 
     def gather_info_hdu(self, hdulist):
+        return self.gather_info_headers([hdu.header for hdu in hdulist])
+
+    def gather_info_headers(self, headers):
         meta = {}
-        meta['n_ext'] = len(hdulist)
-        extnames = [hdu.header.get('extname', '') for hdu in hdulist[1:]]
+        meta['n_ext'] = len(headers)
+        extnames = [hdr.get('extname', '') for hdr in headers[1:]]
         meta['name_ext'] = ['PRIMARY'] + extnames
         for key, val in self._meta.items():
-            meta[key] = hdulist[0].header.get(val[0], val[1])
+            meta[key] = headers[0].get(val[0], val[1])
 
         return meta
 
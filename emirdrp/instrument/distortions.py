@@ -18,49 +18,139 @@
 #
 
 
+"""Optical distortion of EMIR images"""
+
+import os
+import hashlib
+import logging
+
 import numpy
 
 
 from . import EMIR_PLATESCALE_RADS
 
+_logger = logging.getLogger('numina.recipes.emir')
 
-def exvp(pos_x, pos_y):
-    pos_x = numpy.asarray(pos_x)
-    pos_y = numpy.asarray(pos_y)
-    # convert virtual pixel to real pixel
-    # convert world coordinate to pixel
-    center = [1024.5, 1024.5]
-    cf  = EMIR_PLATESCALE_RADS
-    pos_base_x = pos_x - center[0]
-    pos_base_y = pos_y - center[1]
-    ra = numpy.hypot(pos_base_x, pos_base_y)
-    thet = numpy.arctan2(pos_base_y, pos_base_x)
 
-    r  = cf * ra
+def _radial_factor(coeffs, rho2):
+    c0, c2, c4 = coeffs
+    return c0 + rho2 * (c2 + rho2 * c4)
+
+
+class RadialDistortion(object):
+    """Radial distortion around a center.
+
+    A point at distance r (in radians) of the center is moved to a
+    distance r * (c0 + k2 r**2 + k4 r**4). *forward* are the
+    coefficients (c0, k2, k4) of the transformation from virtual to
+    real pixels, *inverse* those of the approximate inverse. *scale*
+    converts pixels to radians. The coefficients are stored in pixel
+    units, so that the transformations only need the squared distance
+    to the center, without trigonometric functions.
+
+    Coordinates are in FITS convention, the first pixel is 1.
+    """
+    def __init__(self, center, forward, inverse, scale=1.0):
+        self.center = tuple(float(c) for c in center)
+        self.scale = scale
+        self.coeffs = tuple(forward)
+        self.inv_coeffs = tuple(inverse)
+        self._forward = self._in_pixels(forward)
+        self._inverse = self._in_pixels(inverse)
+        self._grids = {}
+
+    def _in_pixels(self, coeffs):
+        c0, k2, k4 = coeffs
+        s2 = self.scale * self.scale
+        return c0, k2 * s2, k4 * s2 * s2
+
+    def _apply(self, coeffs, x, y):
+        dx = numpy.asarray(x, dtype='float64') - self.center[0]
+        dy = numpy.asarray(y, dtype='float64') - self.center[1]
+        factor = _radial_factor(coeffs, dx * dx + dy * dy)
+        return dx * factor + self.center[0], dy * factor + self.center[1]
+
+    def forward(self, x, y):
+        """Transform virtual pixels to real pixels.
+
+        x and y are arrays of any shape, transformed at once.
+        """
+        return self._apply(self._forward, x, y)
 
-    rr1 = 1 + 14606.7 * r**2 + 1739716115.1 * r**4
+    def inverse(self, x, y, iterations=0):
+        """Transform real pixels to virtual pixels.
 
-    nx1 = rr1 * ra * numpy.cos(thet) + center[0]
-    ny1 = rr1 * ra * numpy.sin(thet) + center[1]
-    return nx1, ny1
+        The inverse polynomial is used. With *iterations* > 0, the
+        result is refined by Newton iterations of the forward
+        transformation.
+        """
+        if iterations <= 0:
+            return self._apply(self._inverse, x, y)
+
+        dx = numpy.asarray(x, dtype='float64') - self.center[0]
+        dy = numpy.asarray(y, dtype='float64') - self.center[1]
+        rho_r = numpy.hypot(dx, dy)
+        rho = rho_r * _radial_factor(self._inverse, rho_r * rho_r)
+        c0, c2, c4 = self._forward
+        for _ in range(iterations):
+            rho2 = rho * rho
+            value = rho * _radial_factor(self._forward, rho2) - rho_r
+            deriv = c0 + rho2 * (3 * c2 + 5 * c4 * rho2)
+            rho = rho - value / deriv
+        safe = numpy.where(rho_r > 0, rho_r, 1.0)
+        factor = numpy.where(rho_r > 0, rho / safe, 1.0 / c0)
+        return dx * factor + self.center[0], dy * factor + self.center[1]
+
+    def _grid_key(self, shape):
+        desc = repr((self.center, self.scale, self.coeffs, tuple(shape)))
+        return hashlib.sha1(desc.encode('ascii')).hexdigest()[:16]
+
+    def remap_grid(self, shape, cachedir=None):
+        """Positions in the real image of the pixels of a virtual image.
+
+        Returns an array of shape (2,) + shape, with the rows and columns
+        (0-based) in the real image of each pixel of the virtual image,
+        to be used with scipy.ndimage.map_coordinates. The grid is kept
+        in memory, and in *cachedir* if given.
+        """
+        shape = tuple(shape)
+        if shape in self._grids:
+            return self._grids[shape]
+
+        filename = None
+        if cachedir is not None:
+            filename = os.path.join(
+                cachedir, 'distortion-%s.npy' % self._grid_key(shape))
+            if os.path.exists(filename):
+                _logger.debug('reading remap grid from %s', filename)
+                grid = numpy.load(filename)
+                self._grids[shape] = grid
+                return grid
+
+        rows, cols = numpy.indices(shape, dtype='float64')
+        # FITS coordinates are 1-based
+        x, y = self.forward(cols + 1, rows + 1)
+        grid = numpy.array([y - 1, x - 1], dtype='float32')
+        if filename is not None:
+            _logger.debug('writing remap grid to %s', filename)
+            numpy.save(filename, grid)
+        self._grids[shape] = grid
+        return grid
+
+
+EMIR_DISTORTION = RadialDistortion(
+    center=(1024.5, 1024.5),
+    forward=(1.0, 14606.7, 1739716115.1),
+    inverse=(1.000051, -14892, -696254464),
+    scale=EMIR_PLATESCALE_RADS
+)
+
+
+def exvp(pos_x, pos_y):
+    """Convert virtual pixel to real pixel."""
+    return EMIR_DISTORTION.forward(pos_x, pos_y)
 
 
 def pvex(pos_x, pos_y):
-    # convert real pixel to virtual pixel.
-    # convert pixel to world coordinate
-    pos_x = numpy.asarray(pos_x)
-    pos_y = numpy.asarray(pos_y)
-
-    center = [1024.5, 1024.5]
-    cf  = EMIR_PLATESCALE_RADS
-    pos_base_x = pos_x - center[0]
-    pos_base_y = pos_y - center[1]
-    ra = numpy.hypot(pos_base_x, pos_base_y)
-    thet = numpy.arctan2(pos_base_y, pos_base_x)
-
-    r  = cf * ra
-    rr1 = 1.000051 - 14892 * r**2 - 696254464 * r**4
-
-    nx1 = rr1 * ra * numpy.cos(thet) + center[0]
-    ny1 = rr1 * ra * numpy.sin(thet) + center[1]
-    return nx1, ny1
+    """Convert real pixel to virtual pixel."""
+    return EMIR_DISTORTION.inverse(pos_x, pos_y)
@@ -0,0 +1,53 @@
+import numpy
+
+from .. import EMIR_PLATESCALE_RADS
+from ..distortions import exvp, pvex, EMIR_DISTORTION
+
+
+def _exvp_trig(pos_x, pos_y):
+    # Reference, in polar coordinates
+    center = [1024.5, 1024.5]
+    pos_base_x = numpy.asarray(pos_x) - center[0]
+    pos_base_y = numpy.asarray(pos_y) - center[1]
+    ra = numpy.hypot(pos_base_x, pos_base_y)
+    thet = numpy.arctan2(pos_base_y, pos_base_x)
+    r = EMIR_PLATESCALE_RADS * ra
+    rr1 = 1 + 14606.7 * r**2 + 1739716115.1 * r**4
+    return (rr1 * ra * numpy.cos(thet) + center[0],
+            rr1 * ra * numpy.sin(thet) + center[1])
+
+
+def test_exvp_batch():
+    rng = numpy.random.RandomState(5)
+    x, y = rng.uniform(1, 2048, size=(2, 50))
+    nx, ny = exvp(x, y)
+    ex, ey = _exvp_trig(x, y)
+    numpy.testing.assert_allclose(nx, ex, rtol=0, atol=1e-9)
+    numpy.testing.assert_allclose(ny, ey, rtol=0, atol=1e-9)
+    # scalars are accepted
+    sx, sy = exvp(x[3], y[3])
+    assert abs(sx - nx[3]) < 1e-12 and abs(sy - ny[3]) < 1e-12
+
+
+def test_inverse():
+    x = numpy.array([1.0, 1024.5, 300.0, 2048.0])
+    y = numpy.array([1.0, 1024.5, 1900.0, 10.0])
+    rx, ry = exvp(x, y)
+    # the inverse polynomial is approximate
+    vx, vy = pvex(rx, ry)
+    assert numpy.abs(vx - x).max() < 0.5
+    assert numpy.abs(vy - y).max() < 0.5
+    vx, vy = EMIR_DISTORTION.inverse(rx, ry, iterations=3)
+    numpy.testing.assert_allclose(vx, x, atol=1e-6)
+    numpy.testing.assert_allclose(vy, y, atol=1e-6)
+
+
+def test_remap_grid_cache(tmpdir):
+    shape = (6, 5)
+    grid = EMIR_DISTORTION.remap_grid(shape, cachedir=str(tmpdir))
+    assert grid.shape == (2,) + shape
+    x, y = exvp(3 + 1, 2 + 1)
+    numpy.testing.assert_allclose(grid[:, 2, 3], [y - 1, x - 1], rtol=1e-6)
+    assert len(tmpdir.listdir()) == 1
+    cached = numpy.load(str(tmpdir.listdir()[0]))
+    numpy.testing.assert_array_equal(cached, grid)
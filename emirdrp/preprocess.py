@@ -21,17 +21,30 @@
 
 from __future__ import division
 
-import six
+import os
+import sys
+import glob
+import time
+import logging
+import argparse
+import multiprocessing
 
+import six
+import numpy
 from astropy.io import fits
 
-from numina.array import ramp_array, fowler_array
-
 from .core import EMIR_READ_MODES
 
+_logger = logging.getLogger('numina.recipes.emir')
+
 PREPROC_KEY = 'READPROC'
 PREPROC_VAL = True
 
+# Value of the MASK extension in saturated pixels, as in numina
+MASK_SATURATION = 3
+# Modes with several reads of each pixel
+READ_MODES = ['cds', 'fowler', 'ramp']
+
 
 class ReadModeGuessing(object):
     def __init__(self, mode, info=None):
@@ -40,7 +53,11 @@ class ReadModeGuessing(object):
 
 
 def image_readmode(hdulist, default=None):
-    header = hdulist[0].header
+    return header_readmode(hdulist[0].header, default=default)
+
+
+def header_readmode(header, default=None):
+    """Guess the read mode of an image, from its header only."""
     if 'READMODE' in header:
         p_readmode = header['READMODE'].lower()
         if p_readmode in EMIR_READ_MODES:
@@ -48,7 +65,8 @@ def image_readmode(hdulist, default=None):
                                     info={'source': 'keyword'}
                                     )
     # Using heuristics
-    shape = hdulist[0].shape
+    shape = tuple(header['NAXIS%d' % idx]
+                  for idx in range(header['NAXIS'], 0, -1))
     if len(shape) == 2:
         # A 2D image, mode is single
         return ReadModeGuessing(mode='single', info={'source': 'heuristics'})
@@ -65,6 +83,132 @@ def image_readmode(hdulist, default=None):
         return None
 
 
+def is_preprocessed(header):
+    """True if the image has been preprocessed already."""
+    return bool(header.get(PREPROC_KEY, False)) or 'PREPROC' in header
+
+
+def _finish_block(value, var, npix, badpixels, blank):
+    """Blank the pixels without valid reads and the bad pixels."""
+    mask = numpy.zeros(npix.shape, dtype='uint8')
+    empty = npix == 0
+    value[empty] = blank
+    var[empty] = blank
+    mask[empty] = MASK_SATURATION
+    if badpixels is not None:
+        bad = badpixels != 0
+        value[bad] = blank
+        var[bad] = blank
+        npix[bad] = 0
+        mask[bad] = badpixels[bad]
+    return value, var, npix.astype('uint8'), mask
+
+
+def fowler_block(read, nreads, ti=0.0, ts=0.0, gain=1.0, ron=1.0,
+                 saturation=55000.0, blank=0, badpixels=None):
+    """Fowler processing of a block of rows.
+
+    read(z) returns the read z of the block. The signal is the mean
+    of the differences of the pairs of reads below saturation, the
+    variance is computed as in numina.array.fowler_array. Only two
+    reads are in memory at a time.
+    """
+    npairs = nreads // 2
+    if 2 * npairs != nreads:
+        raise ValueError('number of reads must be even')
+
+    accum = 0.0
+    npix = 0
+    for z in range(npairs):
+        first = numpy.asarray(read(z), dtype='float64')
+        last = numpy.asarray(read(z + npairs), dtype='float64')
+        valid = (first < saturation) & (last < saturation)
+        accum = accum + numpy.where(valid, last - first, 0.0)
+        npix = npix + valid
+
+    num = numpy.maximum(npix, 1)
+    value = accum / num
+    rg = ron / gain
+    var = 2 * rg * rg / num
+    teff = ti - (npairs - 1) * ts
+    if teff > 0:
+        var += value / (gain * gain) * (1 + ts / (3 * teff) * (1 / num - num))
+    return _finish_block(value, var, npix, badpixels, blank)
+
+
+def ramp_block(read, nreads, ti, gain=1.0, ron=1.0,
+               saturation=55000.0, blank=0, badpixels=None):
+    """Follow-up-the-ramp processing of a block of rows.
+
+    read(z) returns the read z of the block. The slope is fitted
+    by least squares to the reads before the first saturated one,
+    in closed form from the running sums of the values and of the
+    values times their index. The variance is computed as in
+    numina.array.ramp_array. Only one read is in memory at a time.
+    """
+    if ti <= 0:
+        raise ValueError("invalid parameter, ti <= 0.0")
+    dt = ti / (nreads - 1)
+
+    alive = True
+    sum_y = 0.0
+    sum_iy = 0.0
+    npix = 0
+    for z in range(nreads):
+        values = numpy.asarray(read(z), dtype='float64')
+        # collecting stops at the first saturated read
+        alive = alive & (values < saturation)
+        if not numpy.any(alive):
+            break
+        values = numpy.where(alive, values, 0.0)
+        sum_y = sum_y + values
+        sum_iy = sum_iy + z * values
+        npix = npix + alive
+
+    npix = numpy.zeros(numpy.shape(values), dtype='int') + npix
+    # a slope needs two points
+    npix[npix < 2] = 0
+    num = numpy.where(npix > 0, npix, 2).astype('float64')
+    delt1 = num * (num + 1) * (num - 1) / 12.0
+    delt2 = 6.0 * (num * num + 1) / (5.0 * num * (num * num - 1))
+    value = (sum_iy - 0.5 * (num - 1) * sum_y) / (delt1 * dt)
+    rg = ron / gain
+    var = rg * rg / (delt1 * dt) + value * delt2 / dt
+    return _finish_block(value, var, npix, badpixels, blank)
+
+
+def _append_results(hdulist, result, var, npix, mask):
+    hdulist[0].data = result
+    for data, name in [(var, 'VARIANCE'), (npix, 'MAP'), (mask, 'MASK')]:
+        hdu = fits.ImageHDU(data)
+        hdu.update_ext_name(name)
+        hdulist.append(hdu)
+    return hdulist
+
+
+def _process_cube(cube, kernel, rows=64, dtype='float32', **kwds):
+    """Process a cube of reads in memory, by blocks of rows."""
+    nreads, nrows, ncols = cube.shape
+    result = numpy.empty((nrows, ncols), dtype=dtype)
+    var = numpy.empty_like(result)
+    npix = numpy.empty((nrows, ncols), dtype='uint8')
+    mask = numpy.empty_like(npix)
+    badpixels = kwds.pop('badpixels', None)
+    for r0 in range(0, nrows, rows):
+        block = slice(r0, min(r0 + rows, nrows))
+        bad = None if badpixels is None else badpixels[block]
+        out = kernel(lambda z: cube[z, block], nreads,
+                     badpixels=bad, **kwds)
+        for dest, values in zip([result, var, npix, mask], out):
+            dest[block] = values
+    return result, var, npix, mask
+
+
+def integration_time(header):
+    """Integration time of a raw frame, from its header."""
+    return header.get('EXPTIME', 0.0)
+
+
 def preprocess_single(hdulist):
     return hdulist
 
@@ -84,50 +228,128 @@ def preprocess_fowler(hdulist):
     # A master badpixel mask
     cube = hdulist[0].data
 
-    res, var, npix, mask = fowler_array(cube, ti=tint, ts=ts,
-                                        gain=gain, ron=ron,
-                                        badpixels=None,
-                                        dtype='float32',
-                                        saturation=55000.0
-                                        )
-    hdulist[0].data = res
-    varhdu = fits.ImageHDU(var)
-    varhdu.update_ext_name('VARIANCE')
-    hdulist.append(varhdu)
-    nmap = fits.ImageHDU(npix)
-    nmap.update_ext_name('MAP')
-    hdulist.append(nmap)
-    nmask_hdu = fits.ImageHDU(mask)
-    nmask_hdu.update_ext_name('MASK')
-    hdulist.append(nmask_hdu)
-    return hdulist
+    rslt = _process_cube(cube, fowler_block, ti=tint, ts=ts,
+                         gain=gain, ron=ron, badpixels=None,
+                         saturation=55000.0)
+    return _append_results(hdulist, *rslt)
 
 
 def preprocess_ramp(hdulist):
     hdulist[0].header.update(PREPROC_KEY, PREPROC_VAL)
     cube = hdulist[0].data
     # We need
-    ti = 0.0  # Integration time
+    ti = integration_time(hdulist[0].header)  # Integration time
     gain = 1.0
     ron = 1.0
-    rslt = ramp_array(cube, ti, gain=gain,
-                      ron=ron, badpixels=None,
-                      dtype='float32', saturation=55000.0
-                      )
-    result, var, npix, mask = rslt
+    rslt = _process_cube(cube, ramp_block, ti=ti, gain=gain,
+                         ron=ron, badpixels=None, saturation=55000.0)
+    return _append_results(hdulist, *rslt)
 
-    hdulist[0].data = result
-    varhdu = fits.ImageHDU(var)
-    varhdu.update_ext_name('VARIANCE')
-    hdulist.append(varhdu)
-
-    nmap = fits.ImageHDU(npix)
-    nmap.update_ext_name('MAP')
-    hdulist.append(nmap)
-    nmask = fits.ImageHDU(mask)
-    nmask.update_ext_name('MASK')
-    hdulist.append(nmask)
-    return hdulist
+
+def _output_headers(header, shape):
+    """Headers of the preprocessed image and its extensions."""
+    nrows, ncols = shape
+    primary = header.copy()
+    primary['BITPIX'] = -32
+    primary['NAXIS'] = 2
+    primary['NAXIS1'] = ncols
+    primary['NAXIS2'] = nrows
+    for key in ['NAXIS3', 'BSCALE', 'BZERO']:
+        if key in primary:
+            del primary[key]
+    primary.set('EXTEND', True, after='NAXIS2')
+    primary[PREPROC_KEY] = PREPROC_VAL
+
+    headers = [(primary, 4)]
+    for name, bitpix in [('VARIANCE', -32), ('MAP', 8), ('MASK', 8)]:
+        ext = fits.Header([('XTENSION', 'IMAGE'), ('BITPIX', bitpix),
+                           ('NAXIS', 2), ('NAXIS1', ncols),
+                           ('NAXIS2', nrows), ('PCOUNT', 0),
+                           ('GCOUNT', 1), ('EXTNAME', name)])
+        headers.append((ext, abs(bitpix) // 8))
+    return headers
+
+
+def _create_output(filename, header, shape):
+    """Write the headers of the output, with space for the data."""
+    with open(filename, 'wb') as fd:
+        for hdr, itemsize in _output_headers(header, shape):
+            fd.write(hdr.tostring().encode('ascii'))
+            nbytes = shape[0] * shape[1] * itemsize
+            # FITS blocks have 2880 bytes
+            padded = -(-nbytes // 2880) * 2880
+            fd.seek(padded - 1, 1)
+            fd.write(b'\0')
+
+
+def preprocess_stream(input_, output, mode, rows=64, badpixels=None,
+                      ti=None, ts=0.0, gain=1.0, ron=1.0,
+                      saturation=55000.0, blank=0):
+    """Preprocess a raw cube of reads from a file, by blocks of rows.
+
+    The cube is read with a memory map, one read of a block of
+    *rows* rows at a time, and the result and the VARIANCE, MAP and
+    MASK extensions are written to *output* block by block. The
+    memory used does not depend on the number of reads.
+
+    The input is checked before anything is written, and the output
+    is written under a temporary name, renamed when it is complete.
+    """
+    with fits.open(input_, memmap=True, do_not_scale_image_data=True) as hdul:
+        header = hdul[0].header
+        cube = hdul[0].data
+        bscale = header.get('BSCALE', 1.0)
+        bzero = header.get('BZERO', 0.0)
+        if cube is None or cube.ndim != 3:
+            raise ValueError('%s is not a cube of reads' % input_)
+        nreads, nrows, ncols = cube.shape
+
+        if mode in ['cds', 'fowler']:
+            kernel = fowler_block
+            params = dict(ti=0.0 if ti is None else ti, ts=ts)
+            if nreads < 2 or nreads % 2 != 0:
+                raise ValueError('number of reads must be even, '
+                                 'it is %d' % nreads)
+        elif mode == 'ramp':
+            kernel = ramp_block
+            params = dict(ti=integration_time(header) if ti is None else ti)
+            if nreads < 2:
+                raise ValueError('a ramp needs two reads, '
+                                 'there are %d' % nreads)
+            if params['ti'] <= 0:
+                raise ValueError('invalid integration time %s in %s' %
+                                 (params['ti'], input_))
+        else:
+            raise ValueError('mode %s is not a mode with reads' % mode)
+
+        if badpixels is not None and badpixels.shape != (nrows, ncols):
+            raise ValueError('badpixels shape %s does not match %s' %
+                             (badpixels.shape, (nrows, ncols)))
+
+        _logger.info('preprocessing %s, mode %s, %d reads, in blocks '
+                     'of %d rows', input_, mode, nreads, rows)
+        tmpname = output + '.part'
+        try:
+            _create_output(tmpname, header, (nrows, ncols))
+            with fits.open(tmpname, mode='update', memmap=True) as out:
+                for r0 in range(0, nrows, rows):
+                    block = slice(r0, min(r0 + rows, nrows))
+
+                    def read(z):
+                        values = numpy.asarray(cube[z, block],
+                                               dtype='float64')
+                        return values * bscale + bzero
+
+                    bad = None if badpixels is None else badpixels[block]
+                    result = kernel(read, nreads, gain=gain, ron=ron,
+                                    saturation=saturation, blank=blank,
+                                    badpixels=bad, **params)
+                    for hdu, values in zip(out, result):
+                        hdu.data[block] = values
+            os.rename(tmpname, output)
+        finally:
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
 
 
 def fits_wrapper(frame):
@@ -140,11 +362,19 @@ def fits_wrapper(frame):
 
 
 def preprocess(input_, output):
+    if isinstance(input_, six.string_types):
+        header = fits.getheader(input_)
+        guess = header_readmode(header, 'single')
+        if not is_preprocessed(header) and guess.mode in READ_MODES:
+            # The cube of reads is not loaded in memory
+            preprocess_stream(input_, output, guess.mode)
+            return
+
     with fits_wrapper(input_) as hdulist:
         header = hdulist[0].header
-        if 'PREPROC' in header:
+        if is_preprocessed(header):
             # if the image is preprocessed, do nothing
-            if input != output:
+            if input_ != output:
                 hdulist.writeto(output, clobber=True)
             return
         # determine the READ mode
@@ -160,8 +390,132 @@ def preprocess(input_, output):
         elif guess.mode == 'fowler':
             hduproc = preprocess_fowler(hdulist)
         elif guess.mode == 'ramp':
-            pass
+            hduproc = preprocess_ramp(hdulist)
         else:
             hduproc = preprocess_single(hdulist)
 
         hduproc.writeto(output, clobber=True)
+
+
+def find_frames(paths, pattern='*.fits'):
+    """FITS files in paths, that can be files, directories or globs."""
+    frames = []
+    for path in paths:
+        if os.path.isdir(path):
+            names = glob.glob(os.path.join(path, pattern))
+        else:
+            names = glob.glob(path)
+            if not names:
+                _logger.warning('no files match %s', path)
+        frames.extend(sorted(names))
+    return frames
+
+
+def _preprocess_task(args):
+    """Preprocess a file, return its name, status, size and time.
+
+    The output is written under a temporary name and renamed when it
+    is complete, so that a failure never leaves a partial frame.
+    """
+    input_, output = args
+    start = time.time()
+    tmpname = output + '.part'
+    try:
+        header = fits.getheader(input_)
+        if is_preprocessed(header):
+            return input_, 'skipped', 0, 0.0
+        guess = header_readmode(header, 'single')
+        if output == input_ and guess.mode not in READ_MODES:
+            # nothing to do in place
+            return input_, 'skipped', 0, 0.0
+        nbytes = os.path.getsize(input_)
+        # in place, the input is read while the output is written
+        preprocess(input_, tmpname)
+        os.rename(tmpname, output)
+        return input_, guess.mode, nbytes, time.time() - start
+    except Exception as error:
+        return input_, 'failed, %s' % error, 0, time.time() - start
+    finally:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+
+
+def preprocess_batch(frames, outdir=None, nprocs=1):
+    """Preprocess a list of raw frames with a pool of processes.
+
+    The preprocessed frames are written in *outdir* with the same
+    name, or replace the raw frames if outdir is None. Frames
+    already preprocessed are skipped, without copies. Returns the
+    number of frames preprocessed, skipped and failed.
+    """
+    if outdir is None:
+        tasks = [(frame, frame) for frame in frames]
+    else:
+        tasks = [(frame, os.path.join(outdir, os.path.basename(frame)))
+                 for frame in frames]
+
+    counts = {'done': 0, 'skipped': 0, 'failed': 0}
+    nbytes = 0
+    start = time.time()
+    if nprocs > 1:
+        pool = multiprocessing.Pool(nprocs)
+        results = pool.imap_unordered(_preprocess_task, tasks, chunksize=1)
+    else:
+        pool = None
+        results = six.moves.map(_preprocess_task, tasks)
+    try:
+        for idx, (frame, status, size, elapsed) in enumerate(results, 1):
+            if status == 'skipped':
+                counts['skipped'] += 1
+            elif status.startswith('failed'):
+                counts['failed'] += 1
+            else:
+                counts['done'] += 1
+                nbytes += size
+            _logger.info('[%d/%d] %s: %s, %.1f s', idx, len(tasks),
+                         frame, status, elapsed)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    total = max(time.time() - start, 1e-6)
+    _logger.info('%d frames preprocessed, %d skipped, %d failed, '
+                 'in %.1f s, %.2f frames/s, %.1f MB/s',
+                 counts['done'], counts['skipped'], counts['failed'], total,
+                 counts['done'] / total, nbytes / total / 2 ** 20)
+    return counts
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description='Preprocess raw EMIR frames with several reads')
+    parser.add_argument('paths', nargs='+',
+                        help='FITS files, directories or globs')
+    parser.add_argument('-o', '--outdir', default=None,
+                        help='directory of the preprocessed frames')
+    parser.add_argument('--in-place', action='store_true',
+                        help='replace the raw frames with the '
+                             'preprocessed frames')
+    parser.add_argument('-j', '--nprocs', type=int, default=1,
+                        help='number of worker processes')
+    parser.add_argument('--pattern', default='*.fits',
+                        help='pattern of the files in directories')
+    args = parser.parse_args(args)
+    if args.outdir is None and not args.in_place:
+        parser.error('an output directory (-o) or --in-place is required')
+    if args.outdir is not None and args.in_place:
+        parser.error('-o and --in-place are mutually exclusive')
+
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    frames = find_frames(args.paths, pattern=args.pattern)
+    if args.outdir is not None and not os.path.isdir(args.outdir):
+        os.makedirs(args.outdir)
+    counts = preprocess_batch(frames, outdir=args.outdir,
+                              nprocs=args.nprocs)
+    return 1 if counts['failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
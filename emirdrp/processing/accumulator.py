@@ -0,0 +1,140 @@
+#
+# Copyright 2017 Universidad Complutense de Madrid
+#
+# This file is part of PyEmir
+#
+# PyEmir is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyEmir is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyEmir.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Running accumulation of images"""
+
+from __future__ import division
+
+import numpy
+from astropy.io import fits
+
+
+# Names of the extensions storing the state of the accumulator
+ACCUM_SUM = 'ACCSUM'
+ACCUM_SUM2 = 'ACCSUM2'
+ACCUM_NUM = 'ACCNUM'
+
+
+class RunningStack(object):
+    """Pixel by pixel running sums of images.
+
+    The stack stores, for each pixel, the sum of the values, the sum
+    of the squares of the values and the number of values. Adding
+    an image is an update of the sums, the mean, variance and number of
+    images can be obtained at any moment.
+
+    The variance is the sample variance of the values, as in
+    the combination methods of numina.
+
+    """
+    def __init__(self, total, total2, num):
+        self.total = total
+        self.total2 = total2
+        self.num = num
+
+    @property
+    def shape(self):
+        return self.total.shape
+
+    @classmethod
+    def zeros(cls, shape):
+        return cls(numpy.zeros(shape), numpy.zeros(shape), numpy.zeros(shape))
+
+    @classmethod
+    def from_hdulist(cls, hdulist, mask=None):
+        """Create a stack from an image.
+
+        If the image has the accumulator extensions, the stack is
+        restored from them, otherwise the image is the first element
+        of the stack. *mask* has True (or non zero) values in the
+        pixels to ignore.
+        """
+        if has_accumulator(hdulist):
+            return cls(numpy.array(hdulist[ACCUM_SUM].data, dtype='float64'),
+                       numpy.array(hdulist[ACCUM_SUM2].data, dtype='float64'),
+                       numpy.array(hdulist[ACCUM_NUM].data, dtype='float64'))
+        stack = cls.zeros(hdulist[0].shape)
+        stack.add(hdulist[0].data, mask=mask)
+        return stack
+
+    def add(self, data, mask=None, region=None):
+        """Add an image to the stack, in place.
+
+        If *region* is not None, the image is added to that region
+        of the stack.
+        """
+        region = Ellipsis if region is None else tuple(region)
+        data = numpy.asarray(data, dtype='float64')
+        if mask is None:
+            self.total[region] += data
+            self.total2[region] += data * data
+            self.num[region] += 1
+        else:
+            valid = numpy.logical_not(mask)
+            self.total[region] += numpy.where(valid, data, 0.0)
+            self.total2[region] += numpy.where(valid, data * data, 0.0)
+            self.num[region] += valid
+        return self
+
+    def resize(self, shape, region):
+        """Place the stack in *region* of an empty stack of *shape*."""
+        region = tuple(region)
+        if tuple(shape) == self.shape and all(
+                sl.start in [0, None] and sl.stop in [dim, None]
+                for sl, dim in zip(region, shape)):
+            return self
+        result = RunningStack.zeros(shape)
+        result.total[region] = self.total
+        result.total2[region] = self.total2
+        result.num[region] = self.num
+        return result
+
+    def result(self, dtype='float32'):
+        """Mean, variance and number of values.
+
+        Returns an array of shape (3,) + shape, as the
+        combination methods in numina. The variance is zero
+        in pixels with less than two values.
+        """
+        out = numpy.zeros((3,) + self.shape, dtype=dtype)
+        valid = self.num > 0
+        num = self.num[valid]
+        total = self.total[valid]
+        mean = total / num
+        var = numpy.zeros_like(mean)
+        many = num > 1
+        var[many] = ((self.total2[valid][many] - total[many] * mean[many]) /
+                     (num[many] - 1))
+        # Remove negative values due to rounding
+        numpy.clip(var, 0.0, None, out=var)
+        out[0][valid] = mean
+        out[1][valid] = var
+        out[2] = self.num
+        return out
+
+    def to_hdus(self):
+        """HDUs storing the state of the stack."""
+        return [fits.ImageHDU(self.total, name=ACCUM_SUM),
+                fits.ImageHDU(self.total2, name=ACCUM_SUM2),
+                fits.ImageHDU(self.num.astype('int32'), name=ACCUM_NUM)]
+
+
+def has_accumulator(hdulist):
+    """True if hdulist contains the state of a RunningStack."""
+    return all(name in hdulist for name in [ACCUM_SUM, ACCUM_SUM2, ACCUM_NUM])
@@ -0,0 +1,145 @@
+#
+# Copyright 2017 Universidad Complutense de Madrid
+#
+# This file is part of PyEmir
+#
+# PyEmir is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyEmir is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyEmir.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Process-wide cache of master calibrations"""
+
+import collections
+import logging
+import os
+import threading
+
+import numpy
+
+
+_logger = logging.getLogger(__name__)
+
+# Default memory ceiling, in bytes
+DEFAULT_MAXBYTES = 512 * 1024 * 1024
+
+
+CalibrationEntry = collections.namedtuple(
+    'CalibrationEntry', ['calibid', 'data', 'stats']
+)
+
+
+def _readonly(arr):
+    arr.flags.writeable = False
+    return arr
+
+
+class CalibrationCache(object):
+    """LRU cache of the data of master calibrations.
+
+    Entries are keyed by the kind of calibration, its calibration id
+    and the modification time of its file. The arrays are read-only and
+    the total size of the cached arrays is kept below *maxbytes*.
+
+    """
+    def __init__(self, maxbytes=DEFAULT_MAXBYTES):
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def resize(self, maxbytes):
+        with self._lock:
+            self.maxbytes = maxbytes
+            self._evict()
+
+    def _evict(self):
+        while self._entries and self.nbytes > self.maxbytes:
+            key, entry = self._entries.popitem(last=False)
+            self.nbytes -= entry.data.nbytes
+            _logger.debug('evict calibration %s', key)
+
+    def load(self, dframe, datamodel, kind='data', prepare=None,
+             ext='primary'):
+        """Load the data of a calibration.
+
+        *prepare* is a function that receives the data array and
+        returns a tuple with the array to be stored and a dictionary
+        of statistics. It is called only when the data is read from
+        the file.
+
+        Only calibrations stored in files are cached.
+
+        """
+        filename = getattr(dframe, 'filename', None)
+        if getattr(dframe, 'frame', None) is not None or filename is None:
+            return self._read(dframe, datamodel, prepare, ext)
+
+        mtime = os.path.getmtime(filename)
+        # The calibration id comes from the header only
+        with dframe.open() as hdulist:
+            calibid = datamodel.get_imgid(hdulist)
+            key = (kind, calibid, filename, mtime)
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    _logger.debug('calibration %s found in cache', key)
+                    self._entries.pop(key)
+                    self._entries[key] = entry
+                    return entry
+            entry = self._build(hdulist, calibid, prepare, ext)
+
+        with self._lock:
+            if entry.data.nbytes <= self.maxbytes:
+                if key not in self._entries:
+                    self._entries[key] = entry
+                    self.nbytes += entry.data.nbytes
+                    self._evict()
+            else:
+                _logger.debug('calibration %s too large to be cached', key)
+        return entry
+
+    def _read(self, dframe, datamodel, prepare, ext):
+        with dframe.open() as hdulist:
+            calibid = datamodel.get_imgid(hdulist)
+            return self._build(hdulist, calibid, prepare, ext)
+
+    def _build(self, hdulist, calibid, prepare, ext):
+        data = numpy.array(hdulist[ext].data)
+        if prepare is None:
+            stats = {}
+        else:
+            data, stats = prepare(data)
+        return CalibrationEntry(calibid, _readonly(data), stats)
+
+
+_cache = CalibrationCache()
+
+
+def get_cache():
+    """Return the process-wide calibration cache."""
+    return _cache
+
+
+def load_calibration(dframe, datamodel, kind='data', prepare=None,
+                     ext='primary'):
+    """Load a calibration using the process-wide cache."""
+    return _cache.load(dframe, datamodel, kind=kind, prepare=prepare,
+                       ext=ext)
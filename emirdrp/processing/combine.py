@@ -24,6 +24,9 @@ from __future__ import division
 import datetime
 #
 import logging
+import os
+import shutil
+import tempfile
 import uuid
 
 import numpy
@@ -32,6 +35,8 @@ from numina.array import combine
 from numina.array import combine_shape
 
 from emirdrp.processing.wcs import offsets_from_wcs
+from emirdrp.processing.parallel import imap_flow
+from emirdrp.processing.resample import OffsetView, combine_shifted
 from emirdrp.datamodel import EmirDataModel
 #
 
@@ -39,16 +44,14 @@ from emirdrp.datamodel import EmirDataModel
 _logger = logging.getLogger(__name__)
 
 
-def basic_processing(rinput, flow):
+def basic_processing(rinput, flow, nthreads=1):
     datamodel = EmirDataModel()
     cdata = []
 
     _logger.info('processing input images')
-    for frame in rinput.obresult.images:
-        hdulist = frame.open()
+    for hdulist, final in imap_flow(rinput.obresult.images, flow, nthreads):
         fname = datamodel.get_imgid(hdulist)
         _logger.info('input is %s', fname)
-        final = flow(hdulist)
         _logger.debug('output is input: %s', final is hdulist)
 
         cdata.append(final)
@@ -59,29 +62,48 @@ def basic_processing(rinput, flow):
 def basic_processing_with_combination(rinput, flow,
                                       method=combine.mean,
                                       errors=True,
-                                      prolog=None):
+                                      prolog=None,
+                                      tile_rows=None,
+                                      nthreads=1):
     return basic_processing_with_combination_frames(rinput.obresult.frames,
                                                     flow, method=method,
                                                     errors=errors,
-                                                    prolog=prolog)
+                                                    prolog=prolog,
+                                                    tile_rows=tile_rows,
+                                                    nthreads=nthreads)
 
 
 def basic_processing_with_combination_frames(frames,
                                              flow,
                                              method=combine.mean,
                                              errors=True,
-                                             prolog=None
+                                             prolog=None,
+                                             tile_rows=None,
+                                             nthreads=1
                                              ):
+    """Process frames with flow and combine them.
+
+    If *tile_rows* is not None, the calibrated frames are stored
+    in memory mapped files and the combination is computed in bands
+    of *tile_rows* rows. The result is identical.
+
+    If *nthreads* is greater than 1, the frames are calibrated
+    concurrently by a pool of threads.
+    """
+    if tile_rows is not None:
+        return basic_processing_with_combination_tiled(
+            frames, flow, method=method, errors=errors,
+            prolog=prolog, tile_rows=tile_rows, nthreads=nthreads
+        )
+
     odata = []
     cdata = []
     datamodel = EmirDataModel()
     try:
         _logger.info('processing input images')
-        for frame in frames:
-            hdulist = frame.open()
+        for hdulist, final in imap_flow(frames, flow, nthreads):
             fname = datamodel.get_imgid(hdulist)
             _logger.info('input is %s', fname)
-            final = flow(hdulist)
             _logger.debug('output is input: %s', final is hdulist)
             cdata.append(final)
             # Files to be closed at the end
@@ -121,6 +143,93 @@ def basic_processing_with_combination_frames(frames,
     return result
 
 
+def basic_processing_with_combination_tiled(frames,
+                                            flow,
+                                            method=combine.mean,
+                                            errors=True,
+                                            prolog=None,
+                                            tile_rows=256,
+                                            tmpdir=None,
+                                            nthreads=1
+                                            ):
+    """Process frames with flow and combine them in bands of rows.
+
+    Each calibrated frame is written to a memory mapped file in a
+    temporary directory and closed. The combination is computed
+    band by band, so only *tile_rows* rows of each frame are
+    read at a time.
+    """
+    datamodel = EmirDataModel()
+    workdir = tempfile.mkdtemp(prefix='emir-stack-', dir=tmpdir)
+    mdata = []
+    imgids = []
+    base_header = None
+    last_header = None
+    try:
+        _logger.info('processing input images')
+        calibrated = imap_flow(frames, flow, nthreads)
+        for idx, (hdulist, final) in enumerate(calibrated):
+            try:
+                fname = datamodel.get_imgid(hdulist)
+                _logger.info('input is %s', fname)
+                _logger.debug('output is input: %s', final is hdulist)
+                data = final[0].data
+                name = os.path.join(workdir, 'frame_%04d.npy' % idx)
+                mmap = numpy.lib.format.open_memmap(
+                    name, mode='w+', dtype=data.dtype, shape=data.shape
+                )
+                mmap[...] = data
+                mmap.flush()
+                del mmap
+                mdata.append(name)
+                imgids.append(datamodel.get_imgid(final))
+                if base_header is None:
+                    base_header = final[0].header.copy()
+                last_header = final[0].header
+                if final is not hdulist:
+                    final.close()
+            finally:
+                hdulist.close()
+
+        cnum = len(mdata)
+        arrays = [numpy.load(name, mmap_mode='r') for name in mdata]
+        shape = arrays[0].shape
+        _logger.info("stacking %d images using '%s', in bands of %d rows",
+                     cnum, method.__name__, tile_rows)
+        data = numpy.zeros((3,) + shape, dtype='float32')
+        for r0 in range(0, shape[0], tile_rows):
+            r1 = min(r0 + tile_rows, shape[0])
+            method([arr[r0:r1] for arr in arrays], dtype='float32',
+                   out=data[:, r0:r1])
+        del arrays
+
+        hdu = fits.PrimaryHDU(data[0], header=base_header)
+        _logger.debug('update result header')
+        if prolog:
+            _logger.debug('write prolog')
+            hdu.header['history'] = prolog
+        hdu.header['history'] = "Combined %d images using '%s'" % (cnum, method.__name__)
+        hdu.header['history'] = 'Combination time {}'.format(datetime.datetime.utcnow().isoformat())
+        for imgid in imgids:
+            hdu.header['history'] = "Image {}".format(imgid)
+        prevnum = base_header.get('NUM-NCOM', 1)
+        hdu.header['NUM-NCOM'] = prevnum * cnum
+        hdu.header['UUID'] = str(uuid.uuid1())
+        # Headers of last image
+        hdu.header['TSUTC2'] = last_header['TSUTC2']
+        if errors:
+            varhdu = fits.ImageHDU(data[1], name='VARIANCE')
+            num = fits.ImageHDU(data[2], name='MAP')
+            result = fits.HDUList([hdu, varhdu, num])
+        else:
+            result = fits.HDUList([hdu])
+    finally:
+        _logger.debug('removing temporary stack in %s', workdir)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    return result
+
+
 def resize_hdul(hdul, newshape, region, extensions=None, window=None,
                     scale=1, fill=0.0, conserve=True):
     from numina.frame import resize_hdu
@@ -169,18 +278,18 @@ def resize_hdulists(hdulists, shape, offsetsp, finalshape, window=None):
 
 def basic_processing_with_segmentation(rinput, flow,
                                           method=combine.mean,
-                                          errors=True, bpm=None):
+                                          errors=True, bpm=None,
+                                          nthreads=1):
 
     odata = []
     cdata = []
     datamodel = EmirDataModel()
     try:
         _logger.info('processing input images')
-        for frame in rinput.obresult.images:
-            hdulist = frame.open()
+        calibrated = imap_flow(rinput.obresult.images, flow, nthreads)
+        for hdulist, final in calibrated:
             fname = datamodel.get_imgid(hdulist)
             _logger.info('input is %s', fname)
-            final = flow(hdulist)
             _logger.debug('output is input: %s', final is hdulist)
 
             cdata.append(final)
@@ -208,11 +317,13 @@ def basic_processing_with_segmentation(rinput, flow,
         _logger.debug("offsetsp %s", offsetsp)
 
         _logger.info('Shape of resized array is %s', finalshape)
-        # Resizing target frames
-        rhduls, regions = resize_hdulists(cdata, subpixshape, offsetsp, finalshape)
+        # Target frames placed in the canvas, without copies
+        views = [OffsetView(d[0].data, offset, finalshape)
+                 for d, offset in zip(cdata, offsetsp)]
+        regions = [view.region for view in views]
 
         _logger.info("stacking %d images, with offsets using '%s'", len(cdata), method.__name__)
-        data1 = method([d[0].data for d in rhduls], dtype='float32')
+        data1 = combine_shifted(views, finalshape, method=method)
 
         segmap = segmentation_combined(data1[0])
         # submasks
@@ -27,6 +27,7 @@ import logging
 import numpy
 import numpy.linalg
 import scipy.signal
+import scipy.fftpack
 import numina.array.imsurfit as imsurfit
 import numina.array.utils as utils
 import numina.array.stats as s
@@ -86,24 +87,95 @@ def offsets_from_crosscor(arrs, region, refine=True, refine_box=3, order='ij'):
 
 
 def offsets_from_crosscor_regions(arrs, regions, refine=True, refine_box=3, order='ij', tol=0.5):
-    # import astropy.io.fits as fits
     # allowed values for order
     if order not in ['xy', 'ij']:
         raise ValueError("'order' must be either 'ij' or 'xy'")
 
-    result = numpy.zeros((len(arrs), 2))
-    ref_array = arrs[0]
+    return offsets_from_crosscor_regions_batch(
+        arrs, regions,
+        refine=refine,
+        refine_box=refine_box,
+        order=order,
+        tol=tol
+    )
+
+
+def standarize_cutouts(arrs, region, level=4):
+    """Filter and standarize the cutouts of region in all the arrays.
+
+    Equivalent to calling filter_region and standarize on each
+    cutout, returns an array of shape (len(arrs),) + cutout shape.
+    """
+    cutouts = numpy.array([arr[region] for arr in arrs], dtype='float64')
+    flat = cutouts.reshape(len(cutouts), -1)
+    median = numpy.median(flat, axis=1)
+    # same as numina.array.stats.robust_std
+    q25, q75 = numpy.percentile(flat, [25, 75], axis=1)
+    std = 0.7413 * (q75 - q25)
+    thresh = median + level * std
+    cutouts = numpy.where(cutouts >= thresh[:, None, None], cutouts, 0.0)
+    m = cutouts.mean(axis=(1, 2), keepdims=True)
+    s = cutouts.std(axis=(1, 2), keepdims=True)
+    return (cutouts - m) / s
+
+
+def crosscor_batch(ref, arrs):
+    """Cross-correlation of ref with a stack of arrays, using rfft2.
+
+    The spectrum of ref is computed only once. The result is equivalent
+    to calling fftconvolve(ref, arr[::-1, ::-1], mode='same') for each
+    array in the stack.
+    """
+    shape = numpy.asarray(ref.shape)
+    fullshape = 2 * shape - 1
+    fshape = [scipy.fftpack.next_fast_len(int(d)) for d in fullshape]
+    fref = numpy.fft.rfft2(ref, fshape)
+    farrs = numpy.fft.rfft2(arrs[:, ::-1, ::-1], fshape, axes=(1, 2))
+    farrs *= fref
+    full = numpy.fft.irfft2(farrs, fshape, axes=(1, 2))
+    # Center region, as in mode='same'
+    start = (fullshape - shape) // 2
+    end = start + shape
+    return full[:, start[0]:end[0], start[1]:end[1]]
+
+
+def offsets_from_crosscor_regions_batch(arrs, regions, refine=True,
+                                        refine_box=3, order='ij', tol=0.5,
+                                        chunk=16):
+    """Offsets between arrays, from cross-correlation in several regions.
+
+    For each region, the reference cutout is filtered and transformed
+    once, and the cutouts of the rest of arrays are correlated with it
+    in batches of *chunk* arrays.
+    """
+    if order not in ['xy', 'ij']:
+        raise ValueError("'order' must be either 'ij' or 'xy'")
 
-    for idx, arr in enumerate(arrs[1:], 1):
+    nimages = len(arrs)
+    result = numpy.zeros((nimages, 2))
+    values = [[] for _ in range(nimages)]
+    shape = arrs[0].shape
 
-        refoff = offset_from_crosscor_regions(
-            ref_array, arr, regions,
-            refine=refine,
-            refine_box=refine_box,
-            order=order,
-            tol=tol
-        )
-        result[idx] = refoff
+    for region in regions:
+        d1 = standarize_cutouts(arrs[:1], region)[0]
+        dcenter = numpy.asarray(d1.shape) // 2
+        for first in range(1, nimages, chunk):
+            last = min(first + chunk, nimages)
+            d2 = standarize_cutouts(arrs[first:last], region)
+            corrs = crosscor_batch(d1, d2)
+            for idx, corr in enumerate(corrs, first):
+                try:
+                    res = offset_from_corr(corr, dcenter, shape,
+                                           refine=refine,
+                                           refine_box=refine_box,
+                                           order=order)
+                    values[idx].append(res)
+                except ValueError as error:
+                    _logger.debug('error in region %s of image %d, %s',
+                                  region, idx, error)
+
+    for idx in range(1, nimages):
+        result[idx] = combine_region_offsets(values[idx], tol)
 
     return result
 
@@ -129,6 +201,14 @@ def offset_from_crosscor(arr0, arr1, region, refine=True, refine_box=3, order='i
     #corr = scipy.signal.correlate2d(d1, d2, mode='same', boundary='fill', fillvalue=fillvalue)
     # correlation is equivalent to convolution with inverted image
     corr = scipy.signal.fftconvolve(d1, d2[::-1, ::-1], mode='same')
+
+    return offset_from_corr(corr, dcenter, shape,
+                            refine=refine, refine_box=refine_box,
+                            order=order)
+
+
+def offset_from_corr(corr, dcenter, shape, refine=True, refine_box=3, order='ij'):
+    """Offset from the peak of a cross-correlation array."""
     # normalize
     corr /= corr.max()
     # fits.writeto('corr_%d.fits' % idx, corr, clobber=True)
@@ -197,6 +277,11 @@ def offset_from_crosscor_regions(arr0, arr1, regions, refine=True, refine_box=3,
         except ValueError as error:
             print('error in offset_from_crosscor_regions', error)
 
+    return combine_region_offsets(values, tol)
+
+
+def combine_region_offsets(values, tol=0.5):
+    """Mean of the offsets measured in regions, rejecting outliers."""
     if len(values) == 0:
         raise ValueError('No measurements to compute offset in any region')
     values = numpy.array(values)
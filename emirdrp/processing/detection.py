@@ -0,0 +1,384 @@
+#
+# Copyright 2017 Universidad Complutense de Madrid
+#
+# This file is part of PyEmir
+#
+# PyEmir is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyEmir is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyEmir.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Detection of sources in images.
+
+Detectors return catalogs as structured arrays, with columns
+named as the SExtractor parameters, and segmentation maps.
+The 'sep' detector works in memory, the 'sextractor' detector
+runs the external SExtractor program.
+"""
+
+from __future__ import division
+
+import os
+import shutil
+import hashlib
+import logging
+import tempfile
+
+import six
+import numpy
+from astropy.io import fits
+
+from emirdrp.util.sexcatalog import BLENDED, TRUNCATED, CORRUPTED_APER
+
+
+_logger = logging.getLogger('numina.recipes.emir')
+
+# Columns of the catalogs, coordinates follow the SExtractor
+# convention, the center of the first pixel is (1, 1)
+CATALOG_DTYPE = [
+    ('NUMBER', 'int32'),
+    ('X_IMAGE', 'float64'),
+    ('Y_IMAGE', 'float64'),
+    ('A_IMAGE', 'float64'),
+    ('B_IMAGE', 'float64'),
+    ('THETA_IMAGE', 'float64'),
+    ('KRON_RADIUS', 'float64'),
+    ('FLUX_BEST', 'float64'),
+    ('FLUXERR_BEST', 'float64'),
+    ('FWHM_IMAGE', 'float64'),
+    ('FLAGS', 'int32'),
+]
+
+# Default SExtractor filter
+DEFAULT_FILTER = numpy.array([[1.0, 2.0, 1.0],
+                              [2.0, 4.0, 2.0],
+                              [1.0, 2.0, 1.0]])
+
+
+def catalog_from_table(table):
+    """Create a catalog from a structured array of SExtractor parameters."""
+    catalog = numpy.zeros(len(table), dtype=CATALOG_DTYPE)
+    for key in catalog.dtype.names:
+        if key in table.dtype.names:
+            catalog[key] = table[key]
+    return catalog
+
+
+def _native(data, dtype=None):
+    """Contiguous array in native byte order."""
+    data = numpy.asarray(data, dtype=dtype)
+    return numpy.ascontiguousarray(
+        data, dtype=data.dtype.newbyteorder('='))
+
+
+class SepDetector(object):
+    """Detection of sources in memory, using sep.
+
+    The parameters follow those of SExtractor.
+    """
+
+    name = 'sep'
+
+    def __init__(self, thresh=1.5, minarea=5, deblend_nthresh=32,
+                 deblend_cont=0.005, back_size=64, back_filtersize=3,
+                 kron_fact=2.5, min_radius=3.5, filter_kernel=DEFAULT_FILTER):
+        import sep
+
+        self.sep = sep
+        self.thresh = thresh
+        self.minarea = minarea
+        self.deblend_nthresh = deblend_nthresh
+        self.deblend_cont = deblend_cont
+        self.back_size = back_size
+        self.back_filtersize = back_filtersize
+        self.kron_fact = kron_fact
+        self.min_radius = min_radius
+        self.filter_kernel = filter_kernel
+
+    def _prepare(self, data, weight):
+        data = _native(data, dtype='float64')
+        if weight is None:
+            mask = None
+        else:
+            mask = numpy.asarray(weight) <= 0
+        bkg = self.sep.Background(data, mask=mask,
+                                  bw=self.back_size, bh=self.back_size,
+                                  fw=self.back_filtersize,
+                                  fh=self.back_filtersize)
+        data_s = data - bkg.back()
+        return data_s, mask, bkg.globalrms
+
+    def _photometry(self, data_s, mask, rms, catalog):
+        x = catalog['X_IMAGE'] - 1
+        y = catalog['Y_IMAGE'] - 1
+        a = catalog['A_IMAGE']
+        b = catalog['B_IMAGE']
+        theta = numpy.radians(catalog['THETA_IMAGE'])
+
+        flux = numpy.zeros(len(catalog))
+        fluxerr = numpy.zeros(len(catalog))
+        aflag = numpy.zeros(len(catalog), dtype='int')
+
+        # Kron aperture, circular if it is too small
+        rkron = self.kron_fact * catalog['KRON_RADIUS']
+        circ = rkron * numpy.sqrt(a * b) < self.min_radius
+        ell = ~circ
+        if ell.any():
+            res = self.sep.sum_ellipse(data_s, x[ell], y[ell], a[ell],
+                                       b[ell], theta[ell], rkron[ell],
+                                       err=rms, mask=mask, subpix=1)
+            flux[ell], fluxerr[ell], aflag[ell] = res
+        if circ.any():
+            res = self.sep.sum_circle(data_s, x[circ], y[circ],
+                                      self.min_radius,
+                                      err=rms, mask=mask, subpix=1)
+            flux[circ], fluxerr[circ], aflag[circ] = res
+
+        catalog['FLUX_BEST'] = flux
+        catalog['FLUXERR_BEST'] = fluxerr
+        bad = aflag & (self.sep.APER_TRUNC | self.sep.APER_HASMASKED)
+        catalog['FLAGS'] |= numpy.where(bad, CORRUPTED_APER, 0)
+
+    def detect(self, data, weight=None, seeing_fwhm=None,
+               segmentation=False):
+        """Detect sources in data.
+
+        Pixels with *weight* <= 0 are ignored. Returns the catalog
+        and the segmentation map, or None if *segmentation* is False.
+        *seeing_fwhm* is not used.
+        """
+        sep = self.sep
+        data_s, mask, rms = self._prepare(data, weight)
+
+        _logger.debug('background rms is %f', rms)
+        res = sep.extract(data_s, self.thresh, err=rms, mask=mask,
+                          minarea=self.minarea,
+                          filter_kernel=self.filter_kernel,
+                          deblend_nthresh=self.deblend_nthresh,
+                          deblend_cont=self.deblend_cont,
+                          segmentation_map=segmentation)
+        if segmentation:
+            objects, segmap = res
+        else:
+            objects, segmap = res, None
+
+        _logger.info('detected %d objects', len(objects))
+
+        catalog = numpy.zeros(len(objects), dtype=CATALOG_DTYPE)
+        if len(objects) == 0:
+            return catalog, segmap
+
+        catalog['NUMBER'] = numpy.arange(1, len(objects) + 1)
+        catalog['X_IMAGE'] = objects['x'] + 1
+        catalog['Y_IMAGE'] = objects['y'] + 1
+        catalog['A_IMAGE'] = objects['a']
+        catalog['B_IMAGE'] = objects['b']
+        catalog['THETA_IMAGE'] = numpy.degrees(objects['theta'])
+
+        oflag = objects['flag']
+        catalog['FLAGS'] = (numpy.where(oflag & sep.OBJ_MERGED, BLENDED, 0) |
+                            numpy.where(oflag & sep.OBJ_TRUNC, TRUNCATED, 0))
+
+        kronrad, _ = sep.kron_radius(data_s, objects['x'], objects['y'],
+                                     objects['a'], objects['b'],
+                                     objects['theta'], 6.0, mask=mask)
+        catalog['KRON_RADIUS'] = kronrad
+        self._photometry(data_s, mask, rms, catalog)
+
+        rhalf, _ = sep.flux_radius(data_s, objects['x'], objects['y'],
+                                   6.0 * objects['a'], 0.5,
+                                   normflux=catalog['FLUX_BEST'],
+                                   mask=mask, subpix=5)
+        catalog['FWHM_IMAGE'] = 2 * rhalf
+
+        return catalog, segmap
+
+    def measure(self, data, catalog, detection=None, weight=None):
+        """Measure the flux in data of the sources in catalog.
+
+        The apertures of the catalog are used, *detection* is
+        not needed.
+        """
+        data_s, mask, rms = self._prepare(data, weight)
+        result = catalog.copy()
+        result['FLAGS'] &= ~CORRUPTED_APER
+        self._photometry(data_s, mask, rms, result)
+        return result
+
+    def measure_many(self, datas, catalog, detection=None, weight=None):
+        """Measure the flux of the sources in catalog in each of datas."""
+        return [self.measure(data, catalog, detection=detection,
+                             weight=weight) for data in datas]
+
+
+class SExtractorDetector(object):
+    """Detection of sources with the external SExtractor program.
+
+    The runs share a SExtractorSession, the images are written
+    in a temporary directory. The session runs *nworkers* instances
+    of SExtractor concurrently, by default one per CPU.
+    """
+
+    name = 'sextractor'
+
+    parameters = ['NUMBER', 'X_IMAGE', 'Y_IMAGE', 'A_IMAGE', 'B_IMAGE',
+                  'THETA_IMAGE', 'KRON_RADIUS', 'FLUX_BEST', 'FLUXERR_BEST',
+                  'FWHM_IMAGE', 'FLAGS']
+
+    def __init__(self, session=None, nworkers=None, **config):
+        self.session = session
+        self.nworkers = nworkers
+        self.config = config
+
+    def _session(self):
+        from emirdrp.util.sextractor import get_session
+
+        if self.session is None:
+            self.session = get_session(nworkers=self.nworkers)
+        return self.session
+
+    def _create(self, session, weight, seeing_fwhm):
+        from emirdrp.util.sextractor import SExtractor
+
+        config = SExtractor().config
+        config['VERBOSE_TYPE'] = 'QUIET'
+        config['PIXEL_SCALE'] = 1
+        config['BACK_TYPE'] = 'AUTO'
+        config.update(self.config)
+        if seeing_fwhm is not None and seeing_fwhm > 0:
+            config['SEEING_FWHM'] = seeing_fwhm * config['PIXEL_SCALE']
+        config['PARAMETERS_LIST'] = list(self.parameters)
+        if weight is not None:
+            config['WEIGHT_TYPE'] = 'MAP_WEIGHT'
+            config['WEIGHT_IMAGE'] = self._weight_file(session, weight)
+        return config
+
+    def _weight_file(self, session, weight):
+        """The weight map, in a file of the session named by its hash.
+
+        The configuration files of runs with the same weight map
+        are then the same, and reused by the session.
+        """
+        weight = numpy.ascontiguousarray(weight, dtype='float32')
+        digest = hashlib.sha1(weight.tobytes())
+        digest.update(str(weight.shape).encode('ascii'))
+
+        def write(filename):
+            fits.writeto(filename, weight)
+
+        return session.store('weight-' + digest.hexdigest(), '.fits', write)
+
+    def _write(self, tmpdir, name, data):
+        filename = os.path.join(tmpdir, name)
+        fits.writeto(filename, numpy.asarray(data, dtype='float32'))
+        return filename
+
+    def detect(self, data, weight=None, seeing_fwhm=None,
+               segmentation=False):
+        """Detect sources in data.
+
+        Pixels with *weight* <= 0 are ignored. Returns the catalog
+        and the segmentation map, or None if *segmentation* is False.
+        """
+        session = self._session()
+        tmpdir = tempfile.mkdtemp(prefix='emir-sex-')
+        try:
+            config = self._create(session, weight, seeing_fwhm)
+            if segmentation:
+                config['CHECKIMAGE_TYPE'] = 'SEGMENTATION'
+            filename = self._write(tmpdir, 'image.fits', data)
+            _logger.info('Runing sextractor')
+            job = session.run(config, filename)
+            try:
+                catalog = catalog_from_table(job.table())
+                if segmentation:
+                    segmap = fits.getdata(job.checkimage_name)
+                else:
+                    segmap = None
+            finally:
+                job.clean()
+        finally:
+            shutil.rmtree(tmpdir)
+        return catalog, segmap
+
+    def measure(self, data, catalog, detection=None, weight=None):
+        """Measure the flux in data of the sources in catalog.
+
+        SExtractor is run in double image mode, with *detection*
+        as detection image.
+        """
+        return self.measure_many([data], catalog, detection=detection,
+                                 weight=weight)[0]
+
+    def measure_many(self, datas, catalog, detection=None, weight=None):
+        """Measure the flux of the sources in catalog in each of datas.
+
+        The runs are executed concurrently by the session.
+        """
+        if detection is None:
+            raise ValueError('sextractor requires the detection image')
+        session = self._session()
+        tmpdir = tempfile.mkdtemp(prefix='emir-sex-')
+        try:
+            config = self._create(session, weight, None)
+            dname = self._write(tmpdir, 'detection.fits', detection)
+            files = []
+            for idx, data in enumerate(datas):
+                filename = self._write(tmpdir, 'image-%d.fits' % idx, data)
+                files.append('%s,%s' % (dname, filename))
+            _logger.info('Runing sextractor in double image mode, %d images',
+                         len(files))
+            jobs = session.map(config, files)
+            try:
+                tables = [catalog_from_table(job.table()) for job in jobs]
+            finally:
+                for job in jobs:
+                    job.clean()
+            result = []
+            for measured in tables:
+                bynumber = dict((num, idx) for idx, num in
+                                enumerate(measured['NUMBER']))
+                result.append(
+                    measured[[bynumber[num] for num in catalog['NUMBER']]])
+        finally:
+            shutil.rmtree(tmpdir)
+        return result
+
+
+_detectors = {
+    SepDetector.name: SepDetector,
+    SExtractorDetector.name: SExtractorDetector
+}
+
+
+def default_detector():
+    """Name of the default detector, 'sep' if it is installed."""
+    try:
+        import sep
+        return SepDetector.name
+    except ImportError:
+        return SExtractorDetector.name
+
+
+def get_detector(backend=None, **kwds):
+    """Return a detector.
+
+    *backend* is the name of a detector, a detector or None,
+    to use the default.
+    """
+    if backend is None:
+        backend = default_detector()
+    if isinstance(backend, six.string_types):
+        if backend not in _detectors:
+            raise ValueError('detector %r not recognized' % backend)
+        return _detectors[backend](**kwds)
+    return backend
@@ -0,0 +1,127 @@
+#
+# Copyright 2017 Universidad Complutense de Madrid
+#
+# This file is part of PyEmir
+#
+# PyEmir is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyEmir is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyEmir.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Corrector to resample frames onto the virtual pixel grid"""
+
+from __future__ import division
+
+import datetime
+import logging
+import threading
+
+import numpy
+from numina.flow.processing import Corrector
+
+from emirdrp.instrument.distortions import EMIR_DISTORTION
+from .resample import RemapTable
+
+_logger = logging.getLogger('numina.recipes.emir')
+
+
+class DistortionCorrector(Corrector):
+    """A Node that corrects the optical distortion of a frame.
+
+    The frame is resampled onto the grid of virtual pixels, with
+    linear interpolation. The positions in the real image of the
+    virtual pixels are computed once for each shape of frame,
+    and cached in *cachedir* if given. Pixels of the virtual grid
+    outside the real image have the value fill.
+
+    The VARIANCE extension is interpolated as the data, an upper
+    bound of the propagated variance. MAP takes the minimum of the
+    neighbours, and MASK and BPM the maximum, so that a virtual pixel
+    touched by a masked pixel is masked; pixels outside the real image
+    are masked. Frames with other image extensions are refused.
+    """
+
+    extensions = ['VARIANCE', 'MAP', 'MASK', 'BPM']
+
+    def __init__(self, distortion=None, cachedir=None, fill=0.0,
+                 nthreads=1, band=128, datamodel=None, dtype='float32'):
+
+        super(DistortionCorrector, self).__init__(
+            datamodel=datamodel,
+            calibid='distortion',
+            dtype=dtype)
+
+        if distortion is None:
+            distortion = EMIR_DISTORTION
+        self.distortion = distortion
+        self.cachedir = cachedir
+        self.fill = fill
+        self.nthreads = nthreads
+        self.band = band
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def table(self, shape):
+        """Interpolation table for frames of this shape."""
+        shape = tuple(shape)
+        with self._lock:
+            table = self._tables.get(shape)
+            if table is None:
+                _logger.debug('computing distortion table for shape %s',
+                              shape)
+                grid = self.distortion.remap_grid(shape,
+                                                  cachedir=self.cachedir)
+                table = RemapTable(grid, shape)
+                self._tables[shape] = table
+        return table
+
+    def _check_extensions(self, img):
+        for hdu in img[1:]:
+            if hdu.is_image and hdu.data is not None and \
+                    hdu.name not in self.extensions:
+                raise ValueError('cannot correct distortion of extension '
+                                 '%s' % hdu.name)
+
+    def run(self, img):
+        imgid = self.get_imgid(img)
+        _logger.debug('correcting distortion in %s', imgid)
+        self._check_extensions(img)
+
+        data = self.datamodel.get_data(img)
+        table = self.table(data.shape)
+        result = table(data, fill=self.fill, dtype=self.dtype,
+                       nthreads=self.nthreads, band=self.band)
+        nout = int(table.outside.sum())
+        if nout > 0:
+            _logger.debug('%d pixels outside the real image', nout)
+
+        for name in self.extensions:
+            if name not in img:
+                continue
+            hdu = img[name]
+            _logger.debug('correcting distortion in extension %s', name)
+            if name == 'VARIANCE':
+                hdu.data = table(hdu.data, fill=0.0, dtype=self.dtype,
+                                 nthreads=self.nthreads, band=self.band)
+            elif name == 'MAP':
+                hdu.data = table.reduce(hdu.data, numpy.minimum, fill=0)
+            else:
+                hdu.data = table.reduce(hdu.data, numpy.maximum, fill=1)
+
+        img['primary'].data = result
+        hdr = img['primary'].header
+        hdr['DISTCORR'] = (True, 'Resampled to virtual pixels')
+        hdr['history'] = 'Distortion correction, center {}'.format(
+            self.distortion.center)
+        hdr['history'] = 'Distortion correction time {}'.format(
+            datetime.datetime.utcnow().isoformat())
+        return img
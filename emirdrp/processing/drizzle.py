@@ -0,0 +1,145 @@
+#
+# Copyright 2017 Universidad Complutense de Madrid
+#
+# This file is part of PyEmir
+#
+# PyEmir is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyEmir is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyEmir.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Combination of shifted frames in a subsampled grid, by drizzling"""
+
+from __future__ import division
+
+import math
+import logging
+
+import numpy
+
+_logger = logging.getLogger('numina.recipes.emir')
+
+
+def axis_overlaps(n, start, scale, size, pixfrac=1.0):
+    """Output pixels covered by a row of input pixels, along one axis.
+
+    The input pixel i covers [start + i, start + i + 1) in input
+    pixel units, its drop is reduced by pixfrac around the
+    center and projected in a grid subsampled by scale, with size
+    pixels. Returns the indices of the output pixels, with
+    shape (n, k), and the length of the overlaps, in output pixels.
+    Overlaps outside the output grid are zero.
+    """
+    center = (start + numpy.arange(n) + 0.5) * scale
+    half = 0.5 * pixfrac * scale
+    lower = center - half
+    upper = center + half
+    k = int(math.ceil(pixfrac * scale)) + 1
+    idx = numpy.floor(lower).astype('int')[:, numpy.newaxis] + numpy.arange(k)
+    overlap = (numpy.minimum(upper[:, numpy.newaxis], idx + 1) -
+               numpy.maximum(lower[:, numpy.newaxis], idx))
+    valid = (overlap > 0) & (idx >= 0) & (idx < size)
+    overlap = numpy.where(valid, overlap, 0.0)
+    idx = numpy.clip(idx, 0, size - 1)
+    return idx, overlap
+
+
+class Drizzle(object):
+    """Accumulate shifted frames in a subsampled grid.
+
+    Each input pixel is projected in the output grid, with a
+    weight proportional to its area of overlap with each output
+    pixel. Frames are accumulated by blocks of *tile* rows, without
+    building subsampled copies of the frames.
+    """
+    def __init__(self, shape, scale, pixfrac=1.0, tile=16):
+        self.shape = tuple(shape)
+        self.scale = scale
+        self.pixfrac = pixfrac
+        self.tile = tile
+        self.total = numpy.zeros(self.shape)
+        self.total2 = numpy.zeros(self.shape)
+        self.weight = numpy.zeros(self.shape)
+
+    def add(self, data, offset, mask=None, weight=1.0):
+        """Add a frame, with its pixel [0, 0] at offset.
+
+        offset is in input pixel units, and can be fractional.
+        Pixels where mask is not 0 are ignored.
+        """
+        nrows, ncols = data.shape
+        orows, ocols = self.shape
+        xidx, xover = axis_overlaps(ncols, offset[1], self.scale, ocols,
+                                    pixfrac=self.pixfrac)
+
+        for r0 in range(0, nrows, self.tile):
+            r1 = min(r0 + self.tile, nrows)
+            yidx, yover = axis_overlaps(r1 - r0, offset[0] + r0, self.scale,
+                                        orows, pixfrac=self.pixfrac)
+            covered = yover > 0
+            if not covered.any():
+                continue
+            ylo = yidx[covered].min()
+            yhi = yidx[covered].max() + 1
+            yidx = numpy.where(covered, yidx, ylo)
+
+            values = numpy.asarray(data[r0:r1], dtype='float64')
+            wvalues = numpy.empty_like(values)
+            wvalues.fill(weight)
+            if mask is not None:
+                wvalues[numpy.asarray(mask[r0:r1]) != 0] = 0.0
+            wvalues[~numpy.isfinite(values)] = 0.0
+            values = numpy.where(wvalues > 0, values, 0.0)
+
+            # (rows, ky, cols, kx)
+            area = (yover[:, :, numpy.newaxis, numpy.newaxis] *
+                    xover[numpy.newaxis, numpy.newaxis, :, :])
+            area *= wvalues[:, numpy.newaxis, :, numpy.newaxis]
+            flat = ((yidx - ylo)[:, :, numpy.newaxis, numpy.newaxis] * ocols +
+                    xidx[numpy.newaxis, numpy.newaxis, :, :])
+            flat = flat.ravel()
+            bshape = (yhi - ylo, ocols)
+            size = bshape[0] * bshape[1]
+
+            wv = area * values[:, numpy.newaxis, :, numpy.newaxis]
+            self.weight[ylo:yhi] += numpy.bincount(
+                flat, area.ravel(), minlength=size).reshape(bshape)
+            self.total[ylo:yhi] += numpy.bincount(
+                flat, wv.ravel(), minlength=size).reshape(bshape)
+            wv *= values[:, numpy.newaxis, :, numpy.newaxis]
+            self.total2[ylo:yhi] += numpy.bincount(
+                flat, wv.ravel(), minlength=size).reshape(bshape)
+
+            del area, flat, wv
+        _logger.debug('drizzled frame of shape %s, in %d row blocks',
+                      data.shape, (nrows + self.tile - 1) // self.tile)
+
+    def result(self, dtype='float32', conserve=True):
+        """Weighted mean, variance and weight of each output pixel.
+
+        The variance is the weighted variance of the values of the
+        pixel. With conserve, the values are divided by scale**2,
+        so that the sum of the values is conserved.
+        """
+        out = numpy.zeros((3,) + self.shape, dtype=dtype)
+        valid = self.weight > 0
+        mean = self.total[valid] / self.weight[valid]
+        var = self.total2[valid] / self.weight[valid] - mean * mean
+        var = numpy.clip(var, 0, None)
+        if conserve:
+            area = self.scale ** 2
+            mean /= area
+            var /= area * area
+        out[0][valid] = mean
+        out[1][valid] = var
+        out[2] = self.weight
+        return out
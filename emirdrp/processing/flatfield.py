@@ -31,9 +31,16 @@ _logger = logging.getLogger('numina.recipes.emir')
 
 
 class FlatFieldCorrector(Corrector):
-    """A Node that corrects a frame from flat-field."""
+    """A Node that corrects a frame from flat-field.
 
-    def __init__(self, flatdata, datamodel=None, calibid='calibid-unknown', dtype='float32'):
+    The reciprocal of the flat is computed once. The result is written
+    in a new array of type *dtype*. With *inplace*, the image is
+    corrected in place instead if its data has type *dtype* and is
+    writeable.
+    """
+
+    def __init__(self, flatdata, datamodel=None, calibid='calibid-unknown',
+                 dtype='float32', inplace=False):
 
         self.update_variance = False
 
@@ -42,9 +49,19 @@ class FlatFieldCorrector(Corrector):
             calibid=calibid,
             dtype=dtype)
 
+        mask = flatdata <= 0
+        self.flat_nfixed = int(mask.sum())
+        if self.flat_nfixed > 0:
+            _logger.warning('flat has %d values <= 0, replaced by 1',
+                            self.flat_nfixed)
+            if not flatdata.flags.writeable:
+                flatdata = flatdata.copy()
+            flatdata[mask] = 1.0 # To avoid NaN
         self.flatdata = flatdata
-        self.flatdata[flatdata <= 0] = 1.0 # To avoid NaN
         self.flat_stats = flatdata.mean()
+        self.inplace = inplace
+        self.rflatdata = numpy.divide(1.0, flatdata, dtype=self.dtype)
+        self.rflatdata.flags.writeable = False
 
     def run(self, img):
         import datetime
@@ -55,16 +72,13 @@ class FlatFieldCorrector(Corrector):
 
         data = self.datamodel.get_data(img)
         # data = array.correct_flatfield(data, self.flatdata, dtype=self.dtype)
-        # Check if flatdata as 0
-        mask1 = self.flatdata < 0
-        if numpy.any(mask1):
-            _logger.warning('flat has %d zeros', mask1.sum())
-        mask2 = ~numpy.isfinite(data)
-        if numpy.any(mask2):
-            _logger.warning('image has %d NaN', mask2.sum())
+        # min and max are NaN or inf if there are non-finite values,
+        # the values are only counted in that case
+        if not (numpy.isfinite(data.min()) and numpy.isfinite(data.max())):
+            _logger.warning('image has %d NaN',
+                            data.size - numpy.isfinite(data).sum())
 
-        result = data / self.flatdata
-        result = result.astype(self.dtype)
+        result = self.correct(data)
 
         # FIXME: not using datamodel
         img['primary'].data = result
@@ -74,3 +88,19 @@ class FlatFieldCorrector(Corrector):
         hdr['history'] = 'Flat-field correction time {}'.format(datetime.datetime.utcnow().isoformat())
         hdr['history'] = 'Flat-field correction mean {}'.format(self.flat_stats)
         return img
+
+    def correct(self, data, out=None):
+        """Divide data by the flat, writing in out.
+
+        If out is None, data is used if inplace and possible,
+        or a new array is created.
+        """
+        if out is None:
+            native = data.dtype.newbyteorder('=')
+            if (self.inplace and native == self.rflatdata.dtype and
+                    data.flags.writeable):
+                out = data
+            else:
+                out = numpy.empty(data.shape, dtype=self.dtype)
+        numpy.multiply(data, self.rflatdata, out=out, casting='unsafe')
+        return out
@@ -0,0 +1,155 @@
+#
+# Copyright 2017 Universidad Complutense de Madrid
+#
+# This file is part of PyEmir
+#
+# PyEmir is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyEmir is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyEmir.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Fast reading of FITS headers, without reading the data"""
+
+import collections
+import gzip
+import logging
+import os
+import threading
+
+from astropy.io import fits
+
+
+_logger = logging.getLogger(__name__)
+
+BLOCK_SIZE = 2880
+CARD_SIZE = 80
+END_CARD = b'END' + b' ' * (CARD_SIZE - 3)
+GZIP_MAGIC = b'\x1f\x8b'
+
+# Maximum number of files in the cache
+MAX_ENTRIES = 4096
+
+
+def _read_header_string(fd):
+    blocks = []
+    while True:
+        block = fd.read(BLOCK_SIZE)
+        if len(block) < BLOCK_SIZE:
+            if blocks:
+                raise IOError('truncated FITS header')
+            # End of file, ignoring trailing bytes
+            return None
+        blocks.append(block)
+        for start in range(0, BLOCK_SIZE, CARD_SIZE):
+            if block[start:start + CARD_SIZE] == END_CARD:
+                return b''.join(blocks)
+
+
+def _data_size(hdr):
+    naxis = hdr.get('NAXIS', 0)
+    if naxis == 0:
+        return 0
+    size = 1
+    for idx in range(1, naxis + 1):
+        size *= hdr['NAXIS%d' % idx]
+    bitpix = abs(hdr['BITPIX'])
+    size = bitpix // 8 * hdr.get('GCOUNT', 1) * (hdr.get('PCOUNT', 0) + size)
+    # Data is padded to a full block
+    return ((size + BLOCK_SIZE - 1) // BLOCK_SIZE) * BLOCK_SIZE
+
+
+def _open_fits(filename):
+    """Open a FITS file for reading, gzip compressed or not."""
+    with open(filename, 'rb') as fd:
+        magic = fd.read(len(GZIP_MAGIC))
+    if magic == GZIP_MAGIC:
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb')
+
+
+def scan_headers(filename):
+    """Read the headers of all the HDUs in a FITS file.
+
+    Only the header blocks are read, the data blocks are skipped.
+    Compressed files (gzip) are decompressed while reading.
+    """
+    headers = []
+    with _open_fits(filename) as fd:
+        while True:
+            hstring = _read_header_string(fd)
+            if hstring is None:
+                break
+            hdr = fits.Header.fromstring(hstring.decode('ascii'))
+            headers.append(hdr)
+            fd.seek(_data_size(hdr), os.SEEK_CUR)
+    return headers
+
+
+class HeaderCache(object):
+    """Cache of FITS headers, by file path and modification time."""
+    def __init__(self, maxentries=MAX_ENTRIES):
+        self.maxentries = maxentries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def headers(self, filename):
+        """Headers of all the HDUs in filename."""
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+        stamp = (stat.st_mtime, stat.st_size)
+        with self._lock:
+            entry = self._entries.pop(path, None)
+            if entry is not None and entry[0] == stamp:
+                self._entries[path] = entry
+                return entry[1]
+
+        _logger.debug('scanning headers of %s', path)
+        headers = scan_headers(path)
+        with self._lock:
+            self._entries[path] = (stamp, headers)
+            while len(self._entries) > self.maxentries:
+                self._entries.popitem(last=False)
+        return headers
+
+
+_cache = HeaderCache()
+
+
+def get_headers(filename):
+    """Headers of all the HDUs in a FITS file, cached.
+
+    The headers are shared between callers, they must not be modified.
+    """
+    return _cache.headers(filename)
+
+
+def get_header(filename, ext=0):
+    """Header of HDU *ext* in a FITS file, cached."""
+    return get_headers(filename)[ext]
+
+
+def dframe_headers(dframe):
+    """Headers of all the HDUs of a DataFrame.
+
+    If the DataFrame is in disk, only the headers are read.
+    """
+    hdulist = getattr(dframe, 'frame', None)
+    if hdulist is not None:
+        return [hdu.header for hdu in hdulist]
+    return get_headers(dframe.filename)
@@ -20,14 +20,18 @@
 
 from numina.core import DataFrame, ObservationResult
 
+from emirdrp.processing.headers import dframe_headers
+
 
 def gather_info_dframe(dataframe):
-    with dataframe.open() as hdulist:
-        info = gather_info_hdu(hdulist)
-    return info
+    return gather_info_headers(dframe_headers(dataframe))
 
 
 def gather_info_hdu(hdulist):
+    return gather_info_headers([hdu.header for hdu in hdulist])
+
+
+def gather_info_headers(headers):
 
     _meta = {'readmode': ('READMODE', 'undefined'),
              'texp': ('EXPTIME', None),
@@ -39,11 +43,11 @@ def gather_info_hdu(hdulist):
 
     # READMODE is STRING
     meta = {}
-    meta['n_ext'] = len(hdulist)
-    extnames = [hdu.header.get('extname', '') for hdu in hdulist[1:]]
+    meta['n_ext'] = len(headers)
+    extnames = [hdr.get('extname', '') for hdr in headers[1:]]
     meta['name_ext'] = ['PRIMARY'] + extnames
     for key, val in _meta.items():
-        meta[key] = hdulist[0].header.get(val[0], val[1])
+        meta[key] = headers[0].get(val[0], val[1])
 
     return meta
 
@@ -51,8 +55,7 @@ def gather_info_hdu(hdulist):
 def gather_info_frames(framelist):
     iinfo = []
     for frame in framelist:
-        with frame.open() as hdulist:
-            iinfo.append(gather_info_hdu(hdulist))
+        iinfo.append(gather_info_dframe(frame))
     return iinfo
 
 
@@ -0,0 +1,82 @@
+#
+# Copyright 2017 Universidad Complutense de Madrid
+#
+# This file is part of PyEmir
+#
+# PyEmir is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyEmir is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyEmir.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Concurrent application of calibration flows"""
+
+import logging
+from multiprocessing.pool import ThreadPool
+
+import numpy
+
+
+_logger = logging.getLogger(__name__)
+
+
+def freeze_flow(flow):
+    """Make read-only the calibration arrays stored in the nodes of a flow.
+
+    The arrays are shared by all the workers, no copy is made.
+    """
+    nodes = getattr(flow, 'nodeseq', None)
+    if nodes is not None:
+        for node in nodes:
+            freeze_flow(node)
+    else:
+        for value in vars(flow).values():
+            if isinstance(value, numpy.ndarray):
+                value.flags.writeable = False
+    return flow
+
+
+def imap_flow(frames, flow, nthreads=1):
+    """Open frames and apply flow to them.
+
+    Yields pairs (input, output) of HDULists, in the order of *frames*.
+    If *nthreads* is greater than 1, the frames are processed by a
+    pool of threads. The correctors do their work in NumPy, that
+    releases the GIL, and the calibration arrays are shared read-only
+    between the threads.
+    """
+
+    def process(frame):
+        hdulist = frame.open()
+        final = flow(hdulist)
+        return hdulist, final
+
+    if nthreads <= 1:
+        for frame in frames:
+            yield process(frame)
+    else:
+        _logger.debug('processing frames with %d threads', nthreads)
+        freeze_flow(flow)
+        pool = ThreadPool(nthreads)
+        try:
+            for result in pool.imap(process, frames):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+
+
+def map_flow(frames, flow, nthreads=1):
+    """Open frames and apply flow to them.
+
+    Returns a list of pairs (input, output) of HDULists.
+    """
+    return list(imap_flow(frames, flow, nthreads=nthreads))
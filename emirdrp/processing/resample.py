@@ -0,0 +1,357 @@
+#
+# Copyright 2017 Universidad Complutense de Madrid
+#
+# This file is part of PyEmir
+#
+# PyEmir is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyEmir is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyEmir.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Frames placed in a larger canvas, without copies"""
+
+from __future__ import division
+
+import logging
+from multiprocessing.pool import ThreadPool
+
+import numpy
+from numina.array import combine
+
+_logger = logging.getLogger('numina.recipes.emir')
+
+
+def _canvas_region(region, shape):
+    if region is Ellipsis:
+        region = (slice(None),) * len(shape)
+    return tuple(slice(*r.indices(n)[:2]) for r, n in zip(region, shape))
+
+
+def _intersection(region, footprint):
+    """Intersection of two regions, or None."""
+    result = []
+    for r, f in zip(region, footprint):
+        start = max(r.start, f.start)
+        stop = min(r.stop, f.stop)
+        if start >= stop:
+            return None
+        result.append(slice(start, stop))
+    return tuple(result)
+
+
+class OffsetView(object):
+    """A frame placed at an integer offset in a canvas.
+
+    Slicing returns the values in the canvas, pixels outside the
+    frame have the value fill. Regions inside the frame are views
+    of data, without copies, only regions crossing the border of
+    the frame are copied.
+    """
+    def __init__(self, data, offset, shape, mask=None, fill=0.0):
+        self.data = data
+        self.mask = mask
+        self.offset = tuple(int(o) for o in offset)
+        self.shape = tuple(shape)
+        self.fill = fill
+        # region of the canvas covered by the frame
+        self.region = tuple(slice(o, o + n)
+                            for o, n in zip(self.offset, data.shape))
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def dtype(self):
+        return self.data.dtype
+
+    def overlaps(self, region):
+        """True if the frame covers part of the region of the canvas."""
+        region = _canvas_region(region, self.shape)
+        return _intersection(region, self.region) is not None
+
+    def _local(self, region):
+        return tuple(slice(r.start - o, r.stop - o)
+                     for r, o in zip(region, self.offset))
+
+    def __getitem__(self, region):
+        return self.sample(region)[0]
+
+    def __array__(self, dtype=None):
+        values = self.sample(Ellipsis)[0]
+        if dtype is not None:
+            values = values.astype(dtype)
+        return values
+
+    def sample(self, region):
+        """Values and mask of a region of the canvas.
+
+        Pixels outside the frame are masked.
+        """
+        region = _canvas_region(region, self.shape)
+        inter = _intersection(region, self.region)
+        if inter == region:
+            # inside the frame, no copy
+            local = self._local(region)
+            if self.mask is None:
+                masked = numpy.zeros(self.data[local].shape, dtype='int16')
+            else:
+                masked = self.mask[local]
+            return self.data[local], masked
+
+        shape = tuple(r.stop - r.start for r in region)
+        values = numpy.empty(shape, dtype=self.data.dtype)
+        values.fill(self.fill)
+        masked = numpy.ones(shape, dtype='int16')
+        if inter is not None:
+            dst = tuple(slice(i.start - r.start, i.stop - r.start)
+                        for i, r in zip(inter, region))
+            local = self._local(inter)
+            values[dst] = self.data[local]
+            if self.mask is None:
+                masked[dst] = 0
+            else:
+                masked[dst] = self.mask[local] != 0
+        return values, masked
+
+
+def _axis_weights(idx, offset, size):
+    """Neighbours and weights of linear interpolation along one axis."""
+    pos = idx - offset
+    lower = numpy.floor(pos).astype('int')
+    frac = pos - lower
+    neighbours = []
+    for near, weight in [(lower, 1 - frac), (lower + 1, frac)]:
+        inside = (near >= 0) & (near < size)
+        neighbours.append((numpy.clip(near, 0, size - 1), weight, inside))
+    return neighbours
+
+
+class ShiftedFrame(object):
+    """A frame placed at offset in a canvas of the given shape.
+
+    The pixel [0, 0] of data is at offset in the canvas, offset
+    can be fractional, the frame is then linearly interpolated.
+    Slicing returns the values in the canvas, pixels outside the
+    frame have the value fill. The canvas is never built in
+    full, only the requested regions.
+    """
+    def __init__(self, data, offset, shape, mask=None, fill=0.0):
+        self.data = data
+        self.mask = mask
+        self.offset = numpy.asarray(offset, dtype='float64')
+        self.shape = tuple(shape)
+        self.fill = fill
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def overlaps(self, region):
+        """True if the frame covers part of the region of the canvas."""
+        region = _canvas_region(region, self.shape)
+        lower = numpy.floor(self.offset).astype('int')
+        upper = numpy.ceil(self.offset + self.data.shape).astype('int')
+        footprint = tuple(slice(lo, up) for lo, up in zip(lower, upper))
+        return _intersection(region, footprint) is not None
+
+    def __getitem__(self, region):
+        return self.sample(region)[0]
+
+    def __array__(self, dtype=None):
+        values = self.sample(Ellipsis)[0]
+        if dtype is not None:
+            values = values.astype(dtype)
+        return values
+
+    def sample(self, region):
+        """Values and mask of a region of the canvas.
+
+        Pixels outside the frame, or interpolated from masked
+        pixels, are masked.
+        """
+        region = _canvas_region(region, self.shape)
+        rows, cols = [numpy.arange(r.start, r.stop) for r in region]
+        ny, nx = self.data.shape
+        wrows = _axis_weights(rows, self.offset[0], ny)
+        wcols = _axis_weights(cols, self.offset[1], nx)
+
+        values = numpy.zeros((len(rows), len(cols)))
+        masked = numpy.zeros(values.shape, dtype='bool')
+        for iy, wy, iny in wrows:
+            if not numpy.any(wy > 0):
+                continue
+            for ix, wx, inx in wcols:
+                if not numpy.any(wx > 0):
+                    continue
+                weight = numpy.outer(wy, wx)
+                used = weight > 0
+                inside = numpy.outer(iny, inx)
+                masked |= used & ~inside
+                sel = numpy.ix_(iy, ix)
+                values += weight * self.data[sel]
+                if self.mask is not None:
+                    masked |= used & (self.mask[sel] != 0)
+        values[masked] = self.fill
+        return values, masked.astype('int16')
+
+
+class RemapTable(object):
+    """Linear interpolation of images at fixed positions.
+
+    *grid* has shape (2,) + outshape, with the rows and columns (0-based)
+    in the input image of each output pixel, as returned by
+    RadialDistortion.remap_grid. The neighbours and the weights along
+    each axis are computed once, and reused for every image of the
+    given *shape*. The interpolation is separable: the two rows of
+    neighbours are interpolated along x, and then the results along y.
+    """
+    def __init__(self, grid, shape):
+        self.shape = tuple(shape)
+        self.outshape = tuple(grid.shape[1:])
+        ny, nx = self.shape
+        rows = numpy.asarray(grid[0], dtype='float64')
+        cols = numpy.asarray(grid[1], dtype='float64')
+        self.outside = ((rows < 0) | (rows > ny - 1) |
+                        (cols < 0) | (cols > nx - 1))
+        iy = numpy.clip(numpy.floor(rows), 0, max(ny - 2, 0)).astype('int')
+        ix = numpy.clip(numpy.floor(cols), 0, max(nx - 2, 0)).astype('int')
+        self.fy = numpy.clip(rows - iy, 0, 1).astype('float32')
+        self.fx = numpy.clip(cols - ix, 0, 1).astype('float32')
+        # flat index of the lower neighbour
+        self.index = (iy * nx + ix).astype('int32')
+        self.stride = nx if ny > 1 else 0
+        self.step = 1 if nx > 1 else 0
+
+    def _band(self, flat, out, region, fill):
+        index = self.index[region]
+        fx = self.fx[region]
+        fy = self.fy[region]
+        lower = flat[index]
+        lower += fx * (flat[index + self.step] - lower)
+        upper = flat[index + self.stride]
+        upper += fx * (flat[index + self.stride + self.step] - upper)
+        lower += fy * (upper - lower)
+        lower[self.outside[region]] = fill
+        out[region] = lower
+
+    def __call__(self, data, out=None, fill=0.0, dtype='float32',
+                 nthreads=1, band=128):
+        """Interpolate data at the positions of the grid.
+
+        Output pixels outside data have the value fill. The output
+        is computed in bands of *band* rows, optionally by a pool of
+        *nthreads* threads.
+        """
+        if data.shape != self.shape:
+            raise ValueError('data shape %s does not match %s' %
+                             (data.shape, self.shape))
+        flat = numpy.ravel(data).astype(dtype, copy=False)
+        if out is None:
+            out = numpy.empty(self.outshape, dtype=dtype)
+
+        starts = range(0, self.outshape[0], band)
+
+        def process(r0):
+            region = slice(r0, min(r0 + band, self.outshape[0]))
+            self._band(flat, out, region, fill)
+
+        if nthreads > 1 and len(starts) > 1:
+            pool = ThreadPool(nthreads)
+            try:
+                pool.map(process, starts)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for r0 in starts:
+                process(r0)
+        return out
+
+    def reduce(self, data, ufunc=numpy.maximum, fill=0):
+        """Reduce with ufunc the neighbours of each position of the grid.
+
+        Only the neighbours with nonzero weight in the interpolation
+        are used, so that numpy.maximum of a mask marks every output
+        pixel touched by a masked pixel. Output pixels outside data
+        have the value fill. The output has the dtype of data.
+        """
+        if data.shape != self.shape:
+            raise ValueError('data shape %s does not match %s' %
+                             (data.shape, self.shape))
+        flat = numpy.ravel(data)
+        # the nearest neighbour has always nonzero weight
+        nearest = flat[self.index + self.step * (self.fx >= 0.5) +
+                       self.stride * (self.fy >= 0.5)]
+        out = nearest.copy()
+        corners = [(0, self.fy < 1, self.fx < 1),
+                   (self.step, self.fy < 1, self.fx > 0),
+                   (self.stride, self.fy > 0, self.fx < 1),
+                   (self.stride + self.step, self.fy > 0, self.fx > 0)]
+        for shift, usedy, usedx in corners:
+            values = numpy.where(usedy & usedx, flat[self.index + shift],
+                                 nearest)
+            ufunc(out, values, out=out)
+        out[self.outside] = fill
+        return out
+
+
+def combine_shifted(frames, shape, method=None, tile=128, dtype='float32',
+                    scales=None, out=None, **kwds):
+    """Combine frames in a canvas, by blocks of rows.
+
+    frames are OffsetView or ShiftedFrame objects. For each block
+    of *tile* rows of the canvas, the frames covering the block are
+    sampled and combined with method, masking the pixels outside each
+    frame. *scales* has a value for each frame. The result is written
+    in *out*, of shape (3,) + shape, if given. The memory used is
+    bounded by a block of the canvas for each frame.
+    """
+    if method is None:
+        method = combine.median
+
+    shape = tuple(shape)
+    if out is None:
+        out = numpy.zeros((3,) + shape, dtype=dtype)
+    elif out.shape != (3,) + shape:
+        raise ValueError('out has shape %s, expected %s' %
+                         (out.shape, (3,) + shape))
+    for r0 in range(0, shape[0], tile):
+        r1 = min(r0 + tile, shape[0])
+        region = (slice(r0, r1), slice(0, shape[1]))
+        used = [idx for idx, frame in enumerate(frames)
+                if frame.overlaps(region)]
+        if not used:
+            out[:, r0:r1] = 0
+            continue
+        samples = [frames[idx].sample(region) for idx in used]
+        if scales is not None:
+            kwds['scales'] = [scales[idx] for idx in used]
+        out[:, r0:r1] = method([s[0] for s in samples],
+                               masks=[s[1] for s in samples],
+                               dtype=dtype, **kwds)
+    _logger.debug('combined %d frames in blocks of %d rows',
+                  len(frames), tile)
+    return out
+
+
+def shifted_shape(shape, offsets):
+    """Canvas shape and offsets of frames with fractional offsets.
+
+    The offsets are translated so that the minimum is in [0, 1).
+    """
+    offsets = numpy.asarray(offsets, dtype='float64')
+    offsets = offsets - numpy.floor(offsets.min(axis=0))
+    upper = offsets + numpy.asarray(shape)
+    finalshape = tuple(int(side) for side in
+                       numpy.ceil(upper.max(axis=0)))
+    return finalshape, offsets
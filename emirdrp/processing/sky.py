@@ -0,0 +1,228 @@
+#
+# Copyright 2017 Universidad Complutense de Madrid
+#
+# This file is part of PyEmir
+#
+# PyEmir is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyEmir is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyEmir.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Sky background from sliding windows of sky frames"""
+
+from __future__ import division
+
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+import numpy
+
+_logger = logging.getLogger('numina.recipes.emir')
+
+
+class SkyFrameCache(object):
+    """Sky frames, loaded once and shared between target frames.
+
+    Each frame is divided by its median, computed once, and the
+    masked and non-finite pixels are stored as +inf. A frame is
+    released when all the target frames using it have been processed.
+    Different frames are loaded concurrently, a frame requested by
+    several threads is loaded by one of them.
+
+    The target frames are processed in *blocks* of consecutive frames,
+    by default a single block. In each block, a frame is used once
+    for each run of consecutive windows containing it. The cache holds
+    the windows being processed, and the frames shared by two blocks
+    until both have used them.
+    """
+    def __init__(self, load, windows, blocks=None, dtype='float32'):
+        self._load = load
+        self.dtype = dtype
+        if blocks is None:
+            blocks = [range(len(windows))]
+        self._uses = {}
+        for tids in blocks:
+            previous = []
+            for tid in tids:
+                for idx in windows[tid]:
+                    if idx not in previous:
+                        self._uses[idx] = self._uses.get(idx, 0) + 1
+                previous = windows[tid]
+        self._entries = {}
+        self._loading = {}
+        self.scales = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _normalized(self, idx):
+        data, mask = self._load(idx)
+        scale = numpy.median(data)
+        _logger.debug('sky frame %d, median %f', idx, scale)
+        values = numpy.divide(data, scale, dtype=self.dtype)
+        if mask is not None:
+            values[numpy.asarray(mask) != 0] = numpy.inf
+        values[~numpy.isfinite(values)] = numpy.inf
+        return values, scale
+
+    def get(self, idx):
+        """Normalized values of the sky frame idx."""
+        with self._lock:
+            if idx in self._entries:
+                return self._entries[idx]
+            loading = self._loading.setdefault(idx, threading.Lock())
+
+        with loading:
+            with self._lock:
+                if idx in self._entries:
+                    return self._entries[idx]
+            # the frame is loaded without holding the cache lock
+            values, scale = self._normalized(idx)
+            with self._lock:
+                self.scales[idx] = scale
+                self._entries[idx] = values
+                self._loading.pop(idx, None)
+            return values
+
+    def release(self, idx):
+        """Mark one run of windows using the sky frame idx as finished."""
+        with self._lock:
+            self._uses[idx] -= 1
+            if self._uses[idx] <= 0:
+                self._entries.pop(idx, None)
+
+
+class RunningMedian(object):
+    """Median of a changing set of images, pixel by pixel.
+
+    The values of each pixel are kept sorted, masked values are
+    +inf and are sorted after the valid values. Non-finite values
+    are stored as +inf too, NaN would break the order. Adding or
+    removing an image is linear in the number of images.
+    """
+    def __init__(self, shape, dtype='float32'):
+        self.stack = numpy.empty((0,) + tuple(shape), dtype=dtype)
+
+    def __len__(self):
+        return self.stack.shape[0]
+
+    def _sortable(self, values):
+        finite = numpy.isfinite(values)
+        if finite.all():
+            return values
+        return numpy.where(finite, values, numpy.inf)
+
+    def add(self, values):
+        values = self._sortable(values)
+        stack = self.stack
+        nimg = stack.shape[0]
+        pos = (stack < values).sum(axis=0)
+        result = numpy.empty((nimg + 1,) + values.shape, dtype=stack.dtype)
+        for k in range(nimg + 1):
+            if k == 0:
+                below = values
+            else:
+                below = numpy.where(k == pos, values, stack[k - 1])
+            if k < nimg:
+                result[k] = numpy.where(k < pos, stack[k], below)
+            else:
+                result[k] = below
+        self.stack = result
+
+    def remove(self, values):
+        values = self._sortable(values)
+        stack = self.stack
+        nimg = stack.shape[0]
+        # position of the first element equal to values
+        pos = (stack < values).sum(axis=0)
+        result = numpy.empty((nimg - 1,) + values.shape, dtype=stack.dtype)
+        for k in range(nimg - 1):
+            result[k] = numpy.where(k < pos, stack[k], stack[k + 1])
+        self.stack = result
+
+    def median(self):
+        """Median and number of valid values of each pixel."""
+        stack = self.stack
+        nimg = stack.shape[0]
+        num = (stack < numpy.inf).sum(axis=0)
+        idx = list(numpy.ogrid[tuple(slice(0, s) for s in stack.shape[1:])])
+        lo = stack[tuple([numpy.clip((num - 1) // 2, 0, nimg - 1)] + idx)]
+        hi = stack[tuple([numpy.clip(num // 2, 0, nimg - 1)] + idx)]
+        result = 0.5 * (lo + hi)
+        result[num == 0] = 0
+        return result, num
+
+
+def _sky_block(cache, windows, tids, process):
+    """Compute the sky of a block of consecutive target frames."""
+    running = None
+    current = []
+    for tid in tids:
+        window = windows[tid]
+        if not window:
+            raise ValueError('no sky frames for target frame %d' % tid)
+        for idx in current:
+            if idx not in window:
+                running.remove(cache.get(idx))
+                cache.release(idx)
+        for idx in window:
+            if idx not in current:
+                values = cache.get(idx)
+                if running is None:
+                    running = RunningMedian(values.shape, dtype=cache.dtype)
+                running.add(values)
+        current = list(window)
+        sky, num = running.median()
+        process(tid, sky, num)
+    for idx in current:
+        cache.release(idx)
+
+
+def sliding_sky(windows, load, process, nthreads=1, dtype='float32'):
+    """Compute the sky background of a sequence of target frames.
+
+    The sky of the target frame t is the median of the sky frames
+    with indices in windows[t], each divided by its median. Target
+    frames are ordered in time, so that consecutive windows share
+    most of their frames.
+
+    load(idx) returns the data of a sky frame and its mask (or None),
+    all the frames have the same shape. Each sky frame is loaded once.
+    process(t, sky, num) is called with the sky of each target frame
+    and the number of values used in each pixel.
+
+    The target frames are split in nthreads blocks of consecutive
+    frames. In each block, the median is updated as the window
+    slides.
+    """
+    windows = [list(window) for window in windows]
+    ntargets = len(windows)
+    nthreads = max(1, min(nthreads, ntargets))
+    blocks = [list(b) for b in numpy.array_split(numpy.arange(ntargets),
+                                                 nthreads)]
+    cache = SkyFrameCache(load, windows, blocks=blocks, dtype=dtype)
+
+    if nthreads == 1:
+        _sky_block(cache, windows, blocks[0], process)
+    else:
+        _logger.debug('computing sky of %d frames with %d threads',
+                      ntargets, nthreads)
+        pool = ThreadPool(nthreads)
+        try:
+            pool.map(lambda tids: _sky_block(cache, windows, tids, process),
+                     blocks)
+        finally:
+            pool.close()
+            pool.join()
+    return cache.scales
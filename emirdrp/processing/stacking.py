@@ -0,0 +1,267 @@
+#
+# Copyright 2017 Universidad Complutense de Madrid
+#
+# This file is part of PyEmir
+#
+# PyEmir is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyEmir is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyEmir.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Robust combination of stacks of frames, by blocks of rows.
+
+The functions have the signature of the combination methods of
+numina.array.combine and return an array of shape (3, shape), with
+the combined value, its variance and the number of points used.
+The frames are combined in blocks of *tile* rows, stacked in float32,
+optionally by a pool of *nthreads* threads. Masks can be boolean or
+integer arrays, nonzero values are masked.
+"""
+
+from __future__ import division
+
+import logging
+from multiprocessing.pool import ThreadPool
+
+import numpy
+
+_logger = logging.getLogger('numina.recipes.emir')
+
+
+def _as_bool(mask):
+    mask = numpy.asarray(mask)
+    if mask.dtype == numpy.bool_:
+        return mask
+    return mask != 0
+
+
+def _masked_stack(arrays, masks, zeros, scales, weights, region):
+    """Stack a region of the frames, masked values are NaN.
+
+    Frames with negative weight are not used.
+    """
+    used = [idx for idx in range(len(arrays))
+            if weights is None or weights[idx] >= 0]
+    shape = numpy.asarray(arrays[used[0]][region]).shape
+    stack = numpy.empty((len(used),) + shape, dtype='float32')
+    for k, idx in enumerate(used):
+        layer = stack[k]
+        layer[...] = arrays[idx][region]
+        if zeros is not None:
+            layer -= zeros[idx]
+        if scales is not None:
+            layer /= scales[idx]
+        if masks is not None and masks[idx] is not None:
+            layer[_as_bool(masks[idx][region])] = numpy.nan
+    if weights is None:
+        wstack = None
+    else:
+        wstack = numpy.asarray([weights[idx] for idx in used],
+                               dtype='float64')
+    return stack, wstack
+
+
+def _ogrid(shape):
+    return tuple(numpy.ogrid[tuple(slice(0, side) for side in shape)])
+
+
+def _weighted_stats(values, valid, weights):
+    """Weighted mean, variance and number of the valid values.
+
+    values and valid have the frames in the first axis, weights
+    is None or has the shape of values. The variance is computed
+    as in numina, with one value it is zero.
+    """
+    if weights is None:
+        wv = valid.astype('float64')
+    else:
+        wv = numpy.where(valid, weights, 0.0)
+    vals = numpy.where(valid, values, 0.0)
+    v1 = wv.sum(axis=0)
+    v2 = (wv * wv).sum(axis=0)
+    num = valid.sum(axis=0)
+
+    safe = numpy.where(v1 > 0, v1, 1.0)
+    mean = (wv * vals).sum(axis=0) / safe
+    diff = numpy.where(valid, vals - mean, 0.0)
+    sum2 = (wv * diff * diff).sum(axis=0)
+    denom = v1 * v1 - v2
+    var = numpy.where(denom > 0,
+                      v1 * sum2 / numpy.where(denom > 0, denom, 1.0), 0.0)
+    mean[num == 0] = 0.0
+    return mean, var, num
+
+
+def _partitioned(stack, weights, kth):
+    """Partition the stack along the first axis at the positions kth.
+
+    Masked values are sorted last. The weights are reordered
+    with the values.
+    """
+    stack[numpy.isnan(stack)] = numpy.inf
+    kth = numpy.unique(numpy.clip(kth, 0, stack.shape[0] - 1))
+    if weights is None:
+        return numpy.partition(stack, kth, axis=0), None
+    order = numpy.argpartition(stack, kth, axis=0)
+    return stack[(order,) + _ogrid(stack.shape[1:])], weights[order]
+
+
+def _ranks(shape):
+    ranks = numpy.arange(shape[0])
+    return ranks.reshape((-1,) + (1,) * (len(shape) - 1))
+
+
+def _median_kernel(stack, weights):
+    valid = numpy.isfinite(stack)
+    wv = None if weights is None else _broadcast(weights, stack)
+    _, var, num = _weighted_stats(stack, valid, wv)
+    nimg = stack.shape[0]
+    lo = numpy.clip((num - 1) // 2, 0, nimg - 1)
+    hi = numpy.clip(num // 2, 0, nimg - 1)
+    part, _ = _partitioned(stack, None, numpy.concatenate([lo.ravel(),
+                                                           hi.ravel()]))
+    idx = _ogrid(stack.shape[1:])
+    value = 0.5 * (part[(lo,) + idx].astype('float64') + part[(hi,) + idx])
+    value[num == 0] = 0.0
+    # variance of the median, as in numina
+    return value, var / 0.637, num
+
+
+def _mean_kernel(stack, weights):
+    valid = numpy.isfinite(stack)
+    wv = None if weights is None else _broadcast(weights, stack)
+    return _weighted_stats(stack, valid, wv)
+
+
+def _sigmaclip_kernel(stack, weights, low, high):
+    valid = numpy.isfinite(stack)
+    wv = None if weights is None else _broadcast(weights, stack)
+    while True:
+        mean, var, num = _weighted_stats(stack, valid, wv)
+        std = numpy.sqrt(var)
+        with numpy.errstate(invalid='ignore'):
+            keep = ((stack >= mean - low * std) &
+                    (stack <= mean + high * std))
+        # pixels with std == 0 are not clipped
+        keep = valid & (keep | (std == 0))
+        if numpy.array_equal(keep, valid):
+            return mean, var, num
+        valid = keep
+
+
+def _quantileclip_kernel(stack, weights, fclip):
+    num = numpy.isfinite(stack).sum(axis=0)
+    # rounded, so that exact products are not ceiled up by rounding errors
+    nclip = numpy.ceil(numpy.round(num * fclip, 6)).astype('int')
+    kth = numpy.concatenate([nclip.ravel(), (num - nclip - 1).ravel()])
+    part, wpart = _partitioned(stack, weights, kth)
+    ranks = _ranks(stack.shape)
+    central = (ranks >= nclip) & (ranks < num - nclip)
+    value, var, npoints = _weighted_stats(part, central, wpart)
+    # more points rejected than available
+    empty = npoints == 0
+    value[empty] = 0.0
+    var[empty] = 0.0
+    return value, var, npoints
+
+
+def _broadcast(weights, stack):
+    shape = (-1,) + (1,) * (stack.ndim - 1)
+    return numpy.broadcast_to(weights.reshape(shape), stack.shape)
+
+
+def _combine(kernel, arrays, masks=None, dtype=None, out=None,
+             zeros=None, scales=None, weights=None, nthreads=1, tile=256):
+    if len(arrays) == 0:
+        raise ValueError('no arrays to combine')
+    shape = tuple(arrays[0].shape)
+    if out is None:
+        out = numpy.zeros((3,) + tuple(shape), dtype=dtype)
+
+    def block(r0):
+        region = slice(r0, min(r0 + tile, shape[0]))
+        stack, wstack = _masked_stack(arrays, masks, zeros, scales,
+                                      weights, region)
+        for k, values in enumerate(kernel(stack, wstack)):
+            out[k, region] = values
+
+    starts = list(range(0, shape[0], tile))
+    if nthreads > 1 and len(starts) > 1:
+        _logger.debug('combining %d blocks of rows with %d threads',
+                      len(starts), nthreads)
+        pool = ThreadPool(nthreads)
+        try:
+            pool.map(block, starts)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for r0 in starts:
+            block(r0)
+    return out
+
+
+def mean(arrays, masks=None, dtype=None, out=None, zeros=None,
+         scales=None, weights=None, nthreads=1, tile=256):
+    """Combine arrays using the weighted mean, with masks."""
+    return _combine(_mean_kernel, arrays, masks=masks, dtype=dtype,
+                    out=out, zeros=zeros, scales=scales, weights=weights,
+                    nthreads=nthreads, tile=tile)
+
+
+def median(arrays, masks=None, dtype=None, out=None, zeros=None,
+           scales=None, weights=None, nthreads=1, tile=256):
+    """Combine arrays using the median, with masks.
+
+    The median is selected with a partition of each block of rows.
+    The weights are only used in the variance.
+    """
+    return _combine(_median_kernel, arrays, masks=masks, dtype=dtype,
+                    out=out, zeros=zeros, scales=scales, weights=weights,
+                    nthreads=nthreads, tile=tile)
+
+
+def sigmaclip(arrays, masks=None, dtype=None, out=None, zeros=None,
+              scales=None, weights=None, low=3., high=3.,
+              nthreads=1, tile=256):
+    """Combine arrays using the mean, with iterative sigma clipping.
+
+    Values outside [mean - low * std, mean + high * std] are
+    rejected until no value is rejected.
+    """
+    def kernel(stack, wstack):
+        return _sigmaclip_kernel(stack, wstack, low, high)
+
+    return _combine(kernel, arrays, masks=masks, dtype=dtype,
+                    out=out, zeros=zeros, scales=scales, weights=weights,
+                    nthreads=nthreads, tile=tile)
+
+
+def quantileclip(arrays, masks=None, dtype=None, out=None, zeros=None,
+                 scales=None, weights=None, fclip=0.10,
+                 nthreads=1, tile=256):
+    """Combine arrays using the mean, rejecting a fraction on both ends.
+
+    The fraction fclip of the points of each pixel is rejected on
+    both ends, the maximum is 0.4. When fclip times the number of
+    points is fractional, it is rounded up, as in numina, so that
+    at least one point is rejected on each end if fclip > 0.
+    """
+    if fclip < 0 or fclip > 0.4:
+        raise ValueError('fclip out of limits')
+
+    def kernel(stack, wstack):
+        return _quantileclip_kernel(stack, wstack, fclip)
+
+    return _combine(kernel, arrays, masks=masks, dtype=dtype,
+                    out=out, zeros=zeros, scales=scales, weights=weights,
+                    nthreads=nthreads, tile=tile)
@@ -0,0 +1,223 @@
+#
+# Copyright 2017 Universidad Complutense de Madrid
+#
+# This file is part of PyEmir
+#
+# PyEmir is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyEmir is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyEmir.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Store of intermediate images, kept in memory"""
+
+import os
+import shutil
+import logging
+import tempfile
+import threading
+import contextlib
+import collections
+
+import numpy
+from astropy.io import fits
+
+_logger = logging.getLogger('numina.recipes.emir')
+
+
+def _hdulist_nbytes(hdulist):
+    return sum(hdu.data.nbytes for hdu in hdulist if hdu.data is not None)
+
+
+def _read_hdulist(filename):
+    """Read a FITS file in memory."""
+    with fits.open(filename, mode='readonly', memmap=False) as hdulist:
+        for hdu in hdulist:
+            # access the data to read it before closing the file
+            hdu.data
+        return fits.HDUList([hdu for hdu in hdulist])
+
+
+def _as_hdulist(data, header=None):
+    if isinstance(data, fits.HDUList):
+        return data
+    if data.dtype == numpy.bool_:
+        data = data.astype('uint8')
+    return fits.HDUList([fits.PrimaryHDU(data, header=header)])
+
+
+class IntermediateStore(object):
+    """Intermediate images of a reduction, stored by name.
+
+    The images are kept in memory, as HDULists. If *budget* (in bytes)
+    is not None, the least recently used images are written to a
+    temporary directory when the images in memory exceed the budget,
+    and read back when they are used again.
+
+    If *persist* is True, each image is also written to a FITS file
+    with its name when it is stored. Names not in the store are read
+    from the FITS files with that name.
+    """
+    def __init__(self, budget=None, persist=False, spilldir=None):
+        self.budget = budget
+        self.persist = persist
+        self._spilldir = spilldir
+        self._tmpdir = None
+        # name -> HDUList, in order of use
+        self._memory = collections.OrderedDict()
+        # name -> file with the spilled image
+        self._spilled = {}
+        self.nbytes = 0
+        self._nspilled = 0
+        self._lock = threading.RLock()
+
+    def __contains__(self, name):
+        with self._lock:
+            return name in self._memory or name in self._spilled
+
+    def put(self, name, data, header=None):
+        """Store an HDUList or an array with name."""
+        hdulist = _as_hdulist(data, header=header)
+        with self._lock:
+            self._discard(name)
+            if self.persist:
+                hdulist.writeto(name, clobber=True)
+            self._memory[name] = hdulist
+            self.nbytes += _hdulist_nbytes(hdulist)
+            self._spill()
+        return hdulist
+
+    def get(self, name):
+        """HDUList stored with name."""
+        with self._lock:
+            if name in self._memory:
+                hdulist = self._memory.pop(name)
+                self._memory[name] = hdulist
+                return hdulist
+            if name in self._spilled:
+                _logger.debug('reading spilled image %s', name)
+                filename = self._spilled.pop(name)
+                hdulist = _read_hdulist(filename)
+                os.remove(filename)
+                self._memory[name] = hdulist
+                self.nbytes += _hdulist_nbytes(hdulist)
+                self._spill(keep=name)
+                return hdulist
+        # not an intermediate image
+        return _read_hdulist(name)
+
+    def getdata(self, name):
+        """Data of the primary HDU stored with name."""
+        return self.get(name)['primary'].data
+
+    def _filename(self, name):
+        """File with the image name, if it is not in memory."""
+        with self._lock:
+            if name in self._memory:
+                return None
+            return self._spilled.get(name, name)
+
+    def source(self, name, region=Ellipsis):
+        """Source of the tiles of region of the primary data of name.
+
+        If the image is in memory, returns the data in region. Otherwise
+        returns the name of the file with the image (spilled, persistent
+        or external), to be read by tiles as in emirdrp.processing.superflat.
+        Spilled images are not read back in memory.
+        """
+        filename = self._filename(name)
+        if filename is None:
+            return self.getdata(name)[region]
+        return filename
+
+    def mapped(self, name):
+        """Primary data of name, without reading it in memory.
+
+        If the image is not in memory, its file is memory mapped,
+        only the parts of the array used are read.
+        """
+        filename = self._filename(name)
+        if filename is None:
+            return self.getdata(name)
+        with fits.open(filename, mode='readonly', memmap=True) as hdulist:
+            return hdulist['primary'].data
+
+    @contextlib.contextmanager
+    def open(self, name, mode='readonly'):
+        """Context manager with the HDUList stored with name.
+
+        With mode 'update', the HDUList is stored again on exit.
+        """
+        hdulist = self.get(name)
+        yield hdulist
+        if mode == 'update':
+            self.put(name, hdulist)
+
+    def copy(self, src, dst):
+        """Store a copy of the image src with name dst."""
+        hdulist = self.get(src)
+        copied = fits.HDUList([hdu.copy() for hdu in hdulist])
+        return self.put(dst, copied)
+
+    def rename(self, src, dst):
+        """Store the image src with name dst."""
+        with self._lock:
+            stored = src in self
+            hdulist = self.get(src)
+            self._discard(src)
+        if stored and self.persist:
+            os.remove(src)
+        return self.put(dst, hdulist)
+
+    def save(self, name, data, header=None):
+        """Write an auxiliary image, that is not read again.
+
+        The image is only written if the store is persistent.
+        """
+        if self.persist:
+            _as_hdulist(data, header=header).writeto(name, clobber=True)
+
+    def close(self):
+        """Remove all the images and the temporary files."""
+        with self._lock:
+            self._memory.clear()
+            self._spilled.clear()
+            self.nbytes = 0
+            if self._tmpdir is not None:
+                shutil.rmtree(self._tmpdir, ignore_errors=True)
+                self._tmpdir = None
+
+    def _discard(self, name):
+        hdulist = self._memory.pop(name, None)
+        if hdulist is not None:
+            self.nbytes -= _hdulist_nbytes(hdulist)
+        filename = self._spilled.pop(name, None)
+        if filename is not None:
+            os.remove(filename)
+
+    def _spill(self, keep=None):
+        if self.budget is None:
+            return
+        for name in list(self._memory):
+            if self.nbytes <= self.budget:
+                break
+            if name == keep:
+                continue
+            hdulist = self._memory.pop(name)
+            if self._tmpdir is None:
+                self._tmpdir = tempfile.mkdtemp(prefix='emir-store-',
+                                                dir=self._spilldir)
+            filename = os.path.join(self._tmpdir, '%d.fits' % self._nspilled)
+            self._nspilled += 1
+            _logger.debug('spilling image %s to %s', name, filename)
+            hdulist.writeto(filename)
+            self._spilled[name] = filename
+            self.nbytes -= _hdulist_nbytes(hdulist)
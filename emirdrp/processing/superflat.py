@@ -0,0 +1,220 @@
+#
+# Copyright 2017 Universidad Complutense de Madrid
+#
+# This file is part of PyEmir
+#
+# PyEmir is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# PyEmir is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with PyEmir.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""Superflat combination, streamed by detector channels"""
+
+from __future__ import division
+
+import logging
+import multiprocessing
+
+import six
+import numpy
+from astropy.io import fits
+from numina.array.combine import flatcombine
+
+_logger = logging.getLogger('numina.recipes.emir')
+
+
+def _runs(indices):
+    """Slices covering runs of consecutive indices."""
+    breaks = numpy.flatnonzero(numpy.diff(indices) > 1) + 1
+    return [slice(run[0], run[-1] + 1) for run in numpy.split(indices, breaks)]
+
+
+def channel_tiles(shape, channels):
+    """Tiles covering an array of the given shape, without overlaps.
+
+    The tiles are the channels, plus rectangles covering
+    the pixels outside the channels, if any.
+    """
+    covered = numpy.zeros(shape, dtype='bool')
+    tiles = []
+    for channel in channels:
+        channel = tuple(channel)
+        if covered[channel].size > 0:
+            covered[channel] = True
+            tiles.append(channel)
+
+    rows = numpy.flatnonzero(~covered.all(axis=1))
+    if len(rows) > 0:
+        _logger.debug('%d rows not covered by channels', len(rows))
+        # consecutive rows with the same uncovered columns
+        start = rows[0]
+        for row, nrow in zip(rows, numpy.append(rows[1:], -1)):
+            if (nrow != row + 1 or
+                    numpy.any(covered[nrow] != covered[start])):
+                cols = numpy.flatnonzero(~covered[start])
+                for cslice in _runs(cols):
+                    tiles.append((slice(start, row + 1), cslice))
+                start = nrow
+    return tiles
+
+
+def _tile_source(source, region, tile):
+    """Source of a tile of a frame or a mask.
+
+    source is the name of a FITS file, whose primary data is
+    cut with region, or an array with the shape of the region.
+    Arrays are sliced here, so that only the tile is sent
+    to the workers.
+    """
+    if isinstance(source, six.string_types):
+        return source, region, tile
+    else:
+        return source[tile]
+
+
+def _read_tile(source):
+    """Read a tile of a frame or a mask."""
+    if isinstance(source, tuple):
+        name, region, tile = source
+        with fits.open(name, memmap=True, mode='readonly') as hdulist:
+            data = hdulist['primary'].data[region][tile]
+            return numpy.array(data)
+    else:
+        return numpy.asarray(source)
+
+
+def _tile_sources(frames, masks, regions, tile):
+    frames = [_tile_source(frame, region, tile)
+              for frame, region in zip(frames, regions)]
+    masks = [_tile_source(mask, region, tile)
+             for mask, region in zip(masks, regions)]
+    return frames, masks
+
+
+def _row_counts(masks):
+    """Number of unmasked pixels in each row of a tile of each mask."""
+    return [(_read_tile(mask) == 0).sum(axis=1) for mask in masks]
+
+
+def _rank_offsets(tiles, counts):
+    """Rank of the first unmasked pixel of each row of each tile.
+
+    The rank is the position of the pixel among the unmasked pixels
+    of the whole region, in C order. counts are the row counts of each
+    tile, for each frame. Returns, for each tile, an array with the
+    offsets of each frame and row.
+    """
+    if not counts:
+        return []
+    counts = [numpy.atleast_2d(numpy.array(count, dtype='int'))
+              for count in counts]
+    starts = [tile[0].start or 0 for tile in tiles]
+    nframes = counts[0].shape[0]
+    nrows = max(start + count.shape[1]
+                for start, count in zip(starts, counts))
+    totals = numpy.zeros((nframes, nrows), dtype='int')
+    for start, count in zip(starts, counts):
+        totals[:, start:start + count.shape[1]] += count
+    before = numpy.cumsum(totals, axis=1) - totals
+
+    # in each row, the tiles on the left come first
+    offsets = [None] * len(tiles)
+    left = numpy.zeros((nframes, nrows), dtype='int')
+    order = sorted(range(len(tiles)), key=lambda k: tiles[k][1].start or 0)
+    for k in order:
+        rows = slice(starts[k], starts[k] + counts[k].shape[1])
+        offsets[k] = before[:, rows] + left[:, rows]
+        left[:, rows] += counts[k]
+    return offsets
+
+
+def _scale_sample(args):
+    """Sample of the unmasked values of each frame in a tile.
+
+    The unmasked pixels whose rank in the region is a multiple
+    of step are used.
+    """
+    frames, masks, offsets, step = args
+    samples = []
+    for frame, mask, offset in zip(frames, masks, offsets):
+        data = _read_tile(frame)
+        valid = _read_tile(mask) == 0
+        rank = numpy.cumsum(valid, axis=1) - 1 + offset[:, numpy.newaxis]
+        samples.append(data[valid & (rank % step == 0)])
+    return samples
+
+
+def _combine_tile(args):
+    """Combine a tile of all the frames."""
+    frames, masks, scales, blank = args
+    data = [_read_tile(frame) for frame in frames]
+    mdata = [_read_tile(mask) for mask in masks]
+    return flatcombine(data, mdata, scales=scales, blank=blank)
+
+
+def _map_tiles(func, tasks, nprocs):
+    if nprocs <= 1 or len(tasks) < 2:
+        return [func(task) for task in tasks]
+
+    _logger.debug('processing %d tiles with %d processes',
+                  len(tasks), nprocs)
+    pool = multiprocessing.Pool(nprocs)
+    try:
+        return pool.map(func, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def frame_scales(frames, masks, regions, tiles, step=10, nprocs=1):
+    """Median of the unmasked values of each frame.
+
+    frames and masks are names of FITS files or arrays, regions are
+    the valid regions of the frames. The frames are read by tiles, and
+    one in *step* unmasked pixels of the region is used, the same pixels
+    as data[mask == 0][::step]. The masks are read twice, first to count
+    the unmasked pixels of each row. If *nprocs* is greater than 1, the
+    tiles are read by a pool of processes.
+    """
+    sources = [_tile_sources(frames, masks, regions, tile)
+               for tile in tiles]
+    counts = _map_tiles(_row_counts, [tmasks for _, tmasks in sources],
+                        nprocs)
+    offsets = _rank_offsets(tiles, counts)
+    tasks = [(tframes, tmasks, offset, step)
+             for (tframes, tmasks), offset in zip(sources, offsets)]
+    samples = _map_tiles(_scale_sample, tasks, nprocs)
+    # samples of each frame, in all the tiles
+    scales = []
+    for parts in zip(*samples):
+        scales.append(numpy.median(numpy.concatenate(parts)))
+    return scales
+
+
+def combine_superflat(frames, masks, regions, shape, tiles, scales,
+                      blank=1.0, nprocs=1):
+    """Combine frames with flatcombine, tile by tile.
+
+    The memory used by each worker is bounded by the size of one
+    tile in all the frames. Returns the combined data, variance and
+    number of points, with the given shape.
+    """
+    tasks = [_tile_sources(frames, masks, regions, tile) + (scales, blank)
+             for tile in tiles]
+    results = _map_tiles(_combine_tile, tasks, nprocs)
+
+    out = None
+    for tile, result in zip(tiles, results):
+        if out is None:
+            out = numpy.zeros((3,) + tuple(shape), dtype=result.dtype)
+        out[(slice(None),) + tile] = result
+    return out
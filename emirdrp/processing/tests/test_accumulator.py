@@ -0,0 +1,43 @@
+
+import numpy
+import astropy.io.fits as fits
+from numina.array import combine
+
+from ..accumulator import RunningStack, has_accumulator
+
+
+def test_running_stack_exact():
+    """The stack gives the mean and variance of all the images"""
+    rng = numpy.random.RandomState(1234)
+    data = rng.normal(100.0, 5.0, size=(4, 10, 12)).astype('float32')
+    mask = numpy.zeros(data.shape, dtype='bool')
+    mask[2, 3, 4] = True
+
+    hdul = fits.HDUList([fits.PrimaryHDU(data[0])])
+    stack = RunningStack.from_hdulist(hdul, mask=mask[0])
+    for idx in range(1, 4):
+        result = stack.result()
+        hdul = fits.HDUList([fits.PrimaryHDU(result[0])] + stack.to_hdus())
+        assert has_accumulator(hdul)
+        stack = RunningStack.from_hdulist(hdul)
+        stack.add(data[idx], mask=mask[idx])
+
+    result = stack.result()
+    expected = combine.mean(list(data), masks=list(mask), dtype='float64')
+    numpy.testing.assert_allclose(result[0], expected[0], rtol=1e-6)
+    numpy.testing.assert_allclose(result[1], expected[1], rtol=1e-4)
+    numpy.testing.assert_array_equal(result[2], expected[2])
+
+
+def test_running_stack_resize():
+    stack = RunningStack.zeros((3, 3))
+    stack.add(numpy.ones((3, 3)))
+    stack = stack.resize((4, 5), [slice(1, 4), slice(0, 3)])
+    stack.add(3 * numpy.ones((3, 3)), region=[slice(0, 3), slice(2, 5)])
+    result = stack.result()
+    assert result[0, 0, 0] == 0
+    assert result[2, 0, 0] == 0
+    assert result[0, 1, 0] == 1
+    assert result[0, 1, 2] == 2
+    assert result[1, 1, 2] == 2
+    assert result[0, 0, 4] == 3
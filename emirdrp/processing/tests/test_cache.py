@@ -0,0 +1,80 @@
+
+import os
+
+import numpy
+import astropy.io.fits as fits
+import numina.core
+
+from emirdrp.datamodel import EmirDataModel
+from ..cache import CalibrationCache
+
+
+def create_calib(filename, value, uuid):
+    data = numpy.zeros((10, 10), dtype='float32') + value
+    hdu = fits.PrimaryHDU(data)
+    hdu.header['UUID'] = uuid
+    if os.path.exists(str(filename)):
+        os.remove(str(filename))
+    hdu.writeto(str(filename))
+    return numina.core.DataFrame(filename=str(filename))
+
+
+def test_cache_hit(tmpdir):
+    cache = CalibrationCache()
+    datamodel = EmirDataModel()
+    dframe = create_calib(tmpdir.join('bias.fits'), 1.0, 'a-b-c')
+
+    entry1 = cache.load(dframe, datamodel, kind='bias')
+    entry2 = cache.load(dframe, datamodel, kind='bias')
+
+    assert entry1 is entry2
+    assert entry1.calibid == 'uuid:a-b-c'
+    assert not entry1.data.flags.writeable
+    assert len(cache) == 1
+
+
+def test_cache_mtime(tmpdir):
+    cache = CalibrationCache()
+    datamodel = EmirDataModel()
+    filename = tmpdir.join('bias.fits')
+    dframe = create_calib(filename, 1.0, 'a-b-c')
+    entry1 = cache.load(dframe, datamodel)
+
+    create_calib(filename, 2.0, 'a-b-c')
+    mtime = os.path.getmtime(str(filename))
+    os.utime(str(filename), (mtime + 10, mtime + 10))
+    entry2 = cache.load(dframe, datamodel)
+
+    assert entry1 is not entry2
+    assert numpy.all(entry2.data == 2.0)
+
+
+def test_cache_prepare(tmpdir):
+    cache = CalibrationCache()
+    datamodel = EmirDataModel()
+    dframe = create_calib(tmpdir.join('flat.fits'), 1.0, 'a-b-c')
+    ncalls = []
+
+    def prepare(data):
+        ncalls.append(1)
+        return data, {'mean': data.mean()}
+
+    entry = cache.load(dframe, datamodel, kind='flat', prepare=prepare)
+    entry = cache.load(dframe, datamodel, kind='flat', prepare=prepare)
+
+    assert entry.stats['mean'] == 1.0
+    assert len(ncalls) == 1
+
+
+def test_cache_maxbytes(tmpdir):
+    # Room for two 10x10 float32 arrays
+    cache = CalibrationCache(maxbytes=800)
+    datamodel = EmirDataModel()
+    dframes = [create_calib(tmpdir.join('c%d.fits' % idx), idx, 'id-%d' % idx)
+               for idx in range(3)]
+
+    for dframe in dframes:
+        cache.load(dframe, datamodel)
+
+    assert len(cache) == 2
+    assert cache.nbytes == 800
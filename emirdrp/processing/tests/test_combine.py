@@ -0,0 +1,61 @@
+
+import pytest
+
+import numpy
+import astropy.io.fits as fits
+import numina.core
+from numina.array import combine
+
+from ..combine import basic_processing_with_combination_frames
+
+
+def create_frame(seed, shape=(103, 50)):
+    numpy.random.seed(seed)
+    data = numpy.random.normal(100, 10, shape)
+    hdu = fits.PrimaryHDU(data.astype('float32'))
+    hdu.header['TSUTC2'] = 1000.0 + seed
+    hdu.header['UUID'] = 'test-uuid-%d' % seed
+    return numina.core.DataFrame(frame=fits.HDUList([hdu]))
+
+
+@pytest.mark.parametrize("method", [combine.mean, combine.median])
+@pytest.mark.parametrize("tile_rows", [1, 10, 200])
+def test_combination_tiled(method, tile_rows):
+
+    frames = [create_frame(seed) for seed in range(7)]
+
+    def flow(img):
+        return img
+
+    expected = basic_processing_with_combination_frames(
+        frames, flow, method=method
+    )
+    computed = basic_processing_with_combination_frames(
+        frames, flow, method=method, tile_rows=tile_rows
+    )
+
+    assert len(computed) == 3
+    for ext in range(3):
+        assert numpy.array_equal(expected[ext].data, computed[ext].data)
+
+    assert computed[0].header['TSUTC2'] == 1006.0
+    assert computed[0].header['NUM-NCOM'] == 7
+
+
+def test_combination_threads():
+
+    offset = numpy.ones((103, 50), dtype='float32')
+
+    def flow(img):
+        img[0].data = img[0].data - offset
+        return img
+
+    frames = [create_frame(seed) for seed in range(7)]
+    expected = basic_processing_with_combination_frames(frames, flow)
+    frames = [create_frame(seed) for seed in range(7)]
+    computed = basic_processing_with_combination_frames(
+        frames, flow, nthreads=4
+    )
+
+    for ext in range(3):
+        assert numpy.array_equal(expected[ext].data, computed[ext].data)
@@ -74,3 +74,27 @@ def test_coor_raises(images):
     region = utils.image_box2d(xref_cross, yref_cross, shape, (box, box))
     with pytest.raises(ValueError):
         offsets_from_crosscor(arrs, region, order="sksjd")
+
+
+@pytest.mark.parametrize("refine", [True, False])
+def test_coor_regions_batch(images, refine):
+    from ..corr import offsets_from_crosscor_regions
+    from ..corr import offset_from_crosscor_regions
+
+    arrs = images
+    shape = arrs[0].shape
+    box = 50
+    regions = [utils.image_box2d(xc, yc, shape, (box, box))
+               for xc, yc in [(500, 500), (490, 480), (510, 505)]]
+
+    expected = numpy.zeros((len(arrs), 2))
+    for idx, arr in enumerate(arrs[1:], 1):
+        expected[idx] = offset_from_crosscor_regions(
+            arrs[0], arr, regions, refine=refine, order='xy', tol=1
+        )
+
+    computed = offsets_from_crosscor_regions(
+        arrs, regions, refine=refine, order='xy', tol=1
+    )
+
+    assert numpy.allclose(expected, computed)
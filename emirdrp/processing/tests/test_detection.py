@@ -0,0 +1,78 @@
+
+import pytest
+
+import numpy
+
+from emirdrp.util import sextractor
+from ..detection import get_detector, SepDetector, CORRUPTED_APER
+from ..detection import SExtractorDetector
+
+
+def create_image(shape=(200, 220), sigma=2.0, seed=1):
+    rng = numpy.random.RandomState(seed)
+    y, x = numpy.mgrid[0:shape[0], 0:shape[1]]
+    data = rng.normal(100.0, 1.0, size=shape)
+    sources = [(50, 60, 500.0), (150, 120, 1000.0), (100, 170, 300.0)]
+    for xc, yc, flux in sources:
+        norm = flux / (2 * numpy.pi * sigma ** 2)
+        data += norm * numpy.exp(-((x - xc) ** 2 + (y - yc) ** 2) / (2 * sigma ** 2))
+    return data, sources
+
+
+def test_sep_detect():
+    pytest.importorskip('sep')
+    data, sources = create_image()
+    detector = get_detector('sep')
+    # FITS data is big endian
+    catalog, segmap = detector.detect(data.astype('>f4'), segmentation=True)
+
+    assert len(catalog) == len(sources)
+    assert segmap.shape == data.shape
+    assert segmap.max() == len(sources)
+    for obj, (xc, yc, flux) in zip(catalog, sources):
+        # SExtractor coordinates
+        assert abs(obj['X_IMAGE'] - (xc + 1)) < 0.2
+        assert abs(obj['Y_IMAGE'] - (yc + 1)) < 0.2
+        assert abs(obj['FLUX_BEST'] - flux) < 0.05 * flux
+        assert abs(obj['FWHM_IMAGE'] - 2.0 * 2.3548) < 0.5
+        assert segmap[yc, xc] == obj['NUMBER']
+
+
+def test_sep_measure():
+    pytest.importorskip('sep')
+    data, sources = create_image()
+    detector = SepDetector()
+    weight = numpy.ones_like(data)
+    weight[:, :55] = 0
+    catalog, segmap = detector.detect(data, weight=weight)
+    assert segmap is None
+    assert len(catalog) == len(sources) - 1
+
+    measured = detector.measure(0.5 * data, catalog, weight=weight)
+    ratio = measured['FLUX_BEST'] / catalog['FLUX_BEST']
+    numpy.testing.assert_allclose(ratio, 0.5, rtol=1e-2)
+    assert (measured['FLAGS'] & CORRUPTED_APER).sum() == 0
+
+
+def test_get_detector():
+    with pytest.raises(ValueError):
+        get_detector('nodetector')
+
+    detector = get_detector('sextractor')
+    assert detector.name == 'sextractor'
+    assert get_detector(detector) is detector
+
+
+def test_sextractor_weight_file(monkeypatch):
+    monkeypatch.setattr(sextractor.SExtractor, 'setup',
+                        lambda self, path=None: ('sex', '2.19.5'))
+    weight = numpy.ones((20, 30))
+    with sextractor.SExtractorSession() as session:
+        detector = SExtractorDetector(session=session)
+        config1 = detector._create(session, weight, None)
+        config2 = detector._create(session, weight.copy(), None)
+        assert config1['WEIGHT_IMAGE'] == config2['WEIGHT_IMAGE']
+        assert session.config_file(config1) == session.config_file(config2)
+        weight[3, 4] = 0
+        config3 = detector._create(session, weight, None)
+        assert config3['WEIGHT_IMAGE'] != config1['WEIGHT_IMAGE']
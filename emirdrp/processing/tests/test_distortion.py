@@ -0,0 +1,73 @@
+import numpy
+import pytest
+from astropy.io import fits
+from scipy.ndimage import map_coordinates
+from numina.datamodel import DataModel
+
+from emirdrp.instrument.distortions import RadialDistortion
+from ..distortion import DistortionCorrector
+
+
+def _distortion():
+    return RadialDistortion((20.5, 30.5), (1.0, 2e-4, 1e-8),
+                            (1.0, -2e-4, 0.0))
+
+
+def _frame(shape=(40, 60), seed=3):
+    rng = numpy.random.RandomState(seed)
+    data = rng.normal(100, 10, size=shape)
+    variance = rng.uniform(1, 2, size=shape)
+    nmap = numpy.full(shape, 3, dtype='int16')
+    nmap[10, 15] = 2
+    mask = numpy.zeros(shape, dtype='int16')
+    mask[10, 15] = 1
+    hdulist = fits.HDUList([fits.PrimaryHDU(data),
+                            fits.ImageHDU(variance, name='VARIANCE'),
+                            fits.ImageHDU(nmap, name='MAP'),
+                            fits.ImageHDU(mask, name='MASK')])
+    return hdulist
+
+
+def test_corrector_extensions():
+    img = _frame()
+    data = img[0].data.copy()
+    variance = img['VARIANCE'].data.copy()
+    mask = img['MASK'].data.copy()
+    corrector = DistortionCorrector(_distortion(), fill=-1,
+                                    datamodel=DataModel(), dtype='float64')
+    table = corrector.table(data.shape)
+    grid = corrector.distortion.remap_grid(data.shape)
+    inside = ~table.outside
+    assert table.outside.any()
+
+    result = corrector.run(img)
+    assert result[0].header['DISTCORR']
+    expected = map_coordinates(data, grid, order=1)
+    numpy.testing.assert_allclose(result[0].data[inside], expected[inside],
+                                  rtol=1e-6)
+    assert numpy.all(result[0].data[table.outside] == -1)
+
+    expected = map_coordinates(variance, grid, order=1)
+    numpy.testing.assert_allclose(result['VARIANCE'].data[inside],
+                                  expected[inside], rtol=1e-6)
+
+    # every virtual pixel touched by the masked pixel is masked
+    touched = map_coordinates(mask.astype('float64'), grid, order=1) > 0
+    outmask = result['MASK'].data
+    assert outmask.dtype == mask.dtype
+    assert touched.sum() > 1
+    numpy.testing.assert_array_equal(outmask[inside], touched[inside])
+    assert numpy.all(outmask[table.outside] == 1)
+
+    outmap = result['MAP'].data
+    numpy.testing.assert_array_equal(outmap[inside],
+                                     numpy.where(touched, 2, 3)[inside])
+    assert numpy.all(outmap[table.outside] == 0)
+
+
+def test_corrector_refuses_unknown_extension():
+    img = _frame()
+    img.append(fits.ImageHDU(img[0].data, name='OTHER'))
+    corrector = DistortionCorrector(_distortion(), datamodel=DataModel())
+    with pytest.raises(ValueError):
+        corrector.run(img)
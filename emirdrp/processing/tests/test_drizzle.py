@@ -0,0 +1,60 @@
+
+import numpy
+
+from ..drizzle import Drizzle, axis_overlaps
+
+
+def test_axis_overlaps():
+    idx, over = axis_overlaps(3, 0.25, 2, 8)
+    # pixel 0 covers [0.5, 2.5) in the output grid
+    numpy.testing.assert_array_equal(idx[0], [0, 1, 2])
+    numpy.testing.assert_allclose(over[0], [0.5, 1.0, 0.5])
+    numpy.testing.assert_allclose(over.sum(axis=1), 2.0)
+
+
+def test_drizzle_integer_shift():
+    rng = numpy.random.RandomState(1)
+    data = rng.normal(size=(40, 30))
+    driz = Drizzle((50, 35), 1, tile=7)
+    driz.add(data, (3, 2))
+    out = driz.result(dtype='float64')
+    numpy.testing.assert_allclose(out[0, 3:43, 2:32], data)
+    numpy.testing.assert_allclose(out[2, 3:43, 2:32], 1.0)
+    assert out[2].sum() == data.size
+
+
+def test_drizzle_subsampled():
+    rng = numpy.random.RandomState(2)
+    data = rng.uniform(1, 2, size=(20, 25))
+    mask = numpy.zeros(data.shape, dtype='int')
+    mask[5, 7] = 1
+    scale = 2
+    driz = Drizzle((44, 54), scale, tile=6)
+    # half a pixel, the drops are aligned with the output grid
+    driz.add(data, (0.5, 0.5), mask=mask)
+    out = driz.result(dtype='float64')
+
+    expected = numpy.repeat(numpy.repeat(data, scale, axis=0), scale, axis=1)
+    region = (slice(1, 41), slice(1, 51))
+    emask = numpy.repeat(numpy.repeat(mask, scale, axis=0), scale, axis=1)
+    valid = emask == 0
+    numpy.testing.assert_allclose(out[0][region][valid],
+                                  expected[valid] / scale ** 2)
+    numpy.testing.assert_array_equal(out[2][region], valid)
+
+    # flux is conserved
+    driz = Drizzle((44, 54), scale)
+    driz.add(data, (1.3, 0.8))
+    out = driz.result(dtype='float64')
+    numpy.testing.assert_allclose((out[0] * out[2]).sum(), data.sum())
+
+
+def test_drizzle_two_frames():
+    data = numpy.ones((10, 10))
+    driz = Drizzle((30, 30), 2)
+    driz.add(data, (0, 0))
+    driz.add(3 * data, (0.25, 0))
+    out = driz.result(dtype='float64')
+    assert numpy.allclose(out[0][2:18, 2:18], 2.0 / 4)
+    assert numpy.allclose(out[1][2:18, 2:18], 1.0 / 16)
+    assert numpy.allclose(out[2][2:18, 2:18], 2.0)
@@ -0,0 +1,49 @@
+import numpy
+
+from ..flatfield import FlatFieldCorrector
+
+
+def _flat(shape=(10, 12), seed=7):
+    rng = numpy.random.RandomState(seed)
+    return rng.uniform(0.5, 1.5, size=shape).astype('float32')
+
+
+def test_correct_not_inplace():
+    flat = _flat()
+    data = numpy.ones(flat.shape, dtype='float32') * 100
+    original = data.copy()
+    corrector = FlatFieldCorrector(flat)
+    result = corrector.correct(data)
+    assert result is not data
+    numpy.testing.assert_array_equal(data, original)
+    numpy.testing.assert_allclose(result, original / flat, rtol=1e-6)
+
+
+def test_correct_inplace_and_out():
+    flat = _flat()
+    data = numpy.ones(flat.shape, dtype='float32') * 100
+    corrector = FlatFieldCorrector(flat, inplace=True)
+    result = corrector.correct(data)
+    assert result is data
+    numpy.testing.assert_allclose(result, 100 / flat, rtol=1e-6)
+
+    data = numpy.ones(flat.shape, dtype='float32') * 100
+    out = numpy.zeros(flat.shape, dtype='float64')
+    result = corrector.correct(data, out=out)
+    assert result is out
+    numpy.testing.assert_allclose(out, 100 / flat, rtol=1e-6)
+    numpy.testing.assert_array_equal(data, 100)
+
+
+def test_readonly_flat_is_copied():
+    flat = _flat()
+    flat[2, 3] = 0.0
+    flat[5, 6] = -1.0
+    original = flat.copy()
+    flat.flags.writeable = False
+    corrector = FlatFieldCorrector(flat)
+    assert corrector.flat_nfixed == 2
+    numpy.testing.assert_array_equal(flat, original)
+    assert corrector.flatdata is not flat
+    assert corrector.flatdata[2, 3] == 1.0
+    assert corrector.flatdata[5, 6] == 1.0
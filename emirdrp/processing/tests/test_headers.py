@@ -0,0 +1,73 @@
+
+import gzip
+import os
+import shutil
+
+import numpy
+import astropy.io.fits as fits
+
+from ..headers import scan_headers, HeaderCache
+
+
+def create_file(filename):
+    hdu = fits.PrimaryHDU(numpy.zeros((17, 31), dtype='int16'))
+    hdu.header['READMODE'] = 'CDS'
+    hdu.header['EXPTIME'] = 10.0
+    var = fits.ImageHDU(numpy.zeros((17, 31), dtype='float64'), name='VARIANCE')
+    cube = fits.ImageHDU(numpy.ones((3, 5, 7), dtype='uint8'), name='MAP')
+    empty = fits.ImageHDU(name='EMPTY')
+    table = fits.BinTableHDU.from_columns(
+        [fits.Column(name='a', format='E', array=numpy.arange(11.0))],
+        name='TABLE'
+    )
+    fits.HDUList([hdu, var, cube, empty, table]).writeto(filename)
+
+
+def test_scan_headers(tmpdir):
+    filename = str(tmpdir.join('image.fits'))
+    create_file(filename)
+
+    headers = scan_headers(filename)
+
+    with fits.open(filename) as hdulist:
+        assert len(headers) == len(hdulist)
+        for hdr, hdu in zip(headers, hdulist):
+            assert hdr == hdu.header
+
+    assert headers[0]['READMODE'] == 'CDS'
+    assert headers[4]['EXTNAME'] == 'TABLE'
+
+
+def test_scan_headers_gzip(tmpdir):
+    filename = str(tmpdir.join('image.fits'))
+    create_file(filename)
+    gzname = filename + '.gz'
+    with open(filename, 'rb') as src:
+        with gzip.open(gzname, 'wb') as dst:
+            shutil.copyfileobj(src, dst)
+
+    headers = scan_headers(gzname)
+
+    with fits.open(filename) as hdulist:
+        assert len(headers) == len(hdulist)
+        for hdr, hdu in zip(headers, hdulist):
+            assert hdr == hdu.header
+
+
+def test_header_cache(tmpdir):
+    filename = str(tmpdir.join('image.fits'))
+    create_file(filename)
+    cache = HeaderCache()
+
+    headers1 = cache.headers(filename)
+    headers2 = cache.headers(filename)
+    assert headers1 is headers2
+
+    with fits.open(filename, mode='update') as hdulist:
+        hdulist[0].header['EXPTIME'] = 20.0
+    mtime = os.path.getmtime(filename)
+    os.utime(filename, (mtime + 10, mtime + 10))
+
+    headers3 = cache.headers(filename)
+    assert headers3 is not headers1
+    assert headers3[0]['EXPTIME'] == 20.0
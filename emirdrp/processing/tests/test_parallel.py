@@ -0,0 +1,29 @@
+
+import pytest
+
+import numpy
+
+from ..parallel import freeze_flow
+
+
+class FakeCorrector(object):
+    def __init__(self, calib):
+        self.calib = calib
+
+
+class FakeFlow(object):
+    def __init__(self, nodeseq):
+        self.nodeseq = nodeseq
+
+
+def test_freeze_flow():
+    calib1 = numpy.ones((10, 10))
+    calib2 = numpy.zeros((10, 10))
+    flow = FakeFlow([FakeCorrector(calib1), FakeFlow([FakeCorrector(calib2)])])
+
+    freeze_flow(flow)
+
+    assert not calib1.flags.writeable
+    assert not calib2.flags.writeable
+    with pytest.raises(ValueError):
+        calib1[0, 0] = 2.0
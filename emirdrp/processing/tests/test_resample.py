@@ -0,0 +1,118 @@
+
+import numpy
+from numina.array import resize_array, subarray_match
+
+from ..resample import OffsetView, ShiftedFrame
+from ..resample import combine_shifted, shifted_shape, RemapTable
+
+
+def test_shifted_frame_integer():
+    rng = numpy.random.RandomState(5)
+    data = rng.normal(size=(20, 30))
+    shape = (27, 34)
+    frame = ShiftedFrame(data, (4, 2), shape, fill=1)
+    region, _ = subarray_match(shape, (4, 2), data.shape)
+    expected = resize_array(data, shape, region, fill=1)
+    numpy.testing.assert_array_equal(numpy.asarray(frame), expected)
+
+    cut = (slice(10, 25), slice(0, 20))
+    numpy.testing.assert_array_equal(frame[cut], expected[cut])
+
+
+def test_offset_view():
+    rng = numpy.random.RandomState(4)
+    data = rng.normal(size=(20, 30))
+    mask = numpy.zeros(data.shape, dtype='int16')
+    mask[3, 4] = 1
+    shape = (27, 34)
+    view = OffsetView(data, (4, 2), shape, mask=mask, fill=1)
+    region, _ = subarray_match(shape, (4, 2), data.shape)
+    expected = resize_array(data, shape, region, fill=1)
+    numpy.testing.assert_array_equal(numpy.asarray(view), expected)
+
+    # inside the frame, a view of data
+    values, masked = view.sample((slice(5, 10), slice(2, 12)))
+    assert numpy.may_share_memory(values, data)
+    numpy.testing.assert_array_equal(values, data[1:6, 0:10])
+    assert masked.sum() == 1
+
+    values, masked = view.sample((slice(0, 10), slice(None)))
+    numpy.testing.assert_array_equal(values, expected[:10])
+    assert masked[:4].all()
+    assert masked[7, 6]
+    assert masked.sum() == 4 * 34 + 6 * 4 + 1
+
+    assert view.overlaps((slice(20, 24), slice(0, 3)))
+    assert not view.overlaps((slice(0, 4), slice(None)))
+
+
+def test_shifted_frame_fractional():
+    # a plane is interpolated exactly
+    yy, xx = numpy.mgrid[0:20, 0:30]
+    data = 2.0 * yy + 0.5 * xx
+    mask = numpy.zeros(data.shape, dtype='int16')
+    mask[10, 10] = 1
+    frame = ShiftedFrame(data, (2.25, 1.5), (24, 33), mask=mask)
+    values, masked = frame.sample((slice(None), slice(None)))
+
+    cy, cx = numpy.mgrid[0:24, 0:33]
+    expected = 2.0 * (cy - 2.25) + 0.5 * (cx - 1.5)
+    valid = masked == 0
+    numpy.testing.assert_allclose(values[valid], expected[valid])
+    # the pixels interpolated from the masked pixel
+    assert masked[12:14, 11:13].all()
+    # outside the frame
+    assert masked[:3].all()
+    assert masked[:, :2].all()
+    assert masked.sum() == 24 * 33 - 19 * 29 + 4
+
+
+def test_combine_shifted():
+    rng = numpy.random.RandomState(6)
+    base = rng.normal(size=(40, 40))
+    offsets = [(0.0, 0.0), (1.5, -0.5), (-2.25, 3.0)]
+    finalshape, offsetsp = shifted_shape(base.shape, offsets)
+    assert finalshape == (45, 44)
+    numpy.testing.assert_allclose(offsetsp[0], [3.0, 1.0])
+
+    frames = [ShiftedFrame(base, offset, finalshape) for offset in offsetsp]
+    out = combine_shifted(frames, finalshape, tile=7)
+    # the same frames as views
+    views = [OffsetView(base, offset, (50, 45)) for offset in
+             [(3, 1), (10, 3), (0, 5)]]
+    vout = combine_shifted(views, (50, 45), tile=4)
+    assert vout[2].max() == 3
+    assert (vout[2, :3] <= 1).all()
+    # written in a buffer, rows without frames are zero
+    views = [OffsetView(base, offset, (60, 45)) for offset in
+             [(3, 1), (10, 3), (0, 5)]]
+    buf = numpy.full((3, 60, 45), 7.0, dtype='float32')
+    result = combine_shifted(views, (60, 45), tile=4, out=buf)
+    assert result is buf
+    numpy.testing.assert_array_equal(buf[:, :50], vout)
+    assert (buf[:, 50:] == 0).all()
+
+    samples = [frame.sample((slice(None), slice(None))) for frame in frames]
+    values = numpy.ma.array([s[0] for s in samples],
+                            mask=[s[1] for s in samples])
+    expected = numpy.ma.median(values, axis=0).filled(0)
+    numpy.testing.assert_allclose(out[0], expected, rtol=1e-5)
+    numpy.testing.assert_array_equal(out[2], values.count(axis=0))
+
+
+def test_remap_table():
+    from scipy.ndimage import map_coordinates
+    from emirdrp.instrument.distortions import RadialDistortion
+
+    rng = numpy.random.RandomState(2)
+    data = rng.normal(size=(60, 45))
+    distortion = RadialDistortion((20.5, 30.5), (1.0, 2e-4, 1e-8),
+                                  (1.0, -2e-4, 0.0))
+    grid = distortion.remap_grid(data.shape)
+    table = RemapTable(grid, data.shape)
+    expected = map_coordinates(data, grid, order=1, cval=-1)
+    out1 = table(data, fill=-1, dtype='float64')
+    out2 = table(data, fill=-1, dtype='float64', nthreads=3, band=7)
+    assert table.outside.any()
+    numpy.testing.assert_allclose(out1, expected, atol=1e-5)
+    numpy.testing.assert_array_equal(out1, out2)
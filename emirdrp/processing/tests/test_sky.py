@@ -0,0 +1,147 @@
+
+import threading
+
+import numpy
+
+from .. import sky
+from ..sky import RunningMedian, SkyFrameCache, sliding_sky
+
+
+def reference_sky(data, masks, window):
+    values = numpy.ma.array([data[i] / numpy.median(data[i]) for i in window],
+                            mask=[masks[i] for i in window])
+    return numpy.ma.median(values, axis=0).filled(0), values.count(axis=0)
+
+
+def create_frames(nframes=8, shape=(20, 30), seed=9):
+    rng = numpy.random.RandomState(seed)
+    data = rng.normal(1000.0, 30.0, size=(nframes,) + shape)
+    data *= rng.uniform(0.8, 1.2, size=(nframes, 1, 1))
+    masks = rng.uniform(size=data.shape) < 0.2
+    # a pixel masked in all the frames
+    masks[:, 3, 4] = True
+    return data, masks
+
+
+def test_running_median():
+    data, masks = create_frames()
+    values = numpy.where(masks, numpy.inf, data).astype('float32')
+    running = RunningMedian(data.shape[1:])
+    for idx in [0, 1, 2, 3]:
+        running.add(values[idx])
+    running.remove(values[1])
+    running.add(values[4])
+    running.remove(values[0])
+
+    sky, num = running.median()
+    expected = numpy.ma.median(
+        numpy.ma.array(data[[2, 3, 4]], mask=masks[[2, 3, 4]]), axis=0)
+    numpy.testing.assert_allclose(sky, expected.filled(0), rtol=1e-6)
+    numpy.testing.assert_array_equal(num, (~masks[[2, 3, 4]]).sum(axis=0))
+
+
+def test_sliding_sky():
+    data, masks = create_frames()
+    windows = [[1, 2, 3], [0, 2, 3], [1, 3, 4], [2, 4, 5, 6],
+               [3, 5, 6, 7], [4, 6, 7]]
+
+    loaded = []
+
+    def load(idx):
+        loaded.append(idx)
+        return data[idx], masks[idx]
+
+    for nthreads in [1, 3]:
+        result = {}
+
+        def process(tid, sky, num):
+            result[tid] = sky, num
+
+        del loaded[:]
+        scales = sliding_sky(windows, load, process, nthreads=nthreads)
+        if nthreads == 1:
+            # each frame is loaded once
+            assert sorted(loaded) == list(range(8))
+        assert sorted(scales) == sorted(set(loaded))
+
+        for tid, window in enumerate(windows):
+            sky, num = result[tid]
+            esky, enum = reference_sky(data, masks, window)
+            numpy.testing.assert_allclose(sky, esky, rtol=1e-6)
+            numpy.testing.assert_array_equal(num, enum)
+
+
+def test_sky_cache_concurrent_loads():
+    """Different frames are loaded at the same time"""
+    data, masks = create_frames(nframes=2)
+    started = threading.Event()
+    overlapped = []
+
+    def load(idx):
+        if idx == 0:
+            overlapped.append(started.wait(5.0))
+        else:
+            started.set()
+        return data[idx], masks[idx]
+
+    cache = SkyFrameCache(load, [[0, 1]])
+    threads = [threading.Thread(target=cache.get, args=(idx,))
+               for idx in [0, 1]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert overlapped == [True]
+    assert len(cache) == 2
+    assert cache.get(0) is cache.get(0)
+
+
+def test_sky_cache_released(monkeypatch):
+    """Frames are released while the windows slide"""
+    ntargets = 60
+    data, masks = create_frames(nframes=ntargets, shape=(5, 6))
+    windows = [[idx for idx in range(tid - 3, tid + 4)
+                if 0 <= idx < ntargets and idx != tid]
+               for tid in range(ntargets)]
+    caches = []
+
+    class RecordedCache(SkyFrameCache):
+        def __init__(self, *args, **kwds):
+            super(RecordedCache, self).__init__(*args, **kwds)
+            caches.append(self)
+
+    monkeypatch.setattr(sky, 'SkyFrameCache', RecordedCache)
+
+    def load(idx):
+        return data[idx], masks[idx]
+
+    for nthreads in [1, 2, 3]:
+        sizes = []
+
+        def process(tid, values, num):
+            sizes.append(len(caches[-1]))
+
+        sliding_sky(windows, load, process, nthreads=nthreads)
+        # one window of frames for each thread, and for each boundary
+        # between blocks, the frames kept for the other thread
+        assert max(sizes) <= (2 * nthreads - 1) * 7
+        assert len(caches[-1]) == 0
+
+
+def test_running_median_nan():
+    data, masks = create_frames(nframes=4)
+    values = numpy.where(masks, numpy.inf, data).astype('float32')
+    values[0, 5, 6] = numpy.nan
+    values[2, 7, 8] = -numpy.inf
+    masks[0, 5, 6] = True
+    masks[2, 7, 8] = True
+    running = RunningMedian(data.shape[1:])
+    for idx in range(4):
+        running.add(values[idx])
+    running.remove(values[0])
+
+    sky, num = running.median()
+    expected = numpy.ma.median(
+        numpy.ma.array(data[1:], mask=masks[1:]), axis=0)
+    numpy.testing.assert_allclose(sky, expected.filled(0), rtol=1e-6)
+    numpy.testing.assert_array_equal(num, (~masks[1:]).sum(axis=0))
@@ -0,0 +1,105 @@
+import numpy
+import pytest
+
+from ..stacking import mean, median, sigmaclip, quantileclip
+
+
+def _frames(nframes=7, shape=(30, 20), seed=3):
+    rng = numpy.random.RandomState(seed)
+    arrays = [rng.normal(100, 5, size=shape).astype('float32')
+              for _ in range(nframes)]
+    masks = [rng.uniform(size=shape) < 0.2 for _ in range(nframes)]
+    return arrays, masks
+
+
+def _reference(arrays, masks, func):
+    data = numpy.ma.array(arrays, mask=masks)
+    result = numpy.zeros((3,) + arrays[0].shape)
+    for idx in numpy.ndindex(arrays[0].shape):
+        values = data[(slice(None),) + idx].compressed().astype('float64')
+        if len(values) > 0:
+            result[(slice(None),) + idx] = func(values)
+    return result
+
+
+def test_median():
+    arrays, masks = _frames()
+
+    def ref(values):
+        var = values.var(ddof=1) / 0.637 if len(values) > 1 else 0.0
+        return numpy.median(values), var, len(values)
+
+    expected = _reference(arrays, masks, ref)
+    # integer masks, threads and blocks of rows give the same result
+    out1 = median(arrays, masks=masks, dtype='float64')
+    out2 = median(arrays, masks=[m.astype('int16') for m in masks],
+                  dtype='float64', nthreads=3, tile=7)
+    numpy.testing.assert_allclose(out1, expected, rtol=1e-5)
+    numpy.testing.assert_array_equal(out1, out2)
+
+
+def test_mean_scales_zeros():
+    arrays, masks = _frames(nframes=4)
+    zeros = [1.0, 2.0, 3.0, 4.0]
+    scales = [1.0, 2.0, 0.5, 1.0]
+    out = mean(arrays, masks=masks, zeros=zeros, scales=scales,
+               dtype='float64')
+    converted = [(a - z) / s for a, z, s in zip(arrays, zeros, scales)]
+
+    def ref(values):
+        var = values.var(ddof=1) if len(values) > 1 else 0.0
+        return values.mean(), var, len(values)
+
+    expected = _reference(converted, masks, ref)
+    numpy.testing.assert_allclose(out, expected, rtol=1e-5, atol=1e-6)
+
+
+def test_quantileclip():
+    arrays, masks = _frames(nframes=10)
+    out = quantileclip(arrays, masks=masks, fclip=0.1, dtype='float64')
+
+    def ref(values):
+        nclip = int(numpy.ceil(len(values) * 0.1))
+        values = numpy.sort(values)[nclip:len(values) - nclip]
+        var = values.var(ddof=1) if len(values) > 1 else 0.0
+        return values.mean(), var, len(values)
+
+    expected = _reference(arrays, masks, ref)
+    numpy.testing.assert_allclose(out, expected, rtol=1e-5)
+
+    with pytest.raises(ValueError):
+        quantileclip(arrays, fclip=0.5)
+
+
+def test_quantileclip_rejects_outlier():
+    values = list(range(1, 9)) + [100]
+    arrays = [numpy.full((2, 3), v, dtype='float32') for v in values]
+    out = quantileclip(arrays, fclip=0.1, dtype='float64')
+    # one point rejected on each end
+    numpy.testing.assert_allclose(out[0], 5.0)
+    numpy.testing.assert_allclose(out[1], numpy.var(range(2, 9), ddof=1))
+    numpy.testing.assert_array_equal(out[2], 7)
+
+    # 30 * 0.1 is 3, not 3.0000000000000004 rounded up
+    out = quantileclip(arrays[:6] * 5, fclip=0.1, dtype='float64')
+    numpy.testing.assert_array_equal(out[2], 24)
+
+
+def test_sigmaclip_rejects_outliers():
+    arrays, _ = _frames(nframes=9, shape=(5, 6))
+    arrays[4] = arrays[4] + 1000
+    out = sigmaclip(arrays, low=2.5, high=2.5, dtype='float64')
+    good = numpy.array(arrays[:4] + arrays[5:], dtype='float64')
+    numpy.testing.assert_array_equal(out[2], 8)
+    numpy.testing.assert_allclose(out[0], good.mean(axis=0), rtol=1e-6)
+
+
+def test_negative_weights_are_ignored():
+    arrays, masks = _frames(nframes=5)
+    weights = [1, 1, -1, 1, 1]
+    out = median(arrays, masks=masks, weights=weights, dtype='float64')
+    used = [0, 1, 3, 4]
+    expected = median([arrays[i] for i in used],
+                      masks=[masks[i] for i in used], dtype='float64')
+    numpy.testing.assert_allclose(out[0], expected[0])
+    numpy.testing.assert_array_equal(out[2], expected[2])
@@ -0,0 +1,71 @@
+
+import os
+
+import numpy
+from astropy.io import fits
+
+from ..store import IntermediateStore
+
+
+def test_store_memory():
+    store = IntermediateStore()
+    data = numpy.arange(12, dtype='float32').reshape(3, 4)
+    store.put('a.fits', data)
+    assert 'a.fits' in store
+    assert store.nbytes == data.nbytes
+
+    store.copy('a.fits', 'b.fits')
+    with store.open('b.fits', mode='update') as hdulist:
+        hdulist['primary'].data -= 1
+
+    numpy.testing.assert_array_equal(store.getdata('a.fits'), data)
+    numpy.testing.assert_array_equal(store.getdata('b.fits'), data - 1)
+
+    store.rename('b.fits', 'c.fits')
+    assert 'b.fits' not in store
+    numpy.testing.assert_array_equal(store.getdata('c.fits'), data - 1)
+    assert store.nbytes == 2 * data.nbytes
+    # nothing written
+    assert not os.path.exists('a.fits')
+    store.close()
+
+
+def test_store_spill(tmpdir):
+    store = IntermediateStore(budget=250, spilldir=str(tmpdir))
+    rng = numpy.random.RandomState(3)
+    images = {}
+    for idx in range(4):
+        name = 'frame%d.fits' % idx
+        images[name] = rng.normal(size=(5, 5))
+        store.put(name, images[name])
+        assert store.nbytes <= 250
+
+    for name in sorted(images):
+        # lossless round trip
+        data = store.getdata(name)
+        assert data.dtype.newbyteorder('=') == images[name].dtype
+        numpy.testing.assert_array_equal(data, images[name])
+        assert store.nbytes <= 250
+
+    # spilled images are mapped, not read back in the store
+    nbytes = store.nbytes
+    spilled = [name for name in sorted(images)
+               if isinstance(store.source(name), str)]
+    assert spilled
+    for name in sorted(images):
+        numpy.testing.assert_array_equal(store.mapped(name), images[name])
+    assert store.nbytes == nbytes
+    for name in spilled:
+        assert isinstance(store.source(name), str)
+
+    store.close()
+    assert tmpdir.listdir() == []
+
+
+def test_store_reads_files(tmpdir):
+    name = str(tmpdir.join('raw.fits'))
+    data = numpy.ones((3, 3), dtype='int16')
+    fits.writeto(name, data)
+    store = IntermediateStore()
+    assert name not in store
+    numpy.testing.assert_array_equal(store.getdata(name), data)
@@ -0,0 +1,116 @@
+
+import numpy
+from astropy.io import fits
+from numina.array.combine import flatcombine
+
+from emirdrp.instrument.channels import FULL
+from ..store import IntermediateStore
+from ..superflat import channel_tiles, frame_scales, combine_superflat
+
+
+def test_channel_tiles():
+    shape = (2048, 2048)
+    tiles = channel_tiles(shape, FULL)
+    assert len(tiles) == 32
+    covered = numpy.zeros(shape, dtype='int')
+    for tile in tiles:
+        covered[tile] += 1
+    assert numpy.all(covered == 1)
+
+    # a window not covered by the channels
+    tiles = channel_tiles((1100, 300), FULL)
+    covered = numpy.zeros((1100, 300), dtype='int')
+    for tile in tiles:
+        covered[tile] += 1
+    assert numpy.all(covered == 1)
+
+
+def test_combine_superflat(tmpdir):
+    rng = numpy.random.RandomState(12)
+    shape = (60, 50)
+    region = (slice(5, 45), slice(10, 40))
+    channels = [(slice(0, 20), slice(0, 30)), (slice(20, 40), slice(0, 15))]
+
+    names = []
+    masks = []
+    datas = []
+    for idx in range(5):
+        data = rng.normal(100.0 * (idx + 1), 5.0, size=shape)
+        mask = (rng.uniform(size=shape) < 0.1).astype('int16')
+        name = str(tmpdir.join('frame%d.fits' % idx))
+        mname = str(tmpdir.join('mask%d.fits' % idx))
+        fits.writeto(name, data)
+        fits.writeto(mname, mask)
+        names.append(name)
+        masks.append(mname)
+        datas.append((data[region], mask[region]))
+
+    regions = [region] * len(names)
+    vshape = datas[0][0].shape
+    tiles = channel_tiles(vshape, channels)
+
+    scales = frame_scales(names, masks, regions, tiles, step=1)
+    for scale, (data, mask) in zip(scales, datas):
+        assert numpy.allclose(scale, numpy.median(data[mask == 0]))
+
+    # one in ten unmasked pixels, the same pixels in several tiles
+    whole = [tuple(slice(0, side) for side in vshape)]
+    for sample_tiles in [whole, tiles]:
+        sampled = frame_scales(names, masks, regions, sample_tiles, step=10)
+        for scale, (data, mask) in zip(sampled, datas):
+            assert scale == numpy.median(data[mask == 0][::10])
+    sampled = frame_scales(names, masks, regions, tiles, step=10, nprocs=2)
+    for scale, (data, mask) in zip(sampled, datas):
+        assert scale == numpy.median(data[mask == 0][::10])
+
+    result = combine_superflat(names, masks, regions, vshape, tiles, scales,
+                               blank=1.0 / scales[0])
+    expected = flatcombine([d for d, _ in datas], [m for _, m in datas],
+                           scales=scales, blank=1.0 / scales[0])
+    numpy.testing.assert_allclose(result, expected)
+
+    # masks in memory and a pool of processes
+    amasks = [m for _, m in datas]
+    result = combine_superflat(names, amasks, regions, vshape, tiles, scales,
+                               blank=1.0 / scales[0], nprocs=2)
+    numpy.testing.assert_allclose(result, expected)
+
+
+def test_superflat_from_store(tmpdir):
+    """The frames spilled by the store are read by tiles"""
+    rng = numpy.random.RandomState(7)
+    shape = (60, 50)
+    region = (slice(5, 45), slice(10, 40))
+    channels = [(slice(0, 20), slice(0, 30)), (slice(20, 40), slice(0, 30))]
+    budget = 40000
+    store = IntermediateStore(budget=budget, spilldir=str(tmpdir))
+
+    datas = []
+    for idx in range(5):
+        data = rng.normal(100.0 * (idx + 1), 5.0, size=shape)
+        mask = (rng.uniform(size=shape) < 0.1).astype('int16')
+        store.put('frame%d.fits' % idx, data)
+        store.put('mask%d.fits' % idx, mask)
+        datas.append((data[region], mask[region]))
+    assert store.nbytes <= budget
+
+    frames = [store.source('frame%d.fits' % idx, region) for idx in range(5)]
+    masks = [store.source('mask%d.fits' % idx, region) for idx in range(5)]
+    # some frames are read from the spilled files
+    assert any(isinstance(frame, str) for frame in frames)
+
+    regions = [region] * len(frames)
+    vshape = datas[0][0].shape
+    tiles = channel_tiles(vshape, channels)
+    scales = frame_scales(frames, masks, regions, tiles, step=1)
+    assert store.nbytes <= budget
+    result = combine_superflat(frames, masks, regions, vshape, tiles, scales,
+                               blank=1.0 / scales[0])
+    assert store.nbytes <= budget
+
+    for scale, (data, mask) in zip(scales, datas):
+        assert numpy.allclose(scale, numpy.median(data[mask == 0]))
+    expected = flatcombine([d for d, _ in datas], [m for _, m in datas],
+                           scales=scales, blank=1.0 / scales[0])
+    numpy.testing.assert_allclose(result, expected)
+    store.close()
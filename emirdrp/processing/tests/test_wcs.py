@@ -0,0 +1,103 @@
+
+import pytest
+
+import numpy
+import astropy.wcs
+import astropy.io.fits as fits
+
+from ..wcs import offsets_from_wcs_imgs, reference_pix_from_wcs_imgs
+from ..wcs import tan_params_from_header
+
+
+def create_header(crval, crpix=(1024.5, 1024.5), angle=0.0, pc=False, sip=False):
+    scale = 0.2 / 3600.0
+    cs = numpy.cos(numpy.deg2rad(angle))
+    sn = numpy.sin(numpy.deg2rad(angle))
+    hdr = fits.Header()
+    hdr['CTYPE1'] = 'RA---TAN-SIP' if sip else 'RA---TAN'
+    hdr['CTYPE2'] = 'DEC--TAN-SIP' if sip else 'DEC--TAN'
+    hdr['CRPIX1'] = crpix[0]
+    hdr['CRPIX2'] = crpix[1]
+    hdr['CRVAL1'] = crval[0]
+    hdr['CRVAL2'] = crval[1]
+    if pc:
+        hdr['CDELT1'] = -scale
+        hdr['CDELT2'] = scale
+        hdr['PC1_1'] = cs
+        hdr['PC1_2'] = -sn
+        hdr['PC2_1'] = sn
+        hdr['PC2_2'] = cs
+    else:
+        hdr['CD1_1'] = -scale * cs
+        hdr['CD1_2'] = scale * sn
+        hdr['CD2_1'] = scale * sn
+        hdr['CD2_2'] = scale * cs
+    if sip:
+        hdr['A_ORDER'] = 2
+        hdr['B_ORDER'] = 2
+        hdr['A_2_0'] = 1e-6
+        hdr['B_0_2'] = -1e-6
+    return hdr
+
+
+def create_imgs(dec, **kwds):
+    offsets = [(0, 0), (10, 5), (-20, 30), (3.3, -7.1)]
+    imgs = []
+    for dra, ddec in offsets:
+        crval = (150.0 + dra / 3600.0 / numpy.cos(numpy.deg2rad(dec)),
+                 dec + ddec / 3600.0)
+        hdu = fits.PrimaryHDU(header=create_header(crval, **kwds))
+        imgs.append(fits.HDUList([hdu]))
+    return imgs
+
+
+def offsets_astropy(imgs, pixref):
+    result = numpy.zeros((len(imgs), 2))
+    wcsh = astropy.wcs.WCS(imgs[0][0].header)
+    skyref = wcsh.wcs_pix2world(pixref, 1)
+    for idx, img in enumerate(imgs[1:], 1):
+        wcsh = astropy.wcs.WCS(img[0].header)
+        pixval = wcsh.wcs_world2pix(skyref, 1)
+        result[idx] = -(pixval[0] - pixref[0])
+    return result
+
+
+@pytest.mark.parametrize("dec", [-30.0, 2.0, 75.0])
+@pytest.mark.parametrize("angle", [0.0, 37.0])
+@pytest.mark.parametrize("pc", [True, False])
+def test_offsets_tan(dec, angle, pc):
+    imgs = create_imgs(dec, angle=angle, pc=pc)
+    assert tan_params_from_header(imgs[0][0].header) is not None
+    pixref = numpy.array([[1024.0, 1024.0]])
+
+    expected = offsets_astropy(imgs, pixref)
+    computed = offsets_from_wcs_imgs(imgs, pixref)
+
+    assert numpy.allclose(expected, computed, atol=1e-6)
+
+
+def test_offsets_sip():
+    imgs = create_imgs(20.0, sip=True)
+    assert tan_params_from_header(imgs[0][0].header) is None
+    pixref = numpy.array([[1024.0, 1024.0]])
+
+    expected = offsets_astropy(imgs, pixref)
+    computed = offsets_from_wcs_imgs(imgs, pixref)
+
+    assert numpy.allclose(expected, computed, atol=1e-6)
+
+
+@pytest.mark.parametrize("origin", [0, 1])
+def test_reference_pix(origin):
+    imgs = create_imgs(-45.0, angle=10.0)
+    pixref = (1000.0, 1010.0)
+
+    computed = reference_pix_from_wcs_imgs(imgs, pixref, origin=origin)
+
+    wcsh = astropy.wcs.WCS(imgs[0][0].header)
+    skyref = wcsh.wcs_pix2world([pixref], origin)
+    assert computed[0] == pixref
+    for img, pix in zip(imgs[1:], computed[1:]):
+        wcsh = astropy.wcs.WCS(img[0].header)
+        expected = wcsh.wcs_world2pix(skyref, origin)[0]
+        assert numpy.allclose(expected, pix, atol=1e-6)
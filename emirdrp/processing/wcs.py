@@ -17,8 +17,150 @@
 # along with PyEmir.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+"""Offsets between frames using WCS information"""
+
+import collections
+import logging
+
+import six
 import numpy
 from astropy import wcs
+from astropy.io import fits
+
+from emirdrp.processing.headers import get_header, dframe_headers
+
+_logger = logging.getLogger(__name__)
+
+
+TanParams = collections.namedtuple('TanParams', ['crpix', 'crval', 'cd'])
+
+# Keywords that mean that the WCS is not a plain TAN projection
+_DISTORTION_KEYS = ['A_ORDER', 'B_ORDER', 'AP_ORDER', 'BP_ORDER',
+                    'D2IMDIS1', 'D2IMDIS2', 'CPDIS1', 'CPDIS2',
+                    'LONPOLE', 'LATPOLE']
+
+
+def frame_header(frame):
+    """Primary header of a frame, reading only the header if in disk.
+
+    :parameter frame: a filename, a HDUList or a DataFrame
+    """
+    if isinstance(frame, six.string_types):
+        return get_header(frame)
+    if isinstance(frame, fits.HDUList):
+        return frame[0].header
+    return dframe_headers(frame)[0]
+
+
+def tan_params_from_header(hdr):
+    """Extract the parameters of a TAN WCS from a header.
+
+    Returns a TanParams, or None if the WCS is not a TAN
+    projection without distortions.
+    """
+    ctype1 = hdr.get('CTYPE1', '')
+    ctype2 = hdr.get('CTYPE2', '')
+    if ctype1 != 'RA---TAN' or ctype2 != 'DEC--TAN':
+        return None
+    if hdr.get('WCSAXES', 2) != 2:
+        return None
+    for key in _DISTORTION_KEYS:
+        if key in hdr:
+            return None
+    for key in hdr:
+        if key.startswith('PV'):
+            return None
+    for idx in [1, 2]:
+        if hdr.get('CUNIT%d' % idx, 'deg').strip() not in ['deg', '']:
+            return None
+
+    crpix = [hdr.get('CRPIX1', 0.0), hdr.get('CRPIX2', 0.0)]
+    crval = [hdr.get('CRVAL1', 0.0), hdr.get('CRVAL2', 0.0)]
+    if any(key in hdr for key in ['CD1_1', 'CD1_2', 'CD2_1', 'CD2_2']):
+        cd = [[hdr.get('CD1_1', 0.0), hdr.get('CD1_2', 0.0)],
+              [hdr.get('CD2_1', 0.0), hdr.get('CD2_2', 0.0)]]
+    else:
+        pc = [[hdr.get('PC1_1', 1.0), hdr.get('PC1_2', 0.0)],
+              [hdr.get('PC2_1', 0.0), hdr.get('PC2_2', 1.0)]]
+        cdelt = [hdr.get('CDELT1', 1.0), hdr.get('CDELT2', 1.0)]
+        cd = numpy.asarray(cdelt)[:, numpy.newaxis] * numpy.asarray(pc)
+    return TanParams(numpy.asarray(crpix, dtype='float64'),
+                     numpy.asarray(crval, dtype='float64'),
+                     numpy.asarray(cd, dtype='float64'))
+
+
+def tan_pix2world(params, pix, origin=1):
+    """Sky coordinates (deg) of pixels, for a TAN projection."""
+    pix = numpy.asarray(pix, dtype='float64')
+    dp = pix - params.crpix + (1 - origin)
+    xi, eta = numpy.deg2rad(numpy.dot(dp, params.cd.T)).T
+    ra0, dec0 = numpy.deg2rad(params.crval)
+    den = numpy.cos(dec0) - eta * numpy.sin(dec0)
+    ra = ra0 + numpy.arctan2(xi, den)
+    dec = numpy.arctan2(eta * numpy.cos(dec0) + numpy.sin(dec0),
+                        numpy.hypot(xi, den))
+    ra = numpy.mod(numpy.rad2deg(ra), 360.0)
+    return numpy.column_stack([ra, numpy.rad2deg(dec)])
+
+
+def tan_world2pix_many(crpix, crval, cd, sky, origin=1):
+    """Pixel coordinates of a sky position in many TAN projections.
+
+    *crpix* and *crval* have shape (n, 2) and *cd* (n, 2, 2).
+    Returns an array of shape (n, 2).
+    """
+    ra, dec = numpy.deg2rad(sky)
+    ra0 = numpy.deg2rad(crval[:, 0])
+    dec0 = numpy.deg2rad(crval[:, 1])
+    dra = ra - ra0
+    cosd, sind = numpy.cos(dec), numpy.sin(dec)
+    den = sind * numpy.sin(dec0) + cosd * numpy.cos(dec0) * numpy.cos(dra)
+    xi = cosd * numpy.sin(dra) / den
+    eta = (sind * numpy.cos(dec0) - cosd * numpy.sin(dec0) * numpy.cos(dra)) / den
+    inter = numpy.rad2deg(numpy.column_stack([xi, eta]))
+    dp = numpy.linalg.solve(cd, inter[:, :, numpy.newaxis])[:, :, 0]
+    return dp + crpix - (1 - origin)
+
+
+def pixel_positions_from_wcs(headers, pixref, origin=1):
+    """Position in each frame of the sky position of pixref in the first.
+
+    The WCS parameters of all the headers are extracted in one pass
+    and the positions are computed with a vectorized TAN projection.
+    astropy.wcs is used only for headers with other projections or
+    with distortions.
+
+    :parameter headers: sequence of FITS headers
+    :parameter pixref: (x, y) pixel in the first frame
+    :return: array of shape (len(headers), 2)
+    """
+    pixref = numpy.asarray(pixref, dtype='float64').reshape(2)
+    params = [tan_params_from_header(hdr) for hdr in headers]
+
+    if params[0] is not None:
+        skyref = tan_pix2world(params[0], [pixref], origin)[0]
+    else:
+        _logger.debug('reference WCS is not TAN, using astropy.wcs')
+        wcsh = wcs.WCS(headers[0])
+        skyref = wcsh.wcs_pix2world([pixref], origin)[0]
+
+    result = numpy.empty((len(headers), 2))
+    result[0] = pixref
+
+    tan_idx = [idx for idx, par in enumerate(params[1:], 1) if par is not None]
+    if tan_idx:
+        crpix = numpy.array([params[idx].crpix for idx in tan_idx])
+        crval = numpy.array([params[idx].crval for idx in tan_idx])
+        cd = numpy.array([params[idx].cd for idx in tan_idx])
+        result[tan_idx] = tan_world2pix_many(crpix, crval, cd, skyref, origin)
+
+    for idx, par in enumerate(params[1:], 1):
+        if par is None:
+            _logger.debug('WCS of frame %d is not TAN, using astropy.wcs', idx)
+            wcsh = wcs.WCS(headers[idx])
+            result[idx] = wcsh.wcs_world2pix([skyref], origin)[0]
+
+    return result
 
 
 def offsets_from_wcs(frames, pixref):
@@ -39,34 +181,21 @@ def offsets_from_wcs(frames, pixref):
 
     '''
 
-    result = numpy.zeros((len(frames), pixref.shape[1]))
-
-    with frames[0].open() as hdulist:
-        wcsh = wcs.WCS(hdulist[0].header)
-        skyref = wcsh.wcs_pix2world(pixref, 1)
-
-    for idx, frame in enumerate(frames[1:]):
-        with frame.open() as hdulist:
-            wcsh = wcs.WCS(hdulist[0].header)
-            pixval = wcsh.wcs_world2pix(skyref, 1)
-            result[idx + 1] = -(pixval[0] - pixref[0])
-
-    return result
+    headers = [frame_header(frame) for frame in frames]
+    return _offsets_from_headers(headers, pixref)
 
 
 def offsets_from_wcs_imgs(imgs, pixref):
 
-    result = numpy.zeros((len(imgs), pixref.shape[1]))
+    headers = [img[0].header for img in imgs]
+    return _offsets_from_headers(headers, pixref)
 
-    ref = imgs[0]
-    wcsh = wcs.WCS(ref[0].header)
-    skyref = wcsh.wcs_pix2world(pixref, 1)
-
-    for idx, img in enumerate(imgs[1:]):
-        wcsh = wcs.WCS(img[0].header)
-        pixval = wcsh.wcs_world2pix(skyref, 1)
-        result[idx + 1] = -(pixval[0] - pixref[0])
 
+def _offsets_from_headers(headers, pixref):
+    pixref = numpy.asarray(pixref)
+    pixval = pixel_positions_from_wcs(headers, pixref[0], origin=1)
+    result = -(pixval - pixref[0])
+    result[0] = 0
     return result
 
 
@@ -83,20 +212,8 @@ def reference_pix_from_wcs(frames, pixref, origin=1):
 
     """
 
-    result = []
-
-    with frames[0].open() as hdulist:
-        wcsh = wcs.WCS(hdulist[0].header)
-        skyref = wcsh.wcs_pix2world([pixref], origin)
-        result.append(pixref)
-
-    for idx, frame in enumerate(frames[1:]):
-        with frame.open() as hdulist:
-            wcsh = wcs.WCS(hdulist[0].header)
-            pixval = wcsh.wcs_world2pix(skyref, origin)
-            result.append(tuple(pixval[0]))
-
-    return result
+    headers = [frame_header(frame) for frame in frames]
+    return _reference_pix_from_headers(headers, pixref, origin)
 
 
 def reference_pix_from_wcs_imgs(imgs, pixref, origin=1):
@@ -112,17 +229,12 @@ def reference_pix_from_wcs_imgs(imgs, pixref, origin=1):
 
     """
 
-    result = []
-
-    refimg = imgs[0]
-
-    wcsh = wcs.WCS(refimg[0].header)
-    skyref = wcsh.wcs_pix2world([pixref], origin)
-    result.append(pixref)
+    headers = [img[0].header for img in imgs]
+    return _reference_pix_from_headers(headers, pixref, origin)
 
-    for idx, img in enumerate(imgs[1:]):
-        wcsh = wcs.WCS(img[0].header)
-        pixval = wcsh.wcs_world2pix(skyref, origin)
-        result.append(tuple(pixval[0]))
 
+def _reference_pix_from_headers(headers, pixref, origin):
+    pixval = pixel_positions_from_wcs(headers, pixref, origin=origin)
+    result = [pixref]
+    result.extend(tuple(val) for val in pixval[1:])
     return result
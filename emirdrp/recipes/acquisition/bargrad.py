@@ -26,7 +26,6 @@ from numina.array.utils import coor_to_pix_1d
 from numina.core import Requirement, Product, Parameter, RecipeError
 from numina.core.products import ArrayType
 from numina.core.requirements import ObservationResultRequirement
-from scipy.ndimage import convolve1d
 from scipy.ndimage.filters import median_filter
 
 import emirdrp.datamodel as datamodel
@@ -35,6 +34,8 @@ from emirdrp.core import EmirRecipe, EMIR_PIXSCALE, EMIR_NBARS, EMIR_RON
 from emirdrp.processing.combine import basic_processing_with_combination
 from emirdrp.products import DataFrameType, NominalPositions
 from emirdrp.recipes.aiv.bardetect import char_bar_peak_l, char_bar_peak_r
+from emirdrp.recipes.aiv.bardetect import derivative_bands, merge_bands
+from emirdrp.recipes.aiv.bardetect import savgol_derivative_kernel
 from emirdrp.requirements import MasterBadPixelMaskRequirement
 from emirdrp.requirements import MasterBiasRequirement
 from emirdrp.requirements import MasterDarkRequirement
@@ -185,136 +186,149 @@ class BarDetectionRecipe(EmirRecipe):
         # scipy >= xx has a savgol_filter function
         # for compatibility we do it manually
 
-        allpos = {}
-        ypos3_kernel = None
+        kernel_sizes = [3, 5, 7, 9]
         slits = numpy.zeros((EMIR_NBARS, 8), dtype='float')
 
+        # Reference positions of all the bars, transformed to REAL at once
+        params = numpy.asarray(barstab, dtype='float')
+        pars_l = params[:EMIR_NBARS]
+        pars_r = params[EMIR_NBARS:2 * EMIR_NBARS]
+        lbarids = pars_l[:, 0].astype('int')
+        csupos_a = numpy.asarray(csupos, dtype='float')
+        refs_y_virt = pars_l[:, 1]
+        refs_x_l_virt = pars_l[:, 3] + csupos_a[lbarids - 1] * pars_l[:, 2]
+        refs_x_r_virt = (pars_r[:, 3] +
+                         csupos_a[lbarids + EMIR_NBARS - 1] * pars_r[:, 2])
+        refs_x_l, refs_y_l = dist.exvp(refs_x_l_virt, refs_y_virt)
+        refs_x_r, refs_y_r = dist.exvp(refs_x_r_virt, refs_y_virt)
+
+        # minimal width of the slit
+        minwidth = 0.9
+        prows = [coor_to_pix_1d(y) - 1 for y in refs_y_l]
+        inside = (refs_y_l < 2047) & (refs_y_l > 1)
+        wide = numpy.abs(refs_x_l_virt - refs_x_r_virt) >= minwidth
+        # The derivative is only needed in the rows around the bars
+        # used by char_bar_peak_*, up to 16 rows away along the slit
+        halfw = max(wy, 16) + 2
+        bands = merge_bands([(prows[idx] - halfw, prows[idx] + halfw + 1)
+                             for idx in range(EMIR_NBARS)
+                             if inside[idx] and wide[idx]],
+                            arr_median.shape[0])
+        self.logger.debug('derivative computed in %d bands of rows',
+                          len(bands))
+
+        self.logger.info('derive image in X direction')
+        for ks in kernel_sizes:
+            self.logger.debug('kernel size %d, weights are %s', ks,
+                              savgol_derivative_kernel(ks))
+        derivs = derivative_bands(arr_median, bands, kernel_sizes)
+        for ks in kernel_sizes:
+            self.save_intermediate_array(derivs[ks],
+                                         'deriv_image_k%d.fits' % ks)
+
         self.logger.info('find peaks in derivative image')
-        for ks in [3, 5, 7, 9]:
-            self.logger.debug('kernel size is %d', ks)
-            # S and G kernel for derivative
-            kw = ks * (ks*ks-1) / 12.0
-            coeffs_are = -numpy.arange((1-ks)//2, (ks-1)//2 + 1) / kw
-            if ks == 3:
-                ypos3_kernel = coeffs_are
-            self.logger.debug('kernel weights are %s', coeffs_are)
-
-            self.logger.debug('derive image in X direction')
-            arr_deriv = convolve1d(arr_median, coeffs_are, axis=-1)
-            self.save_intermediate_array(arr_deriv, 'deriv_image_k%d.fits' % ks)
-            # Axis 0 is
-            #
-            # self.logger.debug('derive image in Y direction (with kernel=3)')
-            # arr_deriv_alt = convolve1d(arr_median_alt, ypos3_kernel, axis=0)
-
-            positions = []
-            self.logger.info('using bar parameters')
-            for idx in range(EMIR_NBARS):
-                params_l = barstab[idx]
-                params_r = barstab[idx + EMIR_NBARS]
-                lbarid = int(params_l[0])
-
-                # CSUPOS for this bar
-                rbarid = lbarid + EMIR_NBARS
-                current_csupos_l = csupos[lbarid - 1]
-                current_csupos_r = csupos[rbarid - 1]
-                self.logger.debug('CSUPOS for bar %d is %f', lbarid, current_csupos_l)
-                self.logger.debug('CSUPOS for bar %d is %f', rbarid, current_csupos_r)
-
-                ref_y_coor_virt = params_l[1] # Do I need to add vec[1]?
-                ref_x_l_coor_virt = params_l[3] + current_csupos_l * params_l[2]
-                ref_x_r_coor_virt = params_r[3] + current_csupos_r * params_r[2]
-                # Transform to REAL..
-                ref_x_l_coor, ref_y_l_coor = dist.exvp(ref_x_l_coor_virt, ref_y_coor_virt)
-                ref_x_r_coor, ref_y_r_coor = dist.exvp(ref_x_r_coor_virt, ref_y_coor_virt)
+        positions = dict((ks, []) for ks in kernel_sizes)
+        self.logger.info('using bar parameters')
+        for idx in range(EMIR_NBARS):
+            lbarid = int(lbarids[idx])
+
+            # CSUPOS for this bar
+            rbarid = lbarid + EMIR_NBARS
+            self.logger.debug('CSUPOS for bar %d is %f', lbarid, csupos[lbarid - 1])
+            self.logger.debug('CSUPOS for bar %d is %f', rbarid, csupos[rbarid - 1])
+
+            ref_y_coor_virt = refs_y_virt[idx] # Do I need to add vec[1]?
+            ref_x_l_coor_virt = refs_x_l_virt[idx]
+            ref_x_r_coor_virt = refs_x_r_virt[idx]
+            # REAL positions
+            ref_x_l_coor, ref_y_l_coor = refs_x_l[idx], refs_y_l[idx]
+            ref_x_r_coor, ref_y_r_coor = refs_x_r[idx], refs_y_r[idx]
+            # FIXME: check if DTU has to be applied
+            # ref_y_coor = ref_y_coor + vec[1]
+            prow = prows[idx]
+            fits_row = prow + 1 # FITS pixel index
+
+            # A function that returns the center of the bar
+            # given its X position
+            def center_of_bar_l(x):
+                # Pixel values are 0-based
+                # return ref_y_coor + vec[1] - 1
                 # FIXME: check if DTU has to be applied
-                # ref_y_coor = ref_y_coor + vec[1]
-                prow = coor_to_pix_1d(ref_y_l_coor) - 1
-                fits_row = prow + 1 # FITS pixel index
-
-                # A function that returns the center of the bar
-                # given its X position
-                def center_of_bar_l(x):
-                    # Pixel values are 0-based
-                    # return ref_y_coor + vec[1] - 1
-                    # FIXME: check if DTU has to be applied
-                    return ref_y_l_coor - 1
-
-                def center_of_bar_r(x):
-                    # Pixel values are 0-based
-                    # return ref_y_coor + vec[1] - 1
-                    # FIXME: check if DTU has to be applied
-                    return ref_y_r_coor - 1
-
-                self.logger.debug('looking for bars with ids %d - %d', lbarid, rbarid)
-                self.logger.debug('ref Y virtual position is %7.2f', ref_y_coor_virt)
-                self.logger.debug('ref X virtual positions are %7.2f %7.2f', ref_x_l_coor_virt, ref_x_r_coor_virt)
-                self.logger.debug('ref X positions are %7.2f %7.2f', ref_x_l_coor, ref_x_r_coor)
-                self.logger.debug('ref Y positions are %7.2f %7.2f', ref_y_l_coor, ref_y_r_coor)
-                # if ref_y_coor is outlimits, skip this bar
-                # ref_y_coor is in FITS format
-                if (ref_y_l_coor >= 2047) or (ref_y_l_coor <= 1):
-                    self.logger.debug('reference y position is outlimits, skipping')
-                    positions.append([lbarid, fits_row, fits_row, fits_row, 1, 1, 0, 3])
-                    positions.append([rbarid, fits_row, fits_row, fits_row, 1, 1, 0, 3])
-                    continue
+                return ref_y_l_coor - 1
 
-                # minimal width of the slit
-                minwidth = 0.9
-                if abs(ref_x_l_coor_virt - ref_x_r_coor_virt) < minwidth:
+            def center_of_bar_r(x):
+                # Pixel values are 0-based
+                # return ref_y_coor + vec[1] - 1
+                # FIXME: check if DTU has to be applied
+                return ref_y_r_coor - 1
+
+            self.logger.debug('looking for bars with ids %d - %d', lbarid, rbarid)
+            self.logger.debug('ref Y virtual position is %7.2f', ref_y_coor_virt)
+            self.logger.debug('ref X virtual positions are %7.2f %7.2f', ref_x_l_coor_virt, ref_x_r_coor_virt)
+            self.logger.debug('ref X positions are %7.2f %7.2f', ref_x_l_coor, ref_x_r_coor)
+            self.logger.debug('ref Y positions are %7.2f %7.2f', ref_y_l_coor, ref_y_r_coor)
+            # if ref_y_coor is outlimits, skip this bar
+            # ref_y_coor is in FITS format
+            if not inside[idx] or not wide[idx]:
+                if not inside[idx]:
+                    self.logger.debug('reference y position is outlimits, skipping')
+                else:
                     self.logger.debug('slit is less than %d virt pixels, skipping', minwidth)
-                    positions.append([lbarid, fits_row, fits_row, fits_row, 1, 1, 0, 3])
-                    positions.append([rbarid, fits_row, fits_row, fits_row, 1, 1, 0, 3])
-                    continue
+                for ks in kernel_sizes:
+                    positions[ks].append([lbarid, fits_row, fits_row, fits_row, 1, 1, 0, 3])
+                    positions[ks].append([rbarid, fits_row, fits_row, fits_row, 1, 1, 0, 3])
+                continue
+
+            # The search windows are the same for all the kernel sizes
+            # Dont add +1 to virtual pixels
+            regionw = 10
+            bstart1 = coor_to_pix_1d(ref_x_l_coor - regionw)
+            bend1 = coor_to_pix_1d(ref_x_l_coor + regionw) + 1
+            bstart2 = coor_to_pix_1d(ref_x_r_coor - regionw)
+            bend2 = coor_to_pix_1d(ref_x_r_coor + regionw) + 1
+
+            for ks in kernel_sizes:
+                self.logger.debug('kernel size is %d', ks)
+                arr_deriv = derivs[ks]
 
                 # Left bar
-                # Dont add +1 to virtual pixels
                 self.logger.debug('measure left border (%d)', lbarid)
-                regionw = 10
-                bstart1 = coor_to_pix_1d(ref_x_l_coor - regionw)
-                bend1 = coor_to_pix_1d(ref_x_l_coor + regionw) + 1
                 centery, centery_virt, xpos1, xpos1_virt, fwhm, st = char_bar_peak_l(arr_deriv,
                                                                      prow, bstart1, bend1, threshold,
                                                                      center_of_bar_l,
                                                                      wx=wx, wy=wy, wfit=wfit)
 
                 insert1 = [lbarid, centery + 1, centery_virt, fits_row, xpos1 + 1, xpos1_virt, fwhm, st]
-                positions.append(insert1)
+                positions[ks].append(insert1)
 
                 # Right bar
-                # Dont add +1 to virtual pixels
                 self.logger.debug('measure rigth border (%d)', rbarid)
-                bstart2 = coor_to_pix_1d(ref_x_r_coor - regionw)
-                bend2 = coor_to_pix_1d(ref_x_r_coor + regionw) + 1
                 centery, centery_virt, xpos2, xpos2_virt, fwhm, st = char_bar_peak_r(arr_deriv, prow, bstart2, bend2,
                                                                                      threshold,
                                                           center_of_bar_l, wx=wx, wy=wy, wfit=wfit)
                 # This centery/centery_virt should be equal to ref_y_coor_virt
                 insert2 = [rbarid, centery + 1, centery_virt, fits_row, xpos2 + 1, xpos2_virt, fwhm, st]
-                positions.append(insert2)
-
-                # FIXME: hardcoded value
-                y1_virt = ref_y_coor_virt - 16.242
-                y2_virt = ref_y_coor_virt + 16.242
-                _, y1 = dist.exvp(xpos1_virt + 1, y1_virt + 1)
-                _, y2 = dist.exvp(xpos2_virt + 1, y2_virt + 1)
-
-                # Update positions
+                positions[ks].append(insert2)
 
                 msg = 'bar %d, centroid-y %9.4f centroid-y virt %9.4f, ' \
                       'row %d, x-pos %9.4f x-pos virt %9.4f, FWHM %6.3f, status %d'
-                self.logger.debug(msg, *positions[-2])
-                self.logger.debug(msg, *positions[-1])
+                self.logger.debug(msg, *insert1)
+                self.logger.debug(msg, *insert2)
 
                 if ks == 5:
+                    # FIXME: hardcoded value
+                    y1_virt = ref_y_coor_virt - 16.242
+                    y2_virt = ref_y_coor_virt + 16.242
+                    _, (y1, y2) = dist.exvp([xpos1_virt + 1, xpos2_virt + 1],
+                                            [y1_virt + 1, y2_virt + 1])
                     slits[lbarid - 1] = numpy.array([xpos1, y2, xpos2, y2, xpos2, y1, xpos1, y1])
                     # FITS coordinates
                     slits[lbarid - 1] += 1.0
                     self.logger.debug('inserting bars %d-%d into "slits"', lbarid, rbarid)
 
-            allpos[ks] = numpy.asarray(positions, dtype='float') # GCS doesn't like lists of lists
-
-
+        # GCS doesn't like lists of lists
+        allpos = dict((ks, numpy.asarray(positions[ks], dtype='float'))
+                      for ks in kernel_sizes)
 
         return allpos, slits
 
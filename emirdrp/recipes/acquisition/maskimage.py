@@ -35,6 +35,8 @@ import emirdrp.requirements as reqs
 from emirdrp.core import EmirRecipe, EMIR_PIXSCALE, EMIR_NBARS, EMIR_RON
 from emirdrp.processing.combine import basic_processing_with_combination
 from emirdrp.recipes.aiv.bardetect import char_bar_peak_l, char_bar_peak_r, char_bar_height
+from emirdrp.recipes.aiv.bardetect import derivative_bands, merge_bands
+from emirdrp.recipes.aiv.bardetect import savgol_derivative_kernel
 
 
 class MaskImagingRecipe(EmirRecipe):
@@ -141,66 +143,84 @@ class MaskImagingRecipe(EmirRecipe):
         # scipy >= xx has a savgol_filter function
         # for compatibility we do it manually
 
-        allpos = {}
-        ypos3_kernel = None
+        kernel_sizes = [3, 5, 7, 9]
         slits = numpy.zeros((EMIR_NBARS, 8), dtype='float')
 
+        # Rows used by char_bar_peak_*, around the center of the bar
+        # along all the searched columns, up to 16 rows away
+        halfw = max(wy, 16) + 2
+        xcols = numpy.arange(bstart, bend)
+        intervals = []
+        for coords in barstab:
+            ref_y_coor = coords[1] + vec[1]
+            if (ref_y_coor >= 2047) or (ref_y_coor <= 1):
+                continue
+            prow = wc_to_pix_1d(ref_y_coor) - 1
+            ycen = polyval(xcols + 1 - vec[0], coords[2:]) + vec[1] - 1
+            lower = min(prow, int(numpy.floor(ycen.min())))
+            upper = max(prow, int(numpy.ceil(ycen.max())))
+            intervals.append((lower - halfw, upper + halfw + 1))
+        bands = merge_bands(intervals, arr_median.shape[0])
+        self.logger.debug('derivative computed in %d bands of rows',
+                          len(bands))
+
+        self.logger.debug('derive image in X direction')
+        for ks in kernel_sizes:
+            self.logger.debug('kernel size %d, weights are %s', ks,
+                              savgol_derivative_kernel(ks))
+        derivs = derivative_bands(arr_median, bands, kernel_sizes)
+        # Axis 0 is
+        #
+        self.logger.debug('derive image in Y direction (with kernel=3)')
+        arr_deriv_alt = convolve1d(arr_median_alt,
+                                   savgol_derivative_kernel(3), axis=0)
+
         self.logger.info('start finding bars')
-        for ks in [3, 5, 7, 9]:
-            self.logger.debug('kernel size is %d', ks)
-            # S and G kernel for derivative
-            kw = ks * (ks*ks-1) / 12.0
-            coeffs_are = -numpy.arange((1-ks)//2, (ks-1)//2 + 1) / kw
-            if ks == 3:
-                ypos3_kernel = coeffs_are
-            self.logger.debug('kernel weights are %s', coeffs_are)
-
-            self.logger.debug('derive image in X direction')
-            arr_deriv = convolve1d(arr_median, coeffs_are, axis=-1)
-            # Axis 0 is
-            #
-            self.logger.debug('derive image in Y direction (with kernel=3)')
-            arr_deriv_alt = convolve1d(arr_median_alt, ypos3_kernel, axis=0)
-
-            positions = []
-            for coords in barstab:
-                lbarid = int(coords[0])
-                rbarid = lbarid + EMIR_NBARS
-                ref_y_coor = coords[1] + vec[1]
-                poly_coeffs = coords[2:]
-                prow = wc_to_pix_1d(ref_y_coor) - 1
-                fits_row = prow + 1 # FITS pixel index
-
-                # A function that returns the center of the bar
-                # given its X position
-                def center_of_bar(x):
-                    # Pixel values are 0-based
-                    return polyval(x+1-vec[0], poly_coeffs) + vec[1] - 1
-
-                self.logger.debug('looking for bars with ids %d - %d', lbarid, rbarid)
-                self.logger.debug('reference y position is Y %7.2f', ref_y_coor)
-
-                # if ref_y_coor is outlimits, skip this bar
-                # ref_y_coor is in FITS format
-                if (ref_y_coor >= 2047) or (ref_y_coor <= 1):
-                    self.logger.debug('reference y position is outlimits, skipping')
-                    positions.append([lbarid, fits_row, fits_row, 1, 0, 3])
-                    positions.append([rbarid, fits_row, fits_row, 1, 0, 3])
-                    continue
+        positions = dict((ks, []) for ks in kernel_sizes)
+        for coords in barstab:
+            lbarid = int(coords[0])
+            rbarid = lbarid + EMIR_NBARS
+            ref_y_coor = coords[1] + vec[1]
+            poly_coeffs = coords[2:]
+            prow = wc_to_pix_1d(ref_y_coor) - 1
+            fits_row = prow + 1 # FITS pixel index
+
+            # A function that returns the center of the bar
+            # given its X position
+            def center_of_bar(x):
+                # Pixel values are 0-based
+                return polyval(x+1-vec[0], poly_coeffs) + vec[1] - 1
+
+            self.logger.debug('looking for bars with ids %d - %d', lbarid, rbarid)
+            self.logger.debug('reference y position is Y %7.2f', ref_y_coor)
+
+            # if ref_y_coor is outlimits, skip this bar
+            # ref_y_coor is in FITS format
+            if (ref_y_coor >= 2047) or (ref_y_coor <= 1):
+                self.logger.debug('reference y position is outlimits, skipping')
+                for ks in kernel_sizes:
+                    positions[ks].append([lbarid, fits_row, fits_row, 1, 0, 3])
+                    positions[ks].append([rbarid, fits_row, fits_row, 1, 0, 3])
+                continue
+
+            for ks in kernel_sizes:
+                self.logger.debug('kernel size is %d', ks)
+                arr_deriv = derivs[ks]
+                bar_pos = positions[ks]
 
                 # Left bar
                 self.logger.debug('measure left border (%d)', lbarid)
 
-                centery, xpos, fwhm, st = char_bar_peak_l(arr_deriv, prow, bstart, bend, threshold,
-                                                          center_of_bar, wx=wx, wy=wy, wfit=wfit)
+                centery, _, xpos, _, fwhm, st = char_bar_peak_l(arr_deriv, prow, bstart, bend, threshold,
+                                                                center_of_bar, wx=wx, wy=wy, wfit=wfit)
                 xpos1 = xpos
-                positions.append([lbarid, centery+1, fits_row, xpos+1, fwhm, st])
+                bar_pos.append([lbarid, centery+1, fits_row, xpos+1, fwhm, st])
 
                 # Right bar
                 self.logger.debug('measure rigth border (%d)', rbarid)
-                centery, xpos, fwhm, st = char_bar_peak_r(arr_deriv, prow, bstart, bend, threshold,
-                                                          center_of_bar, wx=wx, wy=wy, wfit=wfit)
-                positions.append([rbarid, centery+1, fits_row, xpos+1, fwhm, st])
+                centery, _, xpos, _, fwhm, st = char_bar_peak_r(arr_deriv, prow, bstart, bend, threshold,
+                                                                center_of_bar, wx=wx, wy=wy, wfit=wfit)
+                bar_pos.append([rbarid, centery+1, fits_row, xpos+1, fwhm, st])
                 xpos2 = xpos
                 #
                 if st == 0:
@@ -214,20 +234,20 @@ class MaskImagingRecipe(EmirRecipe):
 
                     if statusy in [0, 40]:
                         # Main border is detected
-                        positions[-1][1] = y2 + 1
-                        positions[-2][1] = y2 + 1
+                        bar_pos[-1][1] = y2 + 1
+                        bar_pos[-2][1] = y2 + 1
                     else:
                         # Update status
-                        positions[-1][-1] = 4
-                        positions[-2][-1] = 4
+                        bar_pos[-1][-1] = 4
+                        bar_pos[-2][-1] = 4
                 else:
                     self.logger.debug('slit is not complete')
                     y1, y2 = 0, 0
 
                 # Update positions
 
-                self.logger.debug('bar %d centroid-y %9.4f, row %d x-pos %9.4f, FWHM %6.3f, status %d', *positions[-2])
-                self.logger.debug('bar %d centroid-y %9.4f, row %d x-pos %9.4f, FWHM %6.3f, status %d', *positions[-1])
+                self.logger.debug('bar %d centroid-y %9.4f, row %d x-pos %9.4f, FWHM %6.3f, status %d', *bar_pos[-2])
+                self.logger.debug('bar %d centroid-y %9.4f, row %d x-pos %9.4f, FWHM %6.3f, status %d', *bar_pos[-1])
 
                 if ks == 5:
                     slits[lbarid - 1] = [xpos1, y2, xpos2, y2, xpos2, y1, xpos1, y1]
@@ -235,7 +255,9 @@ class MaskImagingRecipe(EmirRecipe):
                     slits[lbarid - 1] += 1.0
                     self.logger.debug('inserting bars %d-%d into "slits"', lbarid, rbarid)
 
-            allpos[ks] = numpy.asarray(positions, dtype='float') # GCS doesn't like lists of lists
+        # GCS doesn't like lists of lists
+        allpos = dict((ks, numpy.asarray(positions[ks], dtype='float'))
+                      for ks in kernel_sizes)
 
         self.logger.debug('end finding bars')
         result = self.create_result(frame=hdulist,
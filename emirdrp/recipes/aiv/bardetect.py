@@ -19,6 +19,8 @@
 
 """Bar detection procedures for EMIR"""
 
+from __future__ import division
+
 import logging
 import itertools
 
@@ -35,6 +37,66 @@ from numina.array.peaks.peakdet import find_peaks_indexes, refine_peaks
 from numina.array.utils import slice_create
 
 
+def savgol_derivative_kernel(ks):
+    """Savitzky-Golay (1964) kernel of the derivative, with ks points.
+
+    The kernel is used with scipy.ndimage.convolve1d, ks is odd.
+    """
+    kw = ks * (ks * ks - 1) / 12.0
+    return -numpy.arange((1 - ks) // 2, (ks - 1) // 2 + 1) / kw
+
+
+def merge_bands(intervals, size):
+    """Merge overlapping intervals of rows (start, stop) inside [0, size).
+
+    Returns a sorted list of slices.
+    """
+    merged = []
+    for start, stop in sorted(intervals):
+        start, stop = max(int(start), 0), min(int(stop), size)
+        if start >= stop:
+            continue
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], stop)
+        else:
+            merged.append([start, stop])
+    return [slice(start, stop) for start, stop in merged]
+
+
+def derivative_bands(arr, bands, sizes=(3, 5, 7, 9)):
+    """Derivative along X of arr, with Savitzky-Golay kernels of several sizes.
+
+    Only the rows in *bands*, a list of slices, are computed; the other
+    rows are zero. Returns a dictionary of arrays with the shape of arr,
+    keyed by kernel size. In the bands, the result is that of convolve1d
+    with savgol_derivative_kernel(ks), with the same boundary mode.
+
+    The kernel of size ks is the sum over m <= ks // 2 of
+    m * (arr[:, i + m] - arr[:, i - m]) / kw, so each band is read once
+    and the differences are shared by all the kernel sizes.
+    """
+    arr = numpy.asarray(arr)
+    dtype = arr.dtype if arr.dtype.kind == 'f' else numpy.dtype('float64')
+    sizes = sorted(sizes)
+    hmax = sizes[-1] // 2
+    ncols = arr.shape[1]
+    result = dict((ks, numpy.zeros(arr.shape, dtype=dtype)) for ks in sizes)
+    for band in bands:
+        # 'symmetric' in numpy.pad is 'reflect' in scipy.ndimage
+        padded = numpy.pad(arr[band].astype('float64'), ((0, 0), (hmax, hmax)),
+                           mode='symmetric')
+        acc = numpy.zeros((padded.shape[0], ncols))
+        used = 0
+        for ks in sizes:
+            for m in range(used + 1, ks // 2 + 1):
+                acc += m * (padded[:, hmax + m:hmax + m + ncols] -
+                            padded[:, hmax - m:hmax - m + ncols])
+            used = ks // 2
+            kw = ks * (ks * ks - 1) / 12.0
+            result[ks][band] = acc / kw
+    return result
+
+
 def find_position(edges, prow, bstart, bend, total=5):
     """Find a EMIR CSU bar position in a edge image.
 
@@ -296,7 +358,11 @@ def _char_bar_peak(arr_deriv, ypix, bstart, bend, th, center_of_bar=None, wx=10,
         return centery, centery, xl, xl, fwhm_x, 3
 
     logger.debug('transform values from real to virtual')
-    xcoords_t, ycoords_t = dist.pvex(xcoords_m, ycoords_m)
+    # the center is transformed in the same call
+    xcoords_t, ycoords_t = dist.pvex(xcoords_m + [centerx + 1],
+                                     ycoords_m + [centery + 1])
+    centery_virt = ycoords_t[-1]
+    xcoords_t, ycoords_t = xcoords_t[:-1], ycoords_t[:-1]
     logger.debug('real xcoords are: %s:', xcoords_m)
     logger.debug('real ycoords are: %s:', ycoords_m)
     logger.debug('virtual xcoords are: %s:', xcoords_t)
@@ -305,8 +371,6 @@ def _char_bar_peak(arr_deriv, ypix, bstart, bend, th, center_of_bar=None, wx=10,
     logger.debug('reference real xcoord is: %s:', xl)
     logger.debug('average virtual xcoord is: %s:', avg_xl_virt)
 
-    centerx_virt, centery_virt = dist.pvex(centerx + 1, centery + 1)
-
     return centery, centery_virt, xl, avg_xl_virt, fwhm_x, 0
 
 
@@ -23,6 +23,7 @@ from __future__ import division
 
 import logging
 import math
+import multiprocessing
 
 import numpy
 import scipy.interpolate as itpl
@@ -44,6 +45,7 @@ from numina.array.utils import expand_region
 from emirdrp.core import EMIR_PIXSCALE
 from .procedures import compute_fwhm_enclosed_direct
 from .procedures import compute_fwhm_enclosed_grow
+from .procedures import enclosed_flux
 from .procedures import moments
 from .procedures import AnnulusBackgroundEstimator
 from .procedures import image_box2d
@@ -258,6 +260,185 @@ def pinhole_char(data, ncenters, box=4, recenter_pinhole=True, maxdist=10.0):
     return mm0
 
 
+def _pinhole_char2_one(data, x0, y0, back_buff, back_width,
+                      phot_niter, rplot):
+    """Characterize the pinhole in x0, y0.
+
+    Returns the columns 5 to 32 of the result of pinhole_char2.
+    """
+    row = numpy.empty((28,))
+    row[:] = -99
+    # Fitter
+    fitter = fitting.LevMarLSQFitter()  # @UndefinedVariable
+
+    # Initial photometric radius
+    rad = 3.0
+    # Loop to find better photometry radius and background annulus
+    irad = rad
+    bck = 0.0
+    for i in range(phot_niter):
+        # Sky background annulus
+        rs1 = rad + back_buff
+        rs2 = rs1 + back_width
+        _logger.debug('Iter %d, annulus r1=%5.2f r2=%5.2f', i, rs1, rs2)
+        bckestim = AnnulusBackgroundEstimator(r1=rs1, r2=rs2)
+
+        # Crop the image to obtain the background
+        sl_sky = image_box2d(x0, y0, data.shape, (rs2, rs2))
+        raster_sky = data[sl_sky]
+        # Logical coordinates
+        xx0 = x0 - sl_sky[1].start
+        yy0 = y0 - sl_sky[0].start
+        # FIXME, perhaps we dont need to crop the image
+        try:
+            bck = bckestim(raster_sky, xx0, yy0)
+            _logger.debug('Iter %d, background %f in '
+                          'annulus r1=%5.2f r2=%5.2f',
+                          i, bck, rs1, rs2)
+        except Exception as error:
+            _logger.warning('Error in background estimation %s', error)
+            break
+
+        # Radius of the fit
+        fit_rad = max(rplot, rad)
+
+        sl = image_box2d(x0, y0, data.shape, (fit_rad, fit_rad))
+        part = data[sl]
+        # Logical coordinates
+        xx0 = x0 - sl[1].start
+        yy0 = y0 - sl[0].start
+
+        yy, xx = numpy.mgrid[sl]
+        _logger.debug('Iter %d, radial fit', i)
+
+        # Photometry
+        dist = numpy.sqrt((xx - x0) ** 2 + (yy - y0) ** 2)
+        phot_mask = dist < fit_rad
+        r1 = dist[phot_mask]
+        part_s = part - bck
+        f1 = part_s[phot_mask]
+        # Fit radial profile
+        model = models.Gaussian1D(amplitude=f1.max(), mean=0, stddev=1.0)
+        model.mean.fixed = True  # Mean is always 0.0
+
+        g1d_f = fitter(model, r1, f1, weights=(r1 + 1e-12) ** -1)
+
+        rpeak = g1d_f.amplitude.value
+        # sometimes the fit is negative
+        rsigma = abs(g1d_f.stddev.value)
+
+        rfwhm = rsigma * FWHM_G
+
+        rad = 2.5 * rfwhm
+        _logger.debug('Iter %d, new rad is %f', i, rad)
+        if abs(rad - irad) < 1e-3:
+            # reached convergence
+            _logger.debug('Convergence in iter %d', i)
+            break
+        else:
+            irad = rad
+    else:
+        _logger.debug('no convergence in photometric radius determination')
+
+    _logger.info('background %6.2f, r1 %7.2f r2 %7.2f', bck, rs1, rs2)
+    row[0:0 + 3] = bck, rs1, rs2
+    aper_rad = rad
+    ca = CircularAperture([(xx0, yy0)], aper_rad)
+    m = photutils.aperture_photometry(part_s, ca)
+    flux_aper = m['aperture_sum'][0]
+    _logger.info('aper rad %f, aper flux %f', aper_rad, flux_aper)
+    row[3:3 + 2] = aper_rad, flux_aper
+
+    _logger.info('Radial fit, peak: %f fwhm %f', rpeak, rfwhm)
+
+    # the curve of growth is shared by both fits
+    curve = enclosed_flux(part_s, xx0, yy0, maxrad=fit_rad)
+    try:
+        dpeak, dfwhm, smsg = compute_fwhm_enclosed_direct(
+            part_s, xx0, yy0, curve=curve)
+        _logger.info('Enclosed direct, peak: %f fwhm %f', dpeak, dfwhm)
+    except Exception as error:
+        _logger.warning('Error in compute_fwhm_enclosed_direct %s', error)
+        dpeak, dfwhm = -99.0, -99.0
+
+    try:
+        eamp, efwhm, epeak, emsg = compute_fwhm_enclosed_grow(
+            part_s, xx0, yy0, curve=curve)
+        _logger.info('Enclosed fit, peak: %f fwhm %f', epeak, efwhm)
+    except Exception as error:
+        _logger.warning('Error in compute_fwhm_enclosed_grow %s', error)
+        eamp, efwhm, epeak, emsg = [-99.0] * 4
+
+    row[5:5 + 6] = epeak, efwhm, dpeak, dfwhm, rpeak, rfwhm
+
+    try:
+        res_simple = compute_fwhm_2d_simple(part_s, xx0, yy0)
+        _logger.info('Simple, peak: %f fwhm x %f fwhm %f', *res_simple)
+        row[11:11 + 3] = res_simple
+    except Exception as error:
+        _logger.warning('Error in compute_fwhm_2d_simple %s', error)
+        row[11:11 + 3] = -99.0
+
+    try:
+        res_spline = compute_fwhm_2d_spline(part_s, xx0, yy0)
+        _logger.info('Spline, peak: %f fwhm x %f fwhm %f', *res_spline)
+        row[14:14 + 3] = res_spline
+    except Exception as error:
+        _logger.warning('Error in compute_fwhm_2d_spline %s', error)
+        row[14:14 + 3] = -99.0
+
+    # Bidimensional fit
+    # Fit in a smaller box
+    fit2d_rad = int(math.ceil(fit_rad))
+
+    fit2d_half_box = (fit2d_rad, fit2d_rad)
+    sl1 = image_box2d(x0, y0, data.shape, fit2d_half_box)
+
+    part1 = data[sl1]
+    yy1, xx1 = numpy.mgrid[sl1]
+
+    g2d = models.Gaussian2D(amplitude=rpeak, x_mean=x0, y_mean=y0,
+                            x_stddev=1.0, y_stddev=1.0)
+    g2d_f = fitter(g2d, xx1, yy1, part1 - bck)
+
+    res_gauss2d = (g2d_f.amplitude.value,
+                   g2d_f.x_mean.value + 1,  # FITS coordinates
+                   g2d_f.y_mean.value + 1,  # FITS coordinates
+                   g2d_f.x_stddev.value * FWHM_G,
+                   g2d_f.y_stddev.value * FWHM_G,
+                   g2d_f.theta.value
+                   )
+
+    _logger.info('Gauss2d, %s', res_gauss2d)
+    row[17:17 + 6] = res_gauss2d
+    # Moments
+    moments_half_box = fit2d_half_box
+    res_moments = moments(data, x0, y0, moments_half_box)
+    _logger.info('Mxx %f Myy %f Mxy %f e %f pa %f', *res_moments)
+
+    row[23:23 + 5] = res_moments
+
+    return row
+
+
+# Image shared by the workers of pinhole_char2
+_shared_data = None
+
+
+def _pinhole_char2_init(buff, shape, dtype):
+    global _shared_data
+    _shared_data = numpy.frombuffer(buff, dtype=dtype).reshape(shape)
+
+
+def _pinhole_char2_chunk(args):
+    chunk, params = args
+    result = []
+    for idx, x0, y0 in chunk:
+        _logger.info('For pinhole %i', idx)
+        result.append((idx, _pinhole_char2_one(_shared_data, x0, y0, *params)))
+    return result
+
+
 def pinhole_char2(
     data, ncenters,
     recenter_pinhole=True,
@@ -267,8 +448,15 @@ def pinhole_char2(
     back_buff=3,
     back_width=5,
     phot_niter=10,
-    phot_rad=8
+    phot_rad=8,
+    nprocs=1,
+    chunksize=None
 ):
+    """Characterize pinholes.
+
+    If *nprocs* is greater than 1, the pinholes are processed in
+    chunks of *chunksize* by a pool of processes.
+    """
 
     sigma0 = 1.0
     rad = 3 * sigma0 * FWHM_G
@@ -293,162 +481,42 @@ def pinhole_char2(
     mm0[:, 4] = starr
     mm0[:, 5:] = -99
 
-    # Fitter
-    fitter = fitting.LevMarLSQFitter()  # @UndefinedVariable
     rplot = phot_rad
+    params = (back_buff, back_width, phot_niter, rplot)
 
-    for idx, (x0, y0) in enumerate(centers_r):
-        _logger.info('For pinhole %i', idx)
-        if not cmask[idx]:
-            _logger.info('skipping')
-            # Fill result with -99
-            continue
-
-        # Initial photometric radius
-        rad = 3.0
-        # Loop to find better photometry radius and background annulus
-        irad = rad
-        bck = 0.0
-        for i in range(phot_niter):
-            phot_rad = rad
-            # Sky background annulus
-            rs1 = rad + back_buff
-            rs2 = rs1 + back_width
-            _logger.debug('Iter %d, annulus r1=%5.2f r2=%5.2f', i, rs1, rs2)
-            bckestim = AnnulusBackgroundEstimator(r1=rs1, r2=rs2)
-
-            # Crop the image to obtain the background
-            sl_sky = image_box2d(x0, y0, data.shape, (rs2, rs2))
-            raster_sky = data[sl_sky]
-            # Logical coordinates
-            xx0 = x0 - sl_sky[1].start
-            yy0 = y0 - sl_sky[0].start
-            # FIXME, perhaps we dont need to crop the image
-            try:
-                bck = bckestim(raster_sky, xx0, yy0)
-                _logger.debug('Iter %d, background %f in '
-                              'annulus r1=%5.2f r2=%5.2f',
-                              i, bck, rs1, rs2)
-            except Exception as error:
-                _logger.warning('Error in background estimation %s', error)
-                break
-
-            # Radius of the fit
-            fit_rad = max(rplot, rad)
-
-            sl = image_box2d(x0, y0, data.shape, (fit_rad, fit_rad))
-            part = data[sl]
-            # Logical coordinates
-            xx0 = x0 - sl[1].start
-            yy0 = y0 - sl[0].start
-
-            yy, xx = numpy.mgrid[sl]
-            _logger.debug('Iter %d, radial fit', i)
-
-            # Photometry
-            dist = numpy.sqrt((xx - x0) ** 2 + (yy - y0) ** 2)
-            phot_mask = dist < fit_rad
-            r1 = dist[phot_mask]
-            part_s = part - bck
-            f1 = part_s[phot_mask]
-            # Fit radial profile
-            model = models.Gaussian1D(amplitude=f1.max(), mean=0, stddev=1.0)
-            model.mean.fixed = True  # Mean is always 0.0
-
-            g1d_f = fitter(model, r1, f1, weights=(r1 + 1e-12) ** -1)
-
-            rpeak = g1d_f.amplitude.value
-            # sometimes the fit is negative
-            rsigma = abs(g1d_f.stddev.value)
-
-            rfwhm = rsigma * FWHM_G
-
-            rad = 2.5 * rfwhm
-            _logger.debug('Iter %d, new rad is %f', i, rad)
-            if abs(rad - irad) < 1e-3:
-                # reached convergence
-                _logger.debug('Convergence in iter %d', i)
-                break
-            else:
-                irad = rad
-        else:
-            _logger.debug('no convergence in photometric radius determination')
-
-        _logger.info('background %6.2f, r1 %7.2f r2 %7.2f', bck, rs1, rs2)
-        mm0[idx, 5:5 + 3] = bck, rs1, rs2
-        aper_rad = rad
-        ca = CircularAperture([(xx0, yy0)], aper_rad)
-        m = photutils.aperture_photometry(part_s, ca)
-        flux_aper = m['aperture_sum'][0]
-        _logger.info('aper rad %f, aper flux %f', aper_rad, flux_aper)
-        mm0[idx, 8:8 + 2] = aper_rad, flux_aper
-
-        _logger.info('Radial fit, peak: %f fwhm %f', rpeak, rfwhm)
-
-        try:
-            dpeak, dfwhm, smsg = compute_fwhm_enclosed_direct(
-                part_s, xx0, yy0, maxrad=fit_rad)
-            _logger.info('Enclosed direct, peak: %f fwhm %f', dpeak, dfwhm)
-        except Exception as error:
-            _logger.warning('Error in compute_fwhm_enclosed_direct %s', error)
-            dpeak, dfwhm = -99.0, -99.0
-
-        try:
-            eamp, efwhm, epeak, emsg = compute_fwhm_enclosed_grow(
-                part_s, xx0, yy0, maxrad=fit_rad)
-            _logger.info('Enclosed fit, peak: %f fwhm %f', epeak, efwhm)
-        except Exception as error:
-            _logger.warning('Error in compute_fwhm_enclosed_grow %s', error)
-            eamp, efwhm, epeak, emsg = [-99.0] * 4
-
-        mm0[idx, 10:10 + 6] = epeak, efwhm, dpeak, dfwhm, rpeak, rfwhm
-
-        try:
-            res_simple = compute_fwhm_2d_simple(part_s, xx0, yy0)
-            _logger.info('Simple, peak: %f fwhm x %f fwhm %f', *res_simple)
-            mm0[idx, 16:16 + 3] = res_simple
-        except Exception as error:
-            _logger.warning('Error in compute_fwhm_2d_simple %s', error)
-            mm0[idx, 16:16 + 3] = -99.0
+    valid = [(idx, x0, y0) for idx, (x0, y0) in enumerate(centers_r)
+             if cmask[idx]]
+    for idx in numpy.flatnonzero(numpy.logical_not(cmask)):
+        _logger.info('For pinhole %i, skipping', idx)
 
+    if nprocs <= 1 or len(valid) < 2:
+        for idx, x0, y0 in valid:
+            _logger.info('For pinhole %i', idx)
+            mm0[idx, 5:33] = _pinhole_char2_one(data, x0, y0, *params)
+    else:
+        # Chunks of pinholes, processed by a pool of processes
+        # sharing the image
+        if chunksize is None:
+            chunksize = max(1, len(valid) // (4 * nprocs))
+        chunks = [(valid[i:i + chunksize], params)
+                  for i in range(0, len(valid), chunksize)]
+        sdata = numpy.ascontiguousarray(data)
+        buff = multiprocessing.RawArray('b', sdata.nbytes)
+        shared = numpy.frombuffer(buff, dtype=sdata.dtype)
+        shared[:] = sdata.ravel()
+        _logger.debug('characterize %d pinholes in %d chunks with %d processes',
+                      len(valid), len(chunks), nprocs)
+        pool = multiprocessing.Pool(nprocs, initializer=_pinhole_char2_init,
+                                    initargs=(buff, sdata.shape, sdata.dtype.str))
         try:
-            res_spline = compute_fwhm_2d_spline(part_s, xx0, yy0)
-            _logger.info('Spline, peak: %f fwhm x %f fwhm %f', *res_spline)
-            mm0[idx, 19:19 + 3] = res_spline
-        except Exception as error:
-            _logger.warning('Error in compute_fwhm_2d_spline %s', error)
-            mm0[idx, 19:19 + 3] = -99.0
-
-        # Bidimensional fit
-        # Fit in a smaller box
-        fit2d_rad = int(math.ceil(fit_rad))
-
-        fit2d_half_box = (fit2d_rad, fit2d_rad)
-        sl1 = image_box2d(x0, y0, data.shape, fit2d_half_box)
-
-        part1 = data[sl1]
-        yy1, xx1 = numpy.mgrid[sl1]
-
-        g2d = models.Gaussian2D(amplitude=rpeak, x_mean=x0, y_mean=y0,
-                                x_stddev=1.0, y_stddev=1.0)
-        g2d_f = fitter(g2d, xx1, yy1, part1 - bck)
-
-        res_gauss2d = (g2d_f.amplitude.value,
-                       g2d_f.x_mean.value + 1,  # FITS coordinates
-                       g2d_f.y_mean.value + 1,  # FITS coordinates
-                       g2d_f.x_stddev.value * FWHM_G,
-                       g2d_f.y_stddev.value * FWHM_G,
-                       g2d_f.theta.value
-                       )
-
-        _logger.info('Gauss2d, %s', res_gauss2d)
-        mm0[idx, 22:22 + 6] = res_gauss2d
-        # Moments
-        moments_half_box = fit2d_half_box
-        res_moments = moments(data, x0, y0, moments_half_box)
-        _logger.info('Mxx %f Myy %f Mxy %f e %f pa %f', *res_moments)
-
-        mm0[idx, 28:28 + 5] = res_moments
+            results = pool.map(_pinhole_char2_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+        # results are returned in the order of the chunks
+        for chunk_result in results:
+            for idx, row in chunk_result:
+                mm0[idx, 5:33] = row
 
     # Photometry in coordinates
     # x=centers_r[:,0]
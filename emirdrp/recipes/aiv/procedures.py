@@ -91,18 +91,115 @@ class AnnulusBackgroundEstimator(object):
         return bck
 
 
+def _circle_primitive(x, r):
+    """Primitive of sqrt(r**2 - x**2)."""
+    sq = np.sqrt(np.maximum(r * r - x * x, 0.0))
+    return 0.5 * (x * sq + r * r * np.arcsin(np.clip(x / r, -1.0, 1.0)))
+
+
+def _circle_corner_area(x, y, r):
+    """Area of the circle of radius r centered in (0,0) inside the
+    rectangle with corners (0,0) and (x,y).
+
+    The area is signed, odd in x and y.
+    """
+    sxy = np.sign(x) * np.sign(y)
+    x = np.minimum(np.abs(x), r)
+    y = np.minimum(np.abs(y), r)
+    inside = x * x + y * y <= r * r
+    # abscissa where the circle crosses y, smaller than x if not inside
+    xa = np.sqrt(np.maximum(r * r - y * y, 0.0))
+    area_out = xa * y + _circle_primitive(x, r) - _circle_primitive(xa, r)
+    return sxy * np.where(inside, x * y, area_out)
+
+
+def pixel_circle_overlap(dx, dy, r):
+    """Exact area of unit pixels inside a circle of radius r.
+
+    dx, dy are the coordinates of the centers of the pixels
+    relative to the center of the circle.
+    """
+    x0 = dx - 0.5
+    x1 = dx + 0.5
+    y0 = dy - 0.5
+    y1 = dy + 0.5
+    return (_circle_corner_area(x1, y1, r) - _circle_corner_area(x0, y1, r) -
+            _circle_corner_area(x1, y0, r) + _circle_corner_area(x0, y0, r))
+
+
+def curve_of_growth(data, positions, rad):
+    """Flux enclosed in circular apertures of several radii.
+
+    positions is a sequence of (x, y) centers, with the center of the
+    first pixel in (0, 0), rad an increasing sequence of radii.
+    Returns an array of shape (len(positions), len(rad)), equal to
+    the sum of aperture_photometry with exact overlaps.
+
+    The pixels fully inside each aperture are summed with a
+    cumulative sum of the flux sorted by distance, only the pixels
+    crossed by the border of each aperture are computed exactly.
+    """
+    positions = np.atleast_2d(np.asarray(positions, dtype='float'))
+    rad = np.asarray(rad, dtype='float')
+    nsrc = positions.shape[0]
+    nrad = rad.shape[0]
+
+    # Pixels in a box around each center, flattened
+    half = int(math.ceil(rad[-1])) + 1
+    off = np.arange(-half, half + 1)
+    oy, ox = [v.ravel() for v in np.meshgrid(off, off, indexing='ij')]
+    cx = np.round(positions[:, 0]).astype('int')
+    cy = np.round(positions[:, 1]).astype('int')
+    px = cx[:, np.newaxis] + ox
+    py = cy[:, np.newaxis] + oy
+    valid = ((px >= 0) & (px < data.shape[1]) &
+             (py >= 0) & (py < data.shape[0]))
+    src = np.repeat(np.arange(nsrc), ox.size).reshape(px.shape)[valid]
+    flux = data[py[valid], px[valid]].astype('float')
+    dx = px[valid] - positions[src, 0]
+    dy = py[valid] - positions[src, 1]
+
+    adx = np.abs(dx)
+    ady = np.abs(dy)
+    dmin = np.hypot(np.maximum(adx - 0.5, 0), np.maximum(ady - 0.5, 0))
+    dmax = np.hypot(adx + 0.5, ady + 0.5)
+
+    # Pixels fully inside, flux sorted by source and
+    # maximum distance, with a stride for each source
+    stride = 2 * (dmax.max() + rad[-1]) + 1 if dmax.size else 1.0
+    keys = src * stride + dmax
+    order = np.argsort(keys, kind='mergesort')
+    keys = keys[order]
+    cumflux = np.concatenate([[0.0], np.cumsum(flux[order])])
+    base = np.arange(nsrc)[:, np.newaxis] * stride
+    start = np.searchsorted(keys, base, side='left')
+    end = np.searchsorted(keys, base + rad, side='right')
+    result = cumflux[end] - cumflux[start]
+
+    # Pixels crossed by the border of the aperture
+    cross = (dmin[:, np.newaxis] < rad) & (rad < dmax[:, np.newaxis])
+    ipix, irad = np.nonzero(cross)
+    area = pixel_circle_overlap(dx[ipix], dy[ipix], rad[irad])
+    partial = np.bincount(src[ipix] * nrad + irad,
+                          weights=flux[ipix] * area,
+                          minlength=nsrc * nrad)
+    result += partial.reshape(nsrc, nrad)
+    return result
+
+
+def enclosed_flux(imgs, xc, yc, minrad=0.01, maxrad=15.0, num=100):
+    """Flux enclosed in apertures of radii spaced logarithmically."""
+    rad = np.logspace(np.log10(minrad), np.log10(maxrad), num=num)
+    flux = curve_of_growth(imgs, [(xc, yc)], rad)[0]
+    return rad, flux
+
+
 def compute_fwhm_enclosed(imgs, xc, yc, minrad=0.01, maxrad=15.0):
 
     peak_pix = wcs_to_pix_np((xc, yc))
     peak = imgs[tuple(peak_pix)]
 
-    rad = np.logspace(np.log10(minrad), np.log10(maxrad), num=100)
-    flux = np.zeros_like(rad)
-    positions = [(xc, yc)]
-    for idr, r in enumerate(rad):
-        ca = CircularAperture(positions, r)
-        m = aperture_photometry(imgs, ca)
-        flux[idr] = m['aperture_sum'][0]
+    rad, flux = enclosed_flux(imgs, xc, yc, minrad=minrad, maxrad=maxrad)
 
     idx = flux.argmax()
 
@@ -117,18 +214,16 @@ def compute_fwhm_enclosed(imgs, xc, yc, minrad=0.01, maxrad=15.0):
     return res_d, res_g
 
 
-def compute_fwhm_enclosed_direct(imgs, xc, yc, minrad=0.01, maxrad=15.0):
+def compute_fwhm_enclosed_direct(imgs, xc, yc, minrad=0.01, maxrad=15.0,
+                                 curve=None):
+    """FWHM from the enclosed flux, curve is (rad, flux) if computed."""
 
     peak_pix = wcs_to_pix_np((xc, yc))
     peak = imgs[tuple(peak_pix)]
 
-    rad = np.logspace(np.log10(minrad), np.log10(maxrad), num=100)
-    flux = np.zeros_like(rad)
-    positions = [(xc, yc)]
-    for idr, r in enumerate(rad):
-        ca = CircularAperture(positions, r)
-        m = aperture_photometry(imgs, ca)
-        flux[idr] = m['aperture_sum'][0]
+    if curve is None:
+        curve = enclosed_flux(imgs, xc, yc, minrad=minrad, maxrad=maxrad)
+    rad, flux = curve
 
     return fit_fwhm_enclosed_direct(peak, rad, flux)
 
@@ -163,15 +258,13 @@ def fit_fwhm_enclosed_direct(peak, rad, flux):
     return peak, fwhm, msg
 
 
-def compute_fwhm_enclosed_grow(imgs, xc, yc, minrad=0.01, maxrad=15.0):
+def compute_fwhm_enclosed_grow(imgs, xc, yc, minrad=0.01, maxrad=15.0,
+                               curve=None):
+    """Fit of the enclosed flux, curve is (rad, flux) if computed."""
 
-    rad = np.logspace(np.log10(minrad), np.log10(maxrad), num=100)
-    flux = np.zeros_like(rad)
-    positions = [(xc, yc)]
-    for idr, r in enumerate(rad):
-        ca = CircularAperture(positions, r)
-        m = aperture_photometry(imgs, ca)
-        flux[idr] = m['aperture_sum'][0]
+    if curve is None:
+        curve = enclosed_flux(imgs, xc, yc, minrad=minrad, maxrad=maxrad)
+    rad, flux = curve
     idx = flux.argmax()
     rmodel = rad[:idx+1]
     fmodel = flux[:idx+1]
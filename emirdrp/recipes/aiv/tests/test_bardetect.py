@@ -4,6 +4,8 @@ import numpy
 
 from ..bardetect import calc_fwhm
 from ..bardetect import find_position
+from ..bardetect import derivative_bands, merge_bands
+from ..bardetect import savgol_derivative_kernel
 
 @pytest.mark.parametrize("axis, result", [(0,7), (1, 16)])
 def test_calc_fwhm(axis, result):
@@ -58,3 +60,20 @@ def test_find_position_1():
     assert len(m) == 1
 
     assert m[0] == res
+
+
+def test_derivative_bands():
+    from scipy.ndimage import convolve1d
+
+    rng = numpy.random.RandomState(1)
+    arr = rng.normal(size=(50, 40)).astype('float32')
+    bands = merge_bands([(30, 45), (-3, 5), (3, 10), (48, 60)], 50)
+    assert bands == [slice(0, 10), slice(30, 45), slice(48, 50)]
+
+    derivs = derivative_bands(arr, bands)
+    for ks in [3, 5, 7, 9]:
+        expected = convolve1d(arr, savgol_derivative_kernel(ks), axis=-1)
+        for band in bands:
+            numpy.testing.assert_allclose(derivs[ks][band], expected[band],
+                                          atol=1e-5)
+        assert numpy.all(derivs[ks][10:30] == 0)
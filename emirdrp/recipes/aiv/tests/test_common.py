@@ -50,3 +50,22 @@ def test_normalize_raw_2():
 
     assert_allclose(ntt, rtt)
 
+
+
+def test_pinhole_char2_nprocs():
+    """The pool of processes gives the same table as the serial path"""
+    from ..common import pinhole_char2
+
+    shape = (80, 90)
+    yy, xx = numpy.mgrid[0:shape[0], 0:shape[1]]
+    rng = numpy.random.RandomState(12)
+    data = rng.normal(100.0, 1.0, size=shape)
+    ncenters = numpy.array([[20.0, 20.0], [60.0, 25.0],
+                            [25.0, 60.0], [65.0, 62.0]])
+    for x, y in ncenters - 1:
+        data += 5000 * numpy.exp(-((xx - x) ** 2 + (yy - y) ** 2) / 4.5)
+
+    serial = pinhole_char2(data, ncenters, phot_niter=3)
+    pooled = pinhole_char2(data, ncenters, phot_niter=3, nprocs=2,
+                           chunksize=1)
+    assert_allclose(pooled, serial)
@@ -25,6 +25,7 @@ import numpy
 from numpy.testing import assert_allclose
 
 from ..procedures import encloses_annulus
+from ..procedures import curve_of_growth
 
 
 def test_encloses_annulus():
@@ -45,3 +46,20 @@ def test_encloses_annulus():
                           r_in, r_out)
 
     assert_allclose(aa[50, [20, 40, 50, 60]], [0.0, 1.0, 0.0, 1.0])
+
+
+def test_curve_of_growth():
+    a = numpy.ones((60, 60))
+    rad = numpy.logspace(numpy.log10(0.01), numpy.log10(15.0), num=100)
+    positions = [(30.4, 29.2), (20.0, 35.5)]
+    flux = curve_of_growth(a, positions, rad)
+
+    assert flux.shape == (2, 100)
+    assert_allclose(flux, numpy.pi * rad ** 2 * numpy.ones((2, 1)))
+
+
+def test_curve_of_growth_border():
+    a = numpy.ones((60, 60))
+    # center in the corner of the image
+    flux = curve_of_growth(a, [(-0.5, -0.5)], [1.0, 5.0])
+    assert_allclose(flux[0], 0.25 * numpy.pi * numpy.array([1.0, 25.0]))
@@ -26,6 +26,7 @@ import six
 import numpy
 from astropy.io import fits
 from emirdrp.util.sextractor import SExtractor
+from emirdrp.processing.detection import get_detector
 
 from .naming import name_skysub_proc
 
@@ -60,39 +61,19 @@ def check_photometry(frames, sf_data, seeing_fwhm, step=0,
                      border=300, extinction=0.0,
                      check_photometry_levels=[0.5, 0.8],
                      check_photometry_actions=['warn', 'warn', 'default'],
-                     figure=None):
+                     figure=None, detector=None, getdata=fits.getdata):
     # Check photometry of few objects
-    weigthmap = 'weights4rms.fits'
+    detector = get_detector(detector)
 
     wmap = numpy.zeros_like(sf_data[0])
 
     # Center of the image
     wmap[border:-border, border:-border] = 1
-    fits.writeto(weigthmap, wmap, clobber=True)
-
-    basename = 'result_i%0d.fits' % (step)
-    sex = SExtractor()
-    sex.config['VERBOSE_TYPE'] = 'QUIET'
-    sex.config['PIXEL_SCALE'] = 1
-    sex.config['BACK_TYPE'] = 'AUTO'
-    if seeing_fwhm is not None:
-        sex.config['SEEING_FWHM'] = seeing_fwhm * sex.config['PIXEL_SCALE']
-    sex.config['WEIGHT_TYPE'] = 'MAP_WEIGHT'
-    sex.config['WEIGHT_IMAGE'] = weigthmap
-
-    sex.config['PARAMETERS_LIST'].append('FLUX_BEST')
-    sex.config['PARAMETERS_LIST'].append('FLUXERR_BEST')
-    sex.config['PARAMETERS_LIST'].append('FWHM_IMAGE')
-    sex.config['PARAMETERS_LIST'].append('CLASS_STAR')
 
-    sex.config['CATALOG_NAME'] = 'master-catalogue-i%01d.cat' % step
-    _logger.info('Runing sextractor in %s', basename)
-    sex.run('%s,%s' % (basename, basename))
-
-    # Sort catalog by flux
-    catalog = sex.catalog()
-    catalog = sorted(
-        catalog, key=operator.itemgetter('FLUX_BEST'), reverse=True)
+    _logger.info('Detecting objects in result, step %d, using %s',
+                 step, detector.name)
+    catalog, _ = detector.detect(sf_data[0], weight=wmap,
+                                 seeing_fwhm=seeing_fwhm)
 
     # set of indices of the N first objects
     MAX_OBJS_I_KEEP = 3
@@ -102,32 +83,24 @@ def check_photometry(frames, sf_data, seeing_fwhm, step=0,
         _logger.warn('I cannot check photometry, no objects detected in frame')
         return
 
-    indices = set(obj['NUMBER'] for obj in catalog[:OBJS_I_KEEP])
+    # The N first objects, sorted by flux
+    brightest = numpy.argsort(catalog['FLUX_BEST'], kind='mergesort')[::-1]
+    catalog = catalog[numpy.sort(brightest[:OBJS_I_KEEP])]
 
     base = numpy.empty((len(frames), OBJS_I_KEEP))
     error = numpy.empty((len(frames), OBJS_I_KEEP))
 
-    for idx, frame in enumerate(frames):
-        imagename = name_skysub_proc(frame.baselabel, step)
-
-        sex.config['CATALOG_NAME'] = ('catalogue-%s-i%01d.cat' %
-                                      (frame.baselabel, step))
-
-        # Lauch SExtractor on a FITS file
-        # om double image mode
-        _logger.info('Runing sextractor in %s', imagename)
-        sex.run('%s,%s' % (basename, imagename))
-        catalog = sex.catalog()
+    imagenames = [name_skysub_proc(frame.baselabel, step) for frame in frames]
+    _logger.info('Measuring objects in %d images', len(imagenames))
+    allmeasured = detector.measure_many(
+        (getdata(imagename) for imagename in imagenames), catalog,
+        detection=sf_data[0], weight=wmap)
 
+    for idx, (frame, measured) in enumerate(zip(frames, allmeasured)):
         # Extinction correction
         excor = pow(10, -0.4 * frame.airmass * extinction)
-        fluxes = [obj['FLUX_BEST'] /
-                  excor for obj in catalog if obj['NUMBER'] in indices]
-        errors = [obj['FLUXERR_BEST'] /
-                  excor for obj in catalog if obj['NUMBER'] in indices]
-
-        base[idx] = fluxes
-        error[idx] = errors
+        base[idx] = measured['FLUX_BEST'] / excor
+        error[idx] = measured['FLUXERR_BEST'] / excor
 
     data = base / base[0]
     err = error / base[0]  # sigma
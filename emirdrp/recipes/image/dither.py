@@ -134,6 +134,8 @@ class DitheredImageRecipe(DirectImageCommon):
         [0.5, 0.8], 'Levels to check the flux of the objects')
     check_photometry_actions = Parameter(
         ['warn', 'warn', 'default'], 'Actions to take on images')
+    memory_budget = Parameter(
+        0, 'Memory for intermediate images in MB, 0 is unlimited')
 
     frame = Product(DataFrameType)
     catalog = Product(SourcesCatalog)
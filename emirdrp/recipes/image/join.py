@@ -31,7 +31,6 @@ from numina.core import Product, RecipeError, Requirement
 from numina.core.requirements import ObservationResultRequirement
 from numina.array import combine
 from numina.array import combine_shape, combine_shapes
-from numina.array import resize_arrays, resize_arrays_alt
 from numina.array.utils import coor_to_pix, image_box2d
 from numina.core import ObservationResult
 from numina.flow.processing import SkyCorrector
@@ -43,6 +42,11 @@ from emirdrp.processing.corr import offsets_from_crosscor, offsets_from_crosscor
 from emirdrp.core import EmirRecipe
 from emirdrp.products import DataFrameType
 from emirdrp.processing.combine import segmentation_combined
+from emirdrp.processing import stacking
+from emirdrp.processing.accumulator import RunningStack
+from emirdrp.processing.resample import OffsetView, ShiftedFrame
+from emirdrp.processing.resample import combine_shifted
+from emirdrp.processing.resample import shifted_shape
 import emirdrp.decorators
 
 
@@ -146,7 +150,7 @@ class JoinDitheredImagesRecipe(EmirRecipe):
         return partial_result
 
     def aggregate_frames(self, accum, frame, naccum):
-        return self.aggregate2(accum, frame, naccum)
+        return self.aggregate2(accum, frame)
 
     def run_single(self, rinput):
 
@@ -208,19 +212,15 @@ class JoinDitheredImagesRecipe(EmirRecipe):
         self.logger.debug("Relative offsetsp %s", offsetsp)
         self.logger.info('Shape of resized array is %s', finalshape)
 
-        # Resizing target imgs
-        data_arr_sr, regions = resize_arrays(
-            [m[0].data for m in data_hdul_s],
-            subpixshape,
-            offsetsp,
-            finalshape,
-            fill=1
-        )
+        # Target imgs in the final canvas, without copies
+        data_arr_sr = [OffsetView(m[0].data, offset, finalshape, fill=1)
+                       for m, offset in zip(data_hdul_s, offsetsp)]
 
         if self.intermediate_results:
             self.logger.debug('save resized intermediate img')
             for idx, arr_r in enumerate(data_arr_sr):
-                self.save_intermediate_array(arr_r, 'interm_%s.fits' % idx)
+                self.save_intermediate_array(numpy.asarray(arr_r),
+                                             'interm_%s.fits' % idx)
 
         compute_cross_offsets = True
         if compute_cross_offsets:
@@ -236,54 +236,47 @@ class JoinDitheredImagesRecipe(EmirRecipe):
                 # Offsets in numpy order, swaping
                 offsets_xy_t = offset_xy0 - offsets_xy_c
                 offsets_fc = offsets_xy_t[:, ::-1]
-                offsets_fc_t = numpy.round(offsets_fc).astype('int')
                 self.logger.debug('Total offsets: %s', offsets_xy_t)
                 self.logger.info('Computing relative offsets from cross-corr')
-                finalshape, offsetsp = combine_shape(subpixshape, offsets_fc_t)
+                # Fractional offsets, the frames are interpolated
+                finalshape, offsetsp = shifted_shape(subpixshape, offsets_fc)
     #
                 self.logger.debug("Relative offsetsp (crosscorr) %s", offsetsp)
                 self.logger.info('Shape of resized array (crosscorr) is %s', finalshape)
 
-                # Resizing target imgs
-                self.logger.debug("Resize to final offsets")
-                data_arr_sr, regions = resize_arrays(
-                    [m[0].data for m in data_hdul_s],
-                    subpixshape,
-                    offsetsp,
-                    finalshape,
-                    fill=1
-                )
-
                 if self.intermediate_results:
                     self.logger.debug('save resized intermediate2 img')
-                    for idx, arr_r in enumerate(data_arr_sr):
-                        self.save_intermediate_array(arr_r, 'interm2_%s.fits' % idx)
+                    for idx, m in enumerate(data_hdul_s):
+                        arr_r = ShiftedFrame(m[0].data, offsetsp[idx],
+                                             finalshape, fill=1)
+                        self.save_intermediate_array(numpy.asarray(arr_r),
+                                                     'interm2_%s.fits' % idx)
 
             except Exception as error:
                 self.logger.warning('Error during cross-correlation, %s', error)
 
         if has_num_ext:
             self.logger.debug('Using NUM extension')
-            masks = [numpy.where(m['NUM'].data, 0, 1).astype('int16') for m in data_hdul]
+            masks = [m['NUM'].data == 0 for m in data_hdul]
         elif has_bpm_ext:
             self.logger.debug('Using BPM extension')
             #
-            masks = [numpy.where(m['BPM'].data, 1, 0).astype('int16') for m in data_hdul]
+            masks = [m['BPM'].data != 0 for m in data_hdul]
         else:
             self.logger.warning('BPM missing, use zeros instead')
-            false_mask = numpy.zeros(baseshape, dtype='int16')
-            masks = [false_mask for _ in data_arr_sr]
-
-        self.logger.debug('resize bad pixel masks')
-        mask_arr_r, _ = resize_arrays(masks, subpixshape, offsetsp, finalshape, fill=1)
+            masks = [None for _ in data_hdul]
 
         # Position of refpixel in final image
         refpix_final = refpix + offsetsp[0]
         self.logger.info('Position of refpixel in final image %s', refpix_final)
 
         self.logger.info('Combine target images (final)')
-        method = combine.median
-        out = method(data_arr_sr, masks=mask_arr_r, dtype='float32')
+        method = stacking.median
+        shifted = [ShiftedFrame(m[0].data, offset, finalshape, mask=mask,
+                                fill=1)
+                   for m, offset, mask in zip(data_hdul_s, offsetsp, masks)]
+        out = combine_shifted(shifted, finalshape, method=method,
+                              dtype='float32')
 
         self.logger.debug('create result image')
         hdu = fits.PrimaryHDU(out[0], header=base_header)
@@ -422,7 +415,7 @@ class JoinDitheredImagesRecipe(EmirRecipe):
         return omasks
 
     def compute_sky_simple(self, data_hdul, use_errors=False):
-        method = combine.median
+        method = stacking.median
 
         refimg = data_hdul[0]
         base_header = refimg[0].header
@@ -454,7 +447,7 @@ class JoinDitheredImagesRecipe(EmirRecipe):
         return sky_result
 
     def compute_sky_advanced(self, data_hdul, omasks, base_header, use_errors):
-        method = combine.mean
+        method = stacking.mean
 
         self.logger.info('recombine images with segmentation mask')
         sky_data = method([m[0].data for m in data_hdul], masks=omasks, dtype='float32')
@@ -491,7 +484,7 @@ class JoinDitheredImagesRecipe(EmirRecipe):
 
         return sky_result
 
-    def aggregate2(self, frame1, frame2, naccum):
+    def aggregate2(self, frame1, frame2):
         # FIXME, this is almost identical to run_single
         frames = [frame1, frame2]
         use_errors = True
@@ -526,30 +519,13 @@ class JoinDitheredImagesRecipe(EmirRecipe):
                 mask = numpy.zeros_like(img[0].data)
             masks.append(mask)
 
-        # Resizing target frames
-        data_arr_r = resize_arrays_alt(
-            [img[0].data for img in imgs],
-            partial_shapes,
-            finalshape,
-            fill=1
-        )
-
-        self.logger.debug('resize bad pixel masks')
-        mask_arr_r = resize_arrays_alt(masks, partial_shapes, finalshape, fill=1)
-
-        self.logger.debug("not computing sky")
-        data_arr_sr = data_arr_r
-
         self.logger.info('Combine target images (final, aggregate)')
-        self.logger.debug("weights for 'accum' and 'frame'")
-
-        weight_accum = 2 * (1 - 1.0 / naccum)
-        weight_frame = 2.0 / naccum
-        scales = [1.0 / weight_accum, 1.0 / weight_frame]
-        self.logger.debug("weights for 'accum' and 'frame', %s", scales)
-        method = combine.mean
-
-        out = method(data_arr_sr, masks=mask_arr_r, scales=scales, dtype='float32')
+        # The accumulated image stores running sums, the new frame
+        # is added to them and the previous frames are not combined again
+        stack = RunningStack.from_hdulist(imgs[0], mask=masks[0])
+        stack = stack.resize(finalshape, partial_shapes[0])
+        stack.add(imgs[1][0].data, mask=masks[1], region=partial_shapes[1])
+        out = stack.result(dtype='float32')
 
         self.logger.debug('create result image')
         hdu = fits.PrimaryHDU(out[0], header=base_header)
@@ -562,7 +538,7 @@ class JoinDitheredImagesRecipe(EmirRecipe):
         hdr['OBSMODE'] = 'DITHERED_IMAGE'
         hdu.header['history'] = "Combined %d images using '%s'" % (
             len(imgs),
-            method.__name__
+            'mean'
         )
         hdu.header['history'] = 'Combination time {}'.format(
             datetime.datetime.utcnow().isoformat()
@@ -582,9 +558,9 @@ class JoinDitheredImagesRecipe(EmirRecipe):
         if use_errors:
             varhdu = fits.ImageHDU(out[1], name='VARIANCE')
             num = fits.ImageHDU(out[2], name='MAP')
-            hdulist = fits.HDUList([hdu, varhdu, num])
+            hdulist = fits.HDUList([hdu, varhdu, num] + stack.to_hdus())
         else:
-            hdulist = fits.HDUList([hdu])
+            hdulist = fits.HDUList([hdu] + stack.to_hdus())
 
         return hdulist
 
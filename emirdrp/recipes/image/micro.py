@@ -60,6 +60,8 @@ class MicroditheredImageRecipeInput(RecipeInput):
         ['warn', 'warn', 'default'], 'Actions to take on images')
     subpixelization = Parameter(4, 'Number of subdivisions in each pixel side')
     window = Parameter([], 'Region of interesting data', optional=True)
+    memory_budget = Parameter(
+        0, 'Memory for intermediate images in MB, 0 is unlimited')
 
 
 class MicroditheredImageRecipeResult(RecipeResult):
@@ -145,6 +147,13 @@ class MicroditheredImageRecipe(DirectImageCommon):
      * Finally, the images are corrected from atmospheric extinction and flux
        calibrated.
 
+     * The sky-subtracted images are drizzled in the grid subdivided by
+       *n*, using their fractional offsets. Pixels deviating more than
+       5 sigma from the combined image of the last iteration are
+       rejected. In the result, the VARIANCE extension is the weighted
+       variance of the drops in each pixel, and MAP is the sum of the
+       weights of the drops, instead of the number of images.
+
      * A preliminary astrometric calibration can always be used (using
        the central coordinates of the pointing and the plate
        scale in the detector).
@@ -160,7 +169,8 @@ class MicroditheredImageRecipe(DirectImageCommon):
         frame, catalog = self.process(ri,
                                       window=window, subpix=subpix,
                                       target_is_sky=True,
-                                      stop_after=DirectImageCommon.FULLRED)
+                                      stop_after=DirectImageCommon.FULLRED,
+                                      drizzle=True)
 
         result = self.create_result(frame=frame, catalog=catalog)
         return result
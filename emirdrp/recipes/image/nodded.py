@@ -55,6 +55,8 @@ class NBImageRecipeInput(RecipeInput):
         [0.5, 0.8], 'Levels to check the flux of the objects')
     check_photometry_actions = Parameter(
         ['warn', 'warn', 'default'], 'Actions to take on images')
+    memory_budget = Parameter(
+        0, 'Memory for intermediate images in MB, 0 is unlimited')
 
 
 class NBImageRecipeResult(RecipeResult):
@@ -21,7 +21,6 @@
 
 import os
 import logging
-import shutil
 import math
 
 import six
@@ -44,17 +43,23 @@ from numina.flow.node import IdNode
 from numina.flow.processing import BiasCorrector, FlatFieldCorrector
 from numina.flow.processing import DarkCorrector
 from numina.array import fixpix2
-from numina.frame import resize_fits, custom_region_to_str
+from numina.frame import resize_hdu, custom_region_to_str
 from numina.array import combine_shape, correct_flatfield
 from numina.array import subarray_match
-from numina.array.combine import flatcombine, median, quantileclip
+from numina.array.combine import median, quantileclip
 
-from emirdrp.util.sextractor import SExtractor
-from emirdrp.util.sextractor import open as sopen
+from emirdrp.util import sexcatalog
 from emirdrp.core import EmirRecipe
 from emirdrp.products import SourcesCatalog
 from emirdrp.instrument.channels import FULL
 from emirdrp.processing.wcs import offsets_from_wcs
+from emirdrp.processing.detection import get_detector
+from emirdrp.processing.sky import sliding_sky
+from emirdrp.processing.superflat import channel_tiles, frame_scales
+from emirdrp.processing.superflat import combine_superflat
+from emirdrp.processing.store import IntermediateStore
+from emirdrp.processing.drizzle import Drizzle
+from emirdrp.processing.resample import OffsetView, combine_shifted
 
 from .checks import check_photometry
 from .naming import (name_redimensioned_frames, name_object_mask,
@@ -115,11 +120,27 @@ def clip_slices(r, region, scale=1):
     return t
 
 
+def reject_outliers(data, mask, combined, region, nsigma=5.0):
+    """Mask the pixels of data deviating from a combined image.
+
+    region is the region of the combined image (value, variance and
+    number of points) covered by data. Pixels farther than nsigma
+    times the standard deviation of the combination are masked.
+    Returns the updated mask, with 1 in the masked pixels.
+    """
+    value = combined[0][region]
+    std = numpy.sqrt(combined[1][region])
+    outlier = (std > 0) & (numpy.abs(data - value) > nsigma * std)
+    return ((numpy.asarray(mask) != 0) | outlier).astype('int16')
+
+
 class DirectImageCommon(EmirRecipe):
 
     logger = _logger
     BASIC, PRERED, CHECKRED, FULLRED, COMPLETE = [0, 1, 2, 3, 4]
     __version__ = '1'
+    # Source detector, 'sep', 'sextractor' or None for the default
+    detector = None
 
     def __init__(self, *args, **kwds):
         super(DirectImageCommon, self).__init__(version=__version__)
@@ -129,11 +150,41 @@ class DirectImageCommon(EmirRecipe):
         self._figure = plt.figure(facecolor='white')
         self._figure.canvas.set_window_title('Recipe Plots')
         self._figure.canvas.draw()
+        # Intermediate images
+        self.store = IntermediateStore(persist=True)
 
     def process(self, ri,
                 window=None, subpix=1,
                 store_intermediate=True,
-                target_is_sky=True, stop_after=PRERED):
+                target_is_sky=True, stop_after=PRERED,
+                memory_budget=None, drizzle=False):
+        """Reduce the frames of ri.
+
+        Intermediate images are kept in memory, and written to FITS
+        files if store_intermediate is True. If the images in memory
+        exceed *memory_budget* bytes (by default, the recipe parameter
+        memory_budget, in MB), they are spilled to temporary files,
+        removed at the end of the reduction.
+        """
+        if memory_budget is None:
+            try:
+                budget_mb = ri.memory_budget
+            except (KeyError, AttributeError):
+                budget_mb = 0
+            if budget_mb > 0:
+                memory_budget = int(budget_mb * 1024 * 1024)
+
+        self.store = IntermediateStore(budget=memory_budget,
+                                       persist=store_intermediate)
+        try:
+            return self._process(ri, window=window, subpix=subpix,
+                                 target_is_sky=target_is_sky,
+                                 stop_after=stop_after, drizzle=drizzle)
+        finally:
+            self.store.close()
+
+    def _process(self, ri, window=None, subpix=1, target_is_sky=True,
+                 stop_after=PRERED, drizzle=False):
 
         numpy.seterr(divide='raise')
 
@@ -149,8 +200,12 @@ class DirectImageCommon(EmirRecipe):
         if window is None:
             window = tuple((0, siz) for siz in baseshape)
 
-        if store_intermediate:
-            pass
+        # With drizzle, the frames are processed with their own
+        # pixels, only the final combination is subsampled
+        if drizzle:
+            drizzle_scale, subpix = subpix, 1
+        else:
+            drizzle_scale = 1
 
         # States
         sf_data = None
@@ -241,6 +296,8 @@ class DirectImageCommon(EmirRecipe):
                     frame.valid_target = False
                     frame.valid_sky = False
                     frame.valid_region = scalewindow
+                    # Region of the stored data used
+                    frame.data_region = scalewindow
                     # FIXME: hardcode itype for the moment
                     frame.itype = 'TARGET'
                     if frame.itype == 'TARGET':
@@ -292,7 +349,8 @@ class DirectImageCommon(EmirRecipe):
                 # superflat
                 _logger.info('Step %d, superflat correction (SF)', step)
                 # Compute scale factors (median)
-                self.update_scale_factors(ri.obresult.frames)
+                self.update_scale_factors(ri.obresult.frames,
+                                          channels=scaled_chan)
 
                 # Create superflat
                 superflat = self.compute_superflat(skyframes,
@@ -338,8 +396,16 @@ class DirectImageCommon(EmirRecipe):
                 else:
                     _logger.info('Recentering is not needed')
                     _logger.info('Checking photometry')
+                    byname = dict((frame.lastname, frame)
+                                  for frame in targetframes)
+
+                    def getdata(name):
+                        return numpy.asarray(self.frame_view(byname[name]))
+
                     check_photometry(targetframes, sf_data,
-                                     seeing_fwhm, figure=self._figure)
+                                     seeing_fwhm, figure=self._figure,
+                                     detector=self.detector,
+                                     getdata=getdata)
 
                     if stop_after == state:
                         break
@@ -360,8 +426,7 @@ class DirectImageCommon(EmirRecipe):
                     _logger.info(
                         'Step %d, create object mask %s', step,  frame.objmask)
                     frame.objmask_data = objmask[frame.valid_region]
-                    fits.writeto(
-                        frame.objmask, frame.objmask_data, clobber=True)
+                    self.store.put(frame.objmask, frame.objmask_data)
 
                 if not target_is_sky:
                     # Empty object mask for sky frames
@@ -373,7 +438,8 @@ class DirectImageCommon(EmirRecipe):
                 _logger.info('Step %d, superflat correction (SF)', step)
 
                 # Compute scale factors (median)
-                self.update_scale_factors(ri.obresult.frames, step)
+                self.update_scale_factors(ri.obresult.frames,
+                                          channels=scaled_chan, step=step)
 
                 # Create superflat
                 superflat = self.compute_superflat(skyframes, scaled_chan,
@@ -394,8 +460,9 @@ class DirectImageCommon(EmirRecipe):
                 # Combining the images
                 _logger.info("Step %d, Combining the images", step)
                 # FIXME: only for science
+                # the previous combination is not used again
                 sf_data = self.combine_frames(
-                    targetframes, ri.extinction, step=step)
+                    targetframes, ri.extinction, out=sf_data, step=step)
                 self.figures_after_combine(sf_data)
 
                 if step >= niteration:
@@ -407,6 +474,11 @@ class DirectImageCommon(EmirRecipe):
             raise RecipeError(
                 'no combined image has been generated at step %d', state)
 
+        if drizzle_scale > 1:
+            sf_data = self.drizzle_frames(targetframes, ri.extinction,
+                                          drizzle_scale, combined=sf_data,
+                                          step=step)
+
         hdu = fits.PrimaryHDU(sf_data[0])
         hdr = hdu.header
         hdr.update('NUMXVER', __version__, 'Numina package version')
@@ -464,17 +536,16 @@ class DirectImageCommon(EmirRecipe):
             sky = skyframe.median_sky
         else:
 
-            with fits.open(skyframe.lastname, mode='readonly') as hdulist:
-                data = hdulist['primary'].data
-                valid = data[frame.valid_region]
+            data = self.store.getdata(skyframe.lastname)
+            valid = data[skyframe.data_region]
 
-                if skyframe.objmask_data is not None:
-                    _logger.debug('object mask defined')
-                    msk = frame.objmask_data
-                    sky = numpy.median(valid[msk == 0])
-                else:
-                    _logger.debug('object mask empty')
-                    sky = numpy.median(valid)
+            if skyframe.objmask_data is not None:
+                _logger.debug('object mask defined')
+                msk = frame.objmask_data
+                sky = numpy.median(valid[msk == 0])
+            else:
+                _logger.debug('object mask empty')
+                sky = numpy.median(valid)
 
             _logger.debug('median sky value is %f', sky)
             skyframe.median_sky = sky
@@ -483,22 +554,22 @@ class DirectImageCommon(EmirRecipe):
         prev = frame.lastname
 
         if save:
-            shutil.copyfile(prev, dst)
+            self.store.copy(prev, dst)
         else:
-            os.rename(prev, dst)
+            self.store.rename(prev, dst)
 
         frame.lastname = dst
 
-        with fits.open(frame.lastname, mode='update') as hdulist:
+        with self.store.open(frame.lastname, mode='update') as hdulist:
             data = hdulist['primary'].data
-            valid = data[frame.valid_region]
+            valid = data[frame.data_region]
             valid -= sky
 
     def compute_advanced_sky(self, targetframes, objmask,
                              skyframes=None, target_is_sky=False,
                              maxsep=5.0,
                              nframes=10,
-                             step=0, save=True):
+                             step=0, nthreads=1):
 
         if target_is_sky:
             skyframes = targetframes
@@ -527,27 +598,46 @@ class DirectImageCommon(EmirRecipe):
 
         nsky = len(sarray)
 
+        windows = []
         for tid, idss in enumerate(idxs):
-            try:
-                tf = targetframes[tid]
-                _logger.info('Step %d, SC: computing advanced sky for %s',
-                             step, tf.baselabel)
-                # filter(lambda x: x < nsky, idss)
-                locskyframes = []
-                for si in idss:
-                    if tid == si:
-                        # this sky frame its the current frame, reject
-                        continue
-                    if si < nsky:
-                        _logger.debug('Step %d, SC: %s is a sky frame',
-                                      step, skyframes[si].baselabel)
-                        locskyframes.append(skyframes[si])
-                self.compute_advanced_sky_for_frame(
-                    tf, locskyframes, step=step, save=save)
-            except IndexError:
+            tf = targetframes[tid]
+            locskyframes = []
+            for si in idss:
+                if tid == si:
+                    # this sky frame its the current frame, reject
+                    continue
+                if si < nsky:
+                    _logger.debug('Step %d, SC: %s is a sky frame for %s',
+                                  step, skyframes[si].baselabel, tf.baselabel)
+                    locskyframes.append(si)
+            if not locskyframes:
                 _logger.error(
                     'No sky image available for frame %s', tf.lastname)
-                raise
+            windows.append(locskyframes)
+
+        def load(idx):
+            frame = skyframes[idx]
+            data = self.store.getdata(frame.flat_corrected)
+            data = data[frame.data_region]
+            if frame.objmask_data is not None:
+                mask = frame.objmask_data
+            elif frame.objmask is not None:
+                mask = self.store.getdata(frame.objmask)
+            else:
+                _logger.warn('no object mask for %s', frame.flat_corrected)
+                mask = None
+            return data, mask
+
+        def process(tid, sky, num):
+            tf = targetframes[tid]
+            _logger.info('Step %d, SC: computed advanced sky for %s',
+                         step, tf.baselabel)
+            self.subtract_advanced_sky(tf, sky, num, step=step)
+
+        scales = sliding_sky(windows, load, process, nthreads=nthreads)
+        for idx in sorted(scales):
+            _logger.debug('Step %d, SC: median of sky frame %s is %f',
+                          step, skyframes[idx].baselabel, scales[idx])
 
     def compute_advanced_sky_for_frame(self, frame, skyframes,
                                        step=0, save=True):
@@ -559,36 +649,25 @@ class DirectImageCommon(EmirRecipe):
         data = []
         scales = []
         masks = []
-        # handle the FITS file to close it finally
-        desc = []
-        try:
-            for i in skyframes:
-                filename = i.flat_corrected
-                hdulist = fits.open(filename, mode='readonly', memmap=True)
-
-                data.append(hdulist['primary'].data[i.valid_region])
-                desc.append(hdulist)
-                scales.append(numpy.median(data[-1]))
-                if i.objmask_data is not None:
-                    masks.append(i.objmask_data)
-                    _logger.debug('object mask is shared')
-                elif i.objmask is not None:
-                    hdulistmask = fits.open(
-                        i.objmask, mode='readonly', memmap=True)
-                    masks.append(hdulistmask['primary'].data)
-                    desc.append(hdulistmask)
-                    _logger.debug('object mask is particular')
-                else:
-                    _logger.warn('no object mask for %s', filename)
+        for i in skyframes:
+            filename = i.flat_corrected
+            data.append(self.store.getdata(filename)[i.data_region])
+            scales.append(numpy.median(data[-1]))
+            if i.objmask_data is not None:
+                masks.append(i.objmask_data)
+                _logger.debug('object mask is shared')
+            elif i.objmask is not None:
+                masks.append(self.store.getdata(i.objmask))
+                _logger.debug('object mask is particular')
+            else:
+                _logger.warn('no object mask for %s', filename)
 
-            _logger.debug('computing background with %d frames', len(data))
-            sky, _, num = median(data, masks, scales=scales)
+        _logger.debug('computing background with %d frames', len(data))
+        sky, _, num = median(data, masks, scales=scales)
 
-        finally:
-            # Closing all FITS files
-            for hdl in desc:
-                hdl.close()
+        self.subtract_advanced_sky(frame, sky, num, step=step)
 
+    def subtract_advanced_sky(self, frame, sky, num, step=0):
         if numpy.any(num == 0):
             # We have pixels without
             # sky background information
@@ -601,56 +680,87 @@ class DirectImageCommon(EmirRecipe):
             # To continue we interpolate over the patches
             fixpix2(sky, binmask, out=sky, iterations=1)
             name = name_skybackground(frame.baselabel, step)
-            fits.writeto(name, sky, clobber=True)
+            self.store.save(name, sky)
             name = name_skybackgroundmask(frame.baselabel, step)
-            fits.writeto(name, binmask.astype('int16'), clobber=True)
+            self.store.save(name, binmask.astype('int16'))
 
         dst = name_skysub_proc(frame.baselabel, step)
         prev = frame.lastname
-        shutil.copyfile(prev, dst)
+        self.store.copy(prev, dst)
         frame.lastname = dst
 
-        with fits.open(frame.lastname, mode='update') as hdulist:
+        with self.store.open(frame.lastname, mode='update') as hdulist:
             data = hdulist['primary'].data
-            valid = data[frame.valid_region]
+            valid = data[frame.data_region]
             valid -= sky
 
-    def combine_frames(self, frames, extinction, out=None, step=0):
-        _logger.debug('Step %d, opening sky-subtracted frames', step)
-
-        def fits_open(name):
-            '''Open FITS with memmap in readonly mode'''
-            return fits.open(name, mode='readonly', memmap=True)
-
-        frameslll = [fits_open(frame.lastname)
-                     for frame in frames if frame.valid_target]
-        _logger.debug('Step %d, opening mask frames', step)
-        mskslll = [fits_open(frame.resized_mask)
-                   for frame in frames if frame.valid_target]
-        _logger.debug('Step %d, combining %d frames', step, len(frameslll))
-        try:
-            extinc = [pow(10, -0.4 * frame.airmass * extinction)
-                      for frame in frames if frame.valid_target]
-            data = [i['primary'].data for i in frameslll]
-            masks = [i['primary'].data for i in mskslll]
-
-            out = quantileclip(data, masks, scales=extinc,
-                               dtype='float32', out=out, fclip=0.1)
-
-            # saving the three extensions
-            fits.writeto('result_i%0d.fits' % step, out[0], clobber=True)
-            fits.writeto('result_var_i%0d.fits' % step, out[1], clobber=True)
-            fits.writeto('result_npix_i%0d.fits' % step, out[2], clobber=True)
+    def frame_view(self, frame):
+        """The last image of frame and its mask, placed in the canvas.
 
-            return out
+        Images not in memory are memory mapped, not read back in the store.
+        """
+        region = frame.data_region
+        data = self.store.mapped(frame.lastname)[region]
+        mask = self.store.mapped(frame.resized_mask)[region]
+        offset = [r.start for r in frame.valid_region]
+        return OffsetView(data, offset, frame.canvas_shape, mask=mask)
 
-        finally:
-            _logger.debug('Step %d, closing sky-subtracted frames', step)
-            for f in frameslll:
-                f.close()
-            _logger.debug('Step %d, closing mask frames', step)
-            for f in mskslll:
-                f.close()
+    def combine_frames(self, frames, extinction, out=None, step=0):
+        frames = [frame for frame in frames if frame.valid_target]
+        _logger.debug('Step %d, reading sky-subtracted frames', step)
+        views = [self.frame_view(frame) for frame in frames]
+        _logger.debug('Step %d, combining %d frames', step, len(views))
+        extinc = [pow(10, -0.4 * frame.airmass * extinction)
+                  for frame in frames]
+
+        out = combine_shifted(views, frames[0].canvas_shape,
+                              method=quantileclip, scales=extinc,
+                              dtype='float32', out=out, fclip=0.1)
+
+        # saving the three extensions
+        self.store.save('result_i%0d.fits' % step, out[0])
+        self.store.save('result_var_i%0d.fits' % step, out[1])
+        self.store.save('result_npix_i%0d.fits' % step, out[2])
+
+        return out
+
+    def drizzle_frames(self, frames, extinction, scale, combined=None,
+                       nsigma=5.0, pixfrac=1.0, step=0):
+        """Drizzle the frames in a grid subsampled by scale.
+
+        If *combined* (the result of combine_frames) is given, pixels
+        deviating from it more than nsigma times its standard deviation
+        are masked before drizzling, to reject cosmic rays and outliers.
+        The result has the weighted mean of the drops, the weighted
+        variance of the drops and the sum of the overlap weights
+        of each output pixel.
+        """
+        _logger.info('Step %d, drizzling frames, subpix=%d', step, scale)
+        frames = [frame for frame in frames if frame.valid_target]
+        shape = frames[0].canvas_shape
+        driz = Drizzle([side * scale for side in shape], scale,
+                       pixfrac=pixfrac)
+        for frame in frames:
+            view = self.frame_view(frame)
+            extinc = pow(10, -0.4 * frame.airmass * extinction)
+            data = view.data / extinc
+            mask = view.mask
+            if combined is not None:
+                mask = reject_outliers(data, mask, combined, view.region,
+                                       nsigma=nsigma)
+                _logger.debug('Step %d, %d outliers masked in %s', step,
+                              mask.sum() - (view.mask != 0).sum(),
+                              frame.lastname)
+            # the frames were placed with rounded offsets
+            frac = frame.pix_offset - numpy.round(frame.pix_offset)
+            offset = [o + f for o, f in zip(view.offset, frac)]
+            _logger.debug('Step %d, drizzling %s, offset %s',
+                          step, frame.lastname, offset)
+            driz.add(data, offset, mask=mask)
+
+        out = driz.result(dtype='float32')
+        self.store.save('result_drizzle_i%0d.fits' % step, out[0])
+        return out
 
     def apply_superflat(self, frames, flatdata, step=0, save=True):
         _logger.info("Step %d, SF: apply superflat", step)
@@ -666,63 +776,52 @@ class DirectImageCommon(EmirRecipe):
         frame.flat_corrected = name_skyflat_proc(frame.baselabel, step)
 
         if save:
-            shutil.copyfile(frame.resized_base, frame.flat_corrected)
+            self.store.copy(frame.resized_base, frame.flat_corrected)
         else:
-            os.rename(frame.resized_base, frame.flat_corrected)
+            self.store.rename(frame.resized_base, frame.flat_corrected)
 
         _logger.info("Step %d, SF: apply superflat to frame %s",
                      step, frame.flat_corrected)
-        with fits.open(frame.flat_corrected, mode='update') as hdulist:
+        with self.store.open(frame.flat_corrected, mode='update') as hdulist:
             data = hdulist['primary'].data
-            datar = data[frame.valid_region]
-            data[frame.valid_region] = correct_flatfield(datar, fitted)
+            datar = data[frame.data_region]
+            data[frame.data_region] = correct_flatfield(datar, fitted)
 
             frame.lastname = frame.flat_corrected
 
             # FIXME: plotting
             try:
-                self.figure_image(data[frame.valid_region], frame)
+                self.figure_image(data[frame.data_region], frame)
             except ValueError:
                 _logger.warning('Problem plotting %s', frame.lastname)
 
-    def compute_superflat(self, frames, channels, segmask=None, step=0):
+    def compute_superflat(self, frames, channels, segmask=None, step=0,
+                          nprocs=1):
         _logger.info("Step %d, SF: combining the frames without offsets", step)
-        try:
-            filelist = []
-            data = []
-            masks = []
-            for frame in frames:
-                _logger.debug('Step %d, opening resized frame %s',
-                              step, frame.resized_base)
-                hdulist = fits.open(
-                    frame.resized_base, memmap=True, mode='readonly')
-                filelist.append(hdulist)
-                data.append(hdulist['primary'].data[frame.valid_region])
-
-            scales = [frame.median_scale for frame in frames]
 
-            # FIXME: plotting
-            self.figure_median_background(scales)
+        # The frames are read by tiles, from memory or from their files
+        regions = [frame.data_region for frame in frames]
+        data = [self.store.source(frame.resized_base, frame.data_region)
+                for frame in frames]
+        if segmask is not None:
+            masks = [segmask[frame.valid_region] for frame in frames]
+        else:
+            masks = [self.store.source(frame.resized_mask, frame.data_region)
+                     for frame in frames]
 
-            if segmask is not None:
-                masks = [segmask[frame.valid_region] for frame in frames]
-            else:
-                for frame in frames:
-                    _logger.debug('Step %d, opening resized mask %s',
-                                  step, frame.resized_mask)
-                    hdulist = fits.open(
-                        frame.resized_mask, memmap=True, mode='readonly')
-                    filelist.append(hdulist)
-                    masks.append(hdulist['primary'].data[frame.valid_region])
-
-            _logger.debug('Step %d, combining %d frames', step, len(data))
-
-            sf_data, _sf_var, sf_num = flatcombine(data, masks, scales=scales,
-                                                   blank=1.0 / scales[0])
-        finally:
-            _logger.debug('Step %d, closing resized frames and mask', step)
-            for fileh in filelist:
-                fileh.close()
+        scales = [frame.median_scale for frame in frames]
+
+        # FIXME: plotting
+        self.figure_median_background(scales)
+
+        shape = tuple(r.stop - r.start for r in frames[0].data_region)
+        tiles = channel_tiles(shape, channels)
+        _logger.debug('Step %d, combining %d frames in %d tiles',
+                      step, len(data), len(tiles))
+
+        sf_data, _sf_var, sf_num = combine_superflat(
+            data, masks, regions, shape, tiles, scales,
+            blank=1.0 / scales[0], nprocs=nprocs)
 
         # We interpolate holes by channel
         _logger.debug('Step %d, interpolating holes by channel', step)
@@ -735,19 +834,26 @@ class DirectImageCommon(EmirRecipe):
         sf_data /= sf_data.mean()
 
         # Auxiliary data
-        sfhdu = fits.PrimaryHDU(sf_data)
-        sfhdu.writeto(name_skyflat('comb', step), clobber=True)
+        self.store.save(name_skyflat('comb', step), sf_data)
         return sf_data
 
-    def update_scale_factors(self, frames, step=0):
+    def update_scale_factors(self, frames, channels=None, step=0, nprocs=1):
         _logger.info('Step %d, SF: computing scale factors', step)
-        # FIXME: not sure
-        for frame in frames:
-            region = frame.valid_region
-            data = fits.getdata(frame.resized_base)[region]
-            mask = fits.getdata(frame.resized_mask)[region]
-            # FIXME: while developing this ::10 is faster, remove later
-            frame.median_scale = numpy.median(data[mask == 0][::10])
+        # The frames are read by tiles, from memory or from their files
+        regions = [frame.data_region for frame in frames]
+        data = [self.store.source(frame.resized_base, frame.data_region)
+                for frame in frames]
+        masks = [self.store.source(frame.resized_mask, frame.data_region)
+                 for frame in frames]
+        if channels is None:
+            channels = []
+        shape = tuple(r.stop - r.start for r in frames[0].data_region)
+        tiles = channel_tiles(shape, channels)
+        # FIXME: while developing one in 10 pixels is faster, remove later
+        scales = frame_scales(data, masks, regions, tiles, step=10,
+                              nprocs=nprocs)
+        for frame, scale in zip(frames, scales):
+            frame.median_scale = scale
             _logger.debug('median value of %s is %f',
                           frame.resized_base, frame.median_scale)
         return frames
@@ -758,8 +864,11 @@ class DirectImageCommon(EmirRecipe):
         for frame, rel_offset in zip(frames, offsetsp):
             if frame.valid_target:
                 region, _ = subarray_match(finalshape, rel_offset, shape)
-                # Valid region
+                # Valid region, in the canvas
                 frame.valid_region = region
+                frame.canvas_shape = finalshape
+                # The resized frames are not placed in the canvas
+                frame.data_region = tuple(slice(0, side) for side in shape)
                 # Relative offset
                 frame.rel_offset = rel_offset
                 # names of frame and mask
@@ -772,22 +881,34 @@ class DirectImageCommon(EmirRecipe):
                               rel_offset
                               )
                 self.resize_frame_and_mask(
-                    frame, finalshape, framen, maskn, window, scale)
+                    frame, shape, framen, maskn, window, scale)
 
         return frames
 
-    def resize_frame_and_mask(self, frame, finalshape,
+    def resize_frame_and_mask(self, frame, shape,
                               framen, maskn, window, scale):
+        """Cut the window of frame and its mask and subsample them.
+
+        The resized images have the given shape, they are placed
+        in the canvas with an OffsetView, at frame.valid_region.
+        """
         _logger.info('Resizing frame %s, window=%s, subpix=%i', frame.label,
                      custom_region_to_str(window), scale)
-        resize_fits(frame.label, framen, finalshape, frame.valid_region,
-                    window=window, scale=scale)
+        hdulist = self.store.get(frame.label)
+        newhdu = resize_hdu(hdulist['primary'], shape, frame.data_region,
+                            window=window, scale=scale)
+        newhdu.header['NVALREGI'] = (custom_region_to_str(frame.valid_region),
+                                     'Valid region of resized FITS')
+        self.store.put(framen, fits.HDUList([newhdu]))
 
         _logger.info('Resizing mask %s, subpix x%i', frame.label, scale)
         # We don't conserve the sum of the values of the frame here, just
         # expand the mask
-        resize_fits(frame.mask.label, maskn, finalshape, frame.valid_region,
-                    fill=1, window=window, scale=scale, conserve=False)
+        hdulist = self.store.get(frame.mask.label)
+        newhdu = resize_hdu(hdulist['primary'], shape, frame.data_region,
+                            fill=1, window=window, scale=scale,
+                            conserve=False)
+        self.store.put(maskn, fits.HDUList([newhdu]))
 
     def figure_init(self, shape):
         self._figure.clf()
@@ -841,7 +962,7 @@ class DirectImageCommon(EmirRecipe):
         ndata[mask] = 0
         self.figure_simple_image(fake, title='Fake sky error image')
         # store fake image
-        fits.writeto('fake_sky_rms_i%0d.fits' % step, fake, clobber=True)
+        self.store.save('fake_sky_rms_i%0d.fits' % step, fake)
 
     def figure_check_combination(self, rnimage, rmean, rstd, step=0):
         self._figure.clf()
@@ -912,69 +1033,29 @@ class DirectImageCommon(EmirRecipe):
                      (image.lastname, clim[0], clim[1]))
         self._figure.canvas.draw()
 
-    def create_mask_single(self, frame, seeing_fwhm, step=0):
-        #
-        # remove_border = True
-
-        # sextractor takes care of bad pixels
-        sex = SExtractor()
-        sex.config['CHECKIMAGE_TYPE'] = "SEGMENTATION"
-        sex.config["CHECKIMAGE_NAME"] = name_object_mask(frame.baselabel, step)
-
-        sex.config['VERBOSE_TYPE'] = 'QUIET'
-        sex.config['PIXEL_SCALE'] = 1
-        sex.config['BACK_TYPE'] = 'AUTO'
-
-        if seeing_fwhm is not None and seeing_fwhm > 0:
-            sex.config['SEEING_FWHM'] = seeing_fwhm * sex.config['PIXEL_SCALE']
-
-        sex.config['PARAMETERS_LIST'].append('FLUX_BEST')
-        sex.config['PARAMETERS_LIST'].append('X_IMAGE')
-        sex.config['PARAMETERS_LIST'].append('Y_IMAGE')
-        sex.config['PARAMETERS_LIST'].append('A_IMAGE')
-        sex.config['PARAMETERS_LIST'].append('B_IMAGE')
-        sex.config['PARAMETERS_LIST'].append('THETA_IMAGE')
-        sex.config['PARAMETERS_LIST'].append('FWHM_IMAGE')
-        sex.config['PARAMETERS_LIST'].append('CLASS_STAR')
+    def figure_catalog_objects(self, catalog, figname):
+        """Plot the objects of the catalog, return their FWHM."""
+        # ignoring those objects with corrupted apertures
+        valid = (catalog['FLAGS'] & sexcatalog.CORRUPTED_APER) == 0
+        catalog = catalog[valid]
 
-        filename = frame.lastname
-
-        # Lauch SExtractor on a FITS file
-        sex.run(filename)
-
-        # Plot objects
-        # FIXME, plot sextractor objects on top of image
         patches = []
-        fwhms = []
-        nfirst = 0
-        catalog_f = sopen(sex.config['CATALOG_NAME'])
-        try:
-            star = catalog_f.readline()
-            while star:
-                flags = star['FLAGS']
-                # ignoring those objects with corrupted apertures
-                if flags & sexcatalog.CORRUPTED_APER:
-                    star = catalog_f.readline()
-                    continue
-                center = (star['X_IMAGE'], star['Y_IMAGE'])
-                wd = 10 * star['A_IMAGE']
-                hd = 10 * star['B_IMAGE']
-                color = 'red'
-                e = Ellipse(center, wd, hd, star['THETA_IMAGE'], color=color)
-                patches.append(e)
-                fwhms.append(star['FWHM_IMAGE'])
-                nfirst += 1
-                # FIXME Plot a ellipse
-                star = catalog_f.readline()
-        finally:
-            catalog_f.close()
+        for star in catalog:
+            center = (star['X_IMAGE'], star['Y_IMAGE'])
+            wd = 10 * star['A_IMAGE']
+            hd = 10 * star['B_IMAGE']
+            color = 'red'
+            e = Ellipse(center, wd, hd, star['THETA_IMAGE'], color=color)
+            patches.append(e)
 
         p = PatchCollection(patches, alpha=0.4)
         ax = self._figure.gca()
         ax.add_collection(p)
         self._figure.canvas.draw()
-        self._figure.savefig('figure-sky-segmentation-overlay_%01d.png' % step)
+        self._figure.savefig(figname)
+        return catalog['FWHM_IMAGE']
 
+    def seeing_from_fwhms(self, fwhms, step=0):
         self.figure_fwhm_histogram(fwhms, step=step)
 
         # mode with an histogram
@@ -987,8 +1068,29 @@ class DirectImageCommon(EmirRecipe):
                 'Seeing FHWM %f pixels is negative, reseting', seeing_fwhm)
             seeing_fwhm = None
         else:
+            # The pixel scale used in the detection is 1
             _logger.info('Seeing FHWM %f pixels (%f arcseconds)',
-                         seeing_fwhm, seeing_fwhm * sex.config['PIXEL_SCALE'])
+                         seeing_fwhm, seeing_fwhm)
+        return seeing_fwhm
+
+    def create_mask_single(self, frame, seeing_fwhm, step=0):
+        #
+        # remove_border = True
+        detector = get_detector(self.detector)
+
+        _logger.info('Detecting objects in %s, using %s',
+                     frame.lastname, detector.name)
+        catalog, segmap = detector.detect(self.store.getdata(frame.lastname),
+                                          seeing_fwhm=seeing_fwhm,
+                                          segmentation=True)
+        self.store.put(name_object_mask(frame.baselabel, step), segmap)
+
+        # Plot objects
+        fwhms = self.figure_catalog_objects(
+            catalog, 'figure-sky-segmentation-overlay_%01d.png' % step)
+
+        seeing_fwhm = self.seeing_from_fwhms(fwhms, step=step)
+
         name_segmask(step)
         _logger.info('Step %d, create object mask %s', step,  frame.objmask)
         frame.objmask = name_object_mask(frame.baselabel, step)
@@ -1001,44 +1103,9 @@ class DirectImageCommon(EmirRecipe):
 
         #
         remove_border = True
+        detector = get_detector(self.detector)
 
-        # sextractor takes care of bad pixels
-        sex = SExtractor()
-        sex.config['CHECKIMAGE_TYPE'] = "SEGMENTATION"
-        sex.config["CHECKIMAGE_NAME"] = name_segmask(step)
-        sex.config['VERBOSE_TYPE'] = 'QUIET'
-        sex.config['PIXEL_SCALE'] = 1
-        sex.config['BACK_TYPE'] = 'AUTO'
-
-        if seeing_fwhm is not None and seeing_fwhm > 0:
-            sex.config['SEEING_FWHM'] = seeing_fwhm * sex.config['PIXEL_SCALE']
-
-        sex.config['PARAMETERS_LIST'].append('FLUX_BEST')
-        sex.config['PARAMETERS_LIST'].append('X_IMAGE')
-        sex.config['PARAMETERS_LIST'].append('Y_IMAGE')
-        sex.config['PARAMETERS_LIST'].append('A_IMAGE')
-        sex.config['PARAMETERS_LIST'].append('B_IMAGE')
-        sex.config['PARAMETERS_LIST'].append('THETA_IMAGE')
-        sex.config['PARAMETERS_LIST'].append('FWHM_IMAGE')
-        sex.config['PARAMETERS_LIST'].append('CLASS_STAR')
         if remove_border:
-            weigthmap = 'weights4rms.fits'
-
-            # Create weight map, remove n pixs from either side
-            # using a Hannig filter
-            # npix = 90
-            # w1 = npix
-            # w2 = npix
-            # wmap = numpy.ones_like(sf_data[0])
-
-            # cos_win1 = numpy.hanning(2 * w1)
-            # cos_win2 = numpy.hanning(2 * w2)
-
-            # wmap[:,:w1] *= cos_win1[:w1]
-            # wmap[:,-w1:] *= cos_win1[-w1:]
-            # wmap[:w2,:] *= cos_win2[:w2, numpy.newaxis]
-            # wmap[-w2:,:] *= cos_win2[-w2:, numpy.newaxis]
-
             # Take the number of combined images from the combined image
             wm = sf_data[2].copy()
             # Dont search objects where nimages < lower
@@ -1047,66 +1114,21 @@ class DirectImageCommon(EmirRecipe):
             # than 10% of the images
             lower = sf_data[2].max() / 10
             wm[wm < lower] = 0
-            fits.writeto(weigthmap, wm, clobber=True)
-
-            sex.config['WEIGHT_TYPE'] = 'MAP_WEIGHT'
-            # FIXME: this is a magic number
-            # sex.config['WEIGHT_THRESH'] = 50
-            sex.config['WEIGHT_IMAGE'] = weigthmap
-
-        filename = 'result_i%0d.fits' % (step)
+        else:
+            wm = None
 
-        # Lauch SExtractor on a FITS file
-        sex.run(filename)
+        _logger.info('Detecting objects in result, step %d, using %s',
+                     step, detector.name)
+        catalog, objmask = detector.detect(sf_data[0], weight=wm,
+                                           seeing_fwhm=seeing_fwhm,
+                                           segmentation=True)
+        self.store.save(name_segmask(step), objmask)
 
         # Plot objects
-        # FIXME, plot sextractor objects on top of image
-        patches = []
-        fwhms = []
-        nfirst = 0
-        catalog_f = sopen(sex.config['CATALOG_NAME'])
-        try:
-            star = catalog_f.readline()
-            while star:
-                flags = star['FLAGS']
-                # ignoring those objects with corrupted apertures
-                if flags & sexcatalog.CORRUPTED_APER:
-                    star = catalog_f.readline()
-                    continue
-                center = (star['X_IMAGE'], star['Y_IMAGE'])
-                wd = 10 * star['A_IMAGE']
-                hd = 10 * star['B_IMAGE']
-                color = 'red'
-                e = Ellipse(center, wd, hd, star['THETA_IMAGE'], color=color)
-                patches.append(e)
-                fwhms.append(star['FWHM_IMAGE'])
-                nfirst += 1
-                # FIXME Plot a ellipse
-                star = catalog_f.readline()
-        finally:
-            catalog_f.close()
-
-        p = PatchCollection(patches, alpha=0.4)
-        ax = self._figure.gca()
-        ax.add_collection(p)
-        self._figure.canvas.draw()
-        self._figure.savefig('figure-segmentation-overlay_%01d.png' % step)
-
-        self.figure_fwhm_histogram(fwhms, step=step)
-
-        # mode with an histogram
-        hist, edges = numpy.histogram(fwhms, 50)
-        idx = hist.argmax()
+        fwhms = self.figure_catalog_objects(
+            catalog, 'figure-segmentation-overlay_%01d.png' % step)
 
-        seeing_fwhm = 0.5 * (edges[idx] + edges[idx + 1])
-        if seeing_fwhm <= 0:
-            _logger.warning(
-                'Seeing FHWM %f pixels is negative, reseting', seeing_fwhm)
-            seeing_fwhm = None
-        else:
-            _logger.info('Seeing FHWM %f pixels (%f arcseconds)',
-                         seeing_fwhm, seeing_fwhm * sex.config['PIXEL_SCALE'])
-        objmask = fits.getdata(name_segmask(step))
+        seeing_fwhm = self.seeing_from_fwhms(fwhms, step=step)
         return objmask, seeing_fwhm
 
     def figure_final_before_s(self, data):
@@ -25,7 +25,6 @@ import astropy.io.fits as fits
 import numina.core
 import numina.exceptions
 import numpy
-from numina.array import combine
 from numina.core import Product, RecipeError
 from numina.core.requirements import ObservationResultRequirement
 
@@ -34,6 +33,7 @@ import emirdrp.decorators
 import emirdrp.products as prods
 from emirdrp.core import EmirRecipe
 from emirdrp.processing.combine import basic_processing
+from emirdrp.processing.accumulator import RunningStack
 
 
 class BaseABBARecipe(EmirRecipe):
@@ -209,9 +209,9 @@ class BaseABBARecipe(EmirRecipe):
         return partial_result
 
     def aggregate_frames(self, accum, frame, naccum):
-        return self.aggregate2(accum, frame, naccum)
+        return self.aggregate2(accum, frame)
 
-    def aggregate2(self, img1, img2, naccum):
+    def aggregate2(self, img1, img2):
 
         frames = [img1, img2]
         use_errors = True
@@ -242,19 +242,19 @@ class BaseABBARecipe(EmirRecipe):
 
         self.logger.info('Combine target images (final, aggregate)')
 
-        weight_accum = 2 * (1 - 1.0 / naccum)
-        weight_frame = 2.0 / naccum
-        self.logger.debug("weights for 'accum' and 'frame', %s", [weight_accum, weight_frame])
-        scales = [1.0 / weight_accum, 1.0 / weight_frame]
-        method = combine.mean
-        data_arr = [hdul[0].data for hdul in data_hdul]
-        out = method(data_arr, masks=masks, scales=scales, dtype='float32')
+        # The accumulated image stores running sums, the new frame
+        # is added to them and the previous frames are not combined again
+        stack = RunningStack.from_hdulist(data_hdul[0], mask=masks[0])
+        stack.add(data_hdul[1][0].data, mask=masks[1])
+        out = stack.result(dtype='float32')
 
         self.logger.debug('create result image')
 
-        return self.create_accum_hdulist(
+        result = self.create_accum_hdulist(
             data_hdul,
             out,
-            method_name=method.__name__,
-            use_errors=False
+            method_name='mean',
+            use_errors=True
         )
+        result.extend(stack.to_hdus())
+        return result
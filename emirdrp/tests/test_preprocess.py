@@ -0,0 +1,173 @@
+import numpy
+import pytest
+from astropy.io import fits
+
+from ..preprocess import fowler_block, ramp_block, preprocess_stream
+from .. import preprocess as preproc
+from ..preprocess import find_frames, preprocess_batch
+
+
+def _ramp_cube(nreads=6, shape=(25, 12), seed=1):
+    rng = numpy.random.RandomState(seed)
+    slope = rng.uniform(100, 12000, size=shape)
+    cube = numpy.array([1000 + slope * z for z in range(nreads)])
+    return cube + rng.normal(0, 2, size=cube.shape)
+
+
+def test_ramp_block_least_squares():
+    cube = _ramp_cube()
+    nreads = cube.shape[0]
+    value, var, npix, mask = ramp_block(lambda z: cube[z], nreads,
+                                        ti=nreads - 1)
+    for y, x in [(0, 0), (10, 5), (24, 11)]:
+        pixel = cube[:, y, x]
+        nvalid = numpy.argmax(pixel >= 55000) if (pixel >= 55000).any() \
+            else nreads
+        if nvalid >= 2:
+            fitted = numpy.polyfit(numpy.arange(nvalid), pixel[:nvalid], 1)
+            assert abs(value[y, x] - fitted[0]) < 1e-6 * abs(fitted[0])
+            assert npix[y, x] == nvalid
+        else:
+            assert npix[y, x] == 0
+            assert mask[y, x] == 3
+
+
+def test_fowler_block_saturation():
+    cube = numpy.array([[[10.0, 10.0]], [[20.0, 20.0]],
+                        [[30.0, 60000.0]], [[50.0, 60000.0]]])
+    value, var, npix, mask = fowler_block(lambda z: cube[z], 4)
+    numpy.testing.assert_allclose(value, [[25.0, 0.0]])
+    numpy.testing.assert_array_equal(npix, [[2, 0]])
+    numpy.testing.assert_array_equal(mask, [[0, 3]])
+
+
+def test_preprocess_stream(tmpdir):
+    cube = _ramp_cube().astype('uint16')
+    hdu = fits.PrimaryHDU(cube)
+    hdu.header['EXPTIME'] = cube.shape[0] - 1.0
+    rawname = str(tmpdir.join('raw.fits'))
+    outname = str(tmpdir.join('proc.fits'))
+    hdu.writeto(rawname)
+
+    preprocess_stream(rawname, outname, 'ramp', rows=7)
+
+    expected = ramp_block(lambda z: cube[z].astype('float64'),
+                          cube.shape[0], ti=cube.shape[0] - 1)
+    with fits.open(outname) as hdulist:
+        assert hdulist[0].header['READPROC']
+        for ext, values in zip([0, 'VARIANCE', 'MAP', 'MASK'], expected):
+            numpy.testing.assert_allclose(hdulist[ext].data, values,
+                                          rtol=1e-6)
+
+
+def test_preprocess_stream_checks_input(tmpdir):
+    cube = _ramp_cube(nreads=4).astype('uint16')
+    rawname = str(tmpdir.join('raw.fits'))
+    outname = str(tmpdir.join('proc.fits'))
+    # no EXPTIME
+    fits.PrimaryHDU(cube).writeto(rawname)
+    with pytest.raises(ValueError):
+        preprocess_stream(rawname, outname, 'ramp')
+    with pytest.raises(ValueError):
+        preprocess_stream(rawname, outname, 'fowler',
+                          badpixels=numpy.zeros((3, 3)))
+    oddname = str(tmpdir.join('odd.fits'))
+    fits.PrimaryHDU(cube[:3]).writeto(oddname)
+    with pytest.raises(ValueError):
+        preprocess_stream(oddname, outname, 'fowler')
+    assert sorted(p.basename for p in tmpdir.listdir()) == ['odd.fits',
+                                                            'raw.fits']
+
+
+def test_preprocess_stream_failure(tmpdir, monkeypatch):
+    cube = _ramp_cube(nreads=4).astype('uint16')
+    hdu = fits.PrimaryHDU(cube)
+    hdu.header['EXPTIME'] = 3.0
+    rawname = str(tmpdir.join('raw.fits'))
+    hdu.writeto(rawname)
+
+    def failing(*args, **kwds):
+        raise MemoryError()
+
+    monkeypatch.setattr(preproc, 'ramp_block', failing)
+    with pytest.raises(MemoryError):
+        preprocess_stream(rawname, str(tmpdir.join('proc.fits')), 'ramp')
+    assert [p.basename for p in tmpdir.listdir()] == ['raw.fits']
+
+
+def test_preprocess_batch_skips_preprocessed(tmpdir):
+    raw = tmpdir.mkdir('raw')
+    cube = _ramp_cube(nreads=4).astype('uint16')
+    for name in ['a.fits', 'b.fits']:
+        hdu = fits.PrimaryHDU(cube)
+        hdu.header['EXPTIME'] = 3.0
+        hdu.header['READMODE'] = 'RAMP'
+        hdu.writeto(str(raw.join(name)))
+    done = fits.PrimaryHDU(cube[0])
+    done.header['READPROC'] = True
+    done.writeto(str(raw.join('c.fits')))
+
+    outdir = tmpdir.mkdir('proc')
+    frames = find_frames([str(raw)])
+    counts = preprocess_batch(frames, outdir=str(outdir), nprocs=2)
+    assert counts == {'done': 2, 'skipped': 1, 'failed': 0}
+    assert sorted(p.basename for p in outdir.listdir()) == ['a.fits',
+                                                             'b.fits']
+
+
+def test_preprocess_batch_in_place_failure(tmpdir, monkeypatch):
+    cube = _ramp_cube(nreads=4).astype('uint16')
+    hdu = fits.PrimaryHDU(cube)
+    hdu.header['EXPTIME'] = 3.0
+    hdu.header['READMODE'] = 'RAMP'
+    rawname = str(tmpdir.join('a.fits'))
+    hdu.writeto(rawname)
+
+    def failing(input_, output):
+        open(output, 'w').close()
+        raise IOError('disk full')
+
+    monkeypatch.setattr(preproc, 'preprocess', failing)
+    counts = preprocess_batch([rawname])
+    assert counts == {'done': 0, 'skipped': 0, 'failed': 1}
+    assert [p.basename for p in tmpdir.listdir()] == ['a.fits']
+    with fits.open(rawname) as hdulist:
+        numpy.testing.assert_array_equal(hdulist[0].data, cube)
+
+
+def test_main_requires_outdir_or_in_place(tmpdir):
+    with pytest.raises(SystemExit):
+        preproc.main([str(tmpdir)])
+    with pytest.raises(SystemExit):
+        preproc.main([str(tmpdir), '-o', str(tmpdir), '--in-place'])
+    assert preproc.main([str(tmpdir), '--in-place']) == 0
+
+
+def test_preprocess_batch_outdir_failure(tmpdir):
+    raw = tmpdir.mkdir('raw')
+    cube = _ramp_cube(nreads=4).astype('uint16')
+    # a ramp without EXPTIME
+    hdu = fits.PrimaryHDU(cube)
+    hdu.header['READMODE'] = 'RAMP'
+    hdu.writeto(str(raw.join('a.fits')))
+
+    outdir = tmpdir.mkdir('proc')
+    counts = preprocess_batch(find_frames([str(raw)]), outdir=str(outdir))
+    assert counts == {'done': 0, 'skipped': 0, 'failed': 1}
+    assert outdir.listdir() == []
+
+
+def test_preprocess_task_raw_size(tmpdir):
+    cube = _ramp_cube(nreads=4).astype('uint16')
+    hdu = fits.PrimaryHDU(cube)
+    hdu.header['EXPTIME'] = 3.0
+    hdu.header['READMODE'] = 'RAMP'
+    rawname = str(tmpdir.join('a.fits'))
+    hdu.writeto(rawname)
+    size = tmpdir.join('a.fits').size()
+
+    name, status, nbytes, _ = preproc._preprocess_task((rawname, rawname))
+    assert status == 'ramp'
+    assert nbytes == size
+    assert tmpdir.join('a.fits').size() != size
+    assert [p.basename for p in tmpdir.listdir()] == ['a.fits']
@@ -136,6 +136,8 @@ Examples:
 
 from six.moves import builtins as __builtin__
 
+import numpy
+
 
 # ======================================================================
 
@@ -667,8 +669,9 @@ class SExtractorfile:
         self._file = None
         self._keys = list()
         self._keys_positions = {}
-        self._output = None
-        self._firstline = True
+        self._body = None
+        self._table = None
+        self._row = 0
 
         if self.mode != 'r':
             raise ValueError(
@@ -711,9 +714,6 @@ class SExtractorfile:
                 'not a SExtractor text catalog (empty header)'
                 )
 
-        self._outdict = dict([(k, None) for k in self._keys])
-        self._firstline = True
-
     def __del__(self):
         self.close()
 
@@ -726,6 +726,8 @@ class SExtractorfile:
             raise StopIteration
         return rr
 
+    next = __next__
+
     def __bool__(self):
         return self._file
 
@@ -737,26 +739,73 @@ class SExtractorfile:
         "Return the list of available parameters."
         return list(self.keys())
 
+    def _read_body(self):
+        """Read the values of the catalog in a 2D array."""
+        if self._body is None:
+            # The first line of the body has been read with the header
+            text = self._line + self._file.read()
+            ncols = len(self._line.split())
+            values = numpy.fromstring(text, sep=' ')
+            if ncols == 0:
+                values = values.reshape((0, len(self._keys)))
+            else:
+                values = values.reshape((-1, ncols))
+            self._body = values
+        return self._body
+
+    def table(self, columns=None):
+        """
+        Read the catalog in a numpy structured array.
+
+        If columns is not None, only those parameters are
+        included in the array.
+        """
+        if columns is None:
+            columns = self._keys
+        else:
+            for name in columns:
+                if name not in self._keys_positions:
+                    raise KeyError('parameter %s not in catalog' % name)
+
+        body = self._read_body()
+
+        # Vector parameters use several columns
+        ends = sorted(self._keys_positions.values()) + [body.shape[1]]
+        dtype = []
+        slices = []
+        for name in columns:
+            start = self._keys_positions[name]
+            width = max(1, min(e for e in ends if e > start) - start)
+            if SExtractorfile._SE_keys[name]["infunc"] is int:
+                coltype = 'int64'
+            else:
+                coltype = 'float64'
+            if width == 1:
+                dtype.append((name, coltype))
+                slices.append(start)
+            else:
+                dtype.append((name, coltype, (width,)))
+                slices.append(slice(start, start + width))
+
+        result = numpy.empty(body.shape[0], dtype=dtype)
+        for name, sl in zip(columns, slices):
+            result[name] = body[:, sl]
+        return result
+
     def readline(self):
         """
-        Read and analyse the next line of the SExtractor catalog
+        Read the next object of the SExtractor catalog
         and return a dictionary {'param1': value, 'param2': value, ...}.
         """
-        if not(self._firstline):
-            self._line = self._file.readline()
+        if self._table is None:
+            self._table = self.table()
 
-        self._firstline = False
-
-        if not(self._line):
+        if self._row >= len(self._table):
             return None
-        __ll = (self._line).replace('\n', '')
-        __values = __ll.split()
-        self._outdict.update(dict(zip(self._keys, __values)))
-        for i in self._keys:
-            self._outdict[i] = (
-                SExtractorfile._SE_keys[i]["infunc"](self._outdict[i]))
 
-        return self._outdict.copy()
+        values = self._table[self._row].tolist()
+        self._row += 1
+        return dict(zip(self._table.dtype.names, values))
 
     def read(self):
         """
@@ -793,4 +842,17 @@ def open(name, mode='r'):
     """
     return SExtractorfile(name, mode)
 
+
+def read_table(name, columns=None):
+    """
+    Read a SExtractor catalog in a numpy structured array.
+
+    If columns is not None, only those parameters are read.
+    """
+    catalog_f = SExtractorfile(name, 'r')
+    try:
+        return catalog_f.table(columns)
+    finally:
+        catalog_f.close()
+
 # ======================================================================
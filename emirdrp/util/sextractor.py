@@ -156,6 +156,13 @@ import os
 import subprocess
 import re
 import copy
+import shutil
+import atexit
+import hashlib
+import tempfile
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 from .sexcatalog import *
 
@@ -442,6 +449,8 @@ class SExtractor:
                                      close_fds=True)
                 (_out_err, _in) = (p.stdout, p.stdin)
                 versionline = _out_err.read()
+                if not isinstance(versionline, str):
+                    versionline = versionline.decode('ascii', 'replace')
                 if (versionline.find("SExtractor") != -1):
                     selected = candidate
                     break
@@ -475,13 +484,17 @@ class SExtractor:
 
         return _program, _version
 
-    def update_config(self):
+    def render_config(self, exclude=()):
         """
-        Update the configuration files according to the current
-        in-memory SExtractor configuration.
+        Return the contents of the configuration files according to
+        the current in-memory SExtractor configuration, as a dictionary
+        with the name of the configuration key of each file as key.
+        Keys in exclude are not written in the main configuration file.
         """
 
-        # -- Write filter configuration file
+        files = {}
+
+        # -- Filter configuration file
 
         # First check the filter itself
 
@@ -489,46 +502,50 @@ class SExtractor:
         rows = len(filter)
         cols = len(filter[0])   # May raise ValueError, OK
 
-        filter_f = __builtin__.open(self.config['FILTER_NAME'], 'w')
-        filter_f.write("CONV NORM\n")
-        filter_f.write("# %dx%d Generated from sextractor.py module.\n" %
-                       (rows, cols))
+        lines = ["CONV NORM\n",
+                 "# %dx%d Generated from sextractor.py module.\n" % (rows, cols)]
         for row in filter:
-            filter_f.write(" ".join(map(repr, row)))
-            filter_f.write("\n")
-
-        filter_f.close()
+            lines.append(" ".join(map(repr, row)))
+            lines.append("\n")
+        files['FILTER_NAME'] = "".join(lines)
 
-        # -- Write parameter list file
+        # -- Parameter list file
 
-        parameters_f = __builtin__.open(self.config['PARAMETERS_NAME'], 'w')
-        for parameter in self.config['PARAMETERS_LIST']:
-            print(parameter, file=parameters_f)
+        files['PARAMETERS_NAME'] = "".join(
+            "%s\n" % parameter for parameter in self.config['PARAMETERS_LIST'])
 
-        parameters_f.close()
+        # -- NNW configuration file
 
-        # -- Write NNW configuration file
+        files['STARNNW_NAME'] = nnw_config
 
-        nnw_f = __builtin__.open(self.config['STARNNW_NAME'], 'w')
-        nnw_f.write(nnw_config)
-        nnw_f.close()
+        # -- Main configuration file
 
-        # -- Write main configuration file
-
-        main_f = __builtin__.open(self.config['CONFIG_FILE'], 'w')
-
-        for key in self.config.keys():
+        lines = []
+        for key in sorted(self.config.keys()):
             if (key in SExtractor._SE_config_special_keys):
                 continue
+            if key in exclude:
+                continue
 
             if (key == "PHOT_AUTOPARAMS"):  # tuple instead of a single value
                 value = " ".join(map(str, self.config[key]))
             else:
                 value = str(self.config[key])
 
-            print(("%-16s       %-16s # %s" % (key, value, SExtractor._SE_config[key]['comment'])), file=main_f)
+            lines.append("%-16s       %-16s # %s\n" % (key, value, SExtractor._SE_config[key]['comment']))
+        files['CONFIG_FILE'] = "".join(lines)
+
+        return files
+
+    def update_config(self):
+        """
+        Update the configuration files according to the current
+        in-memory SExtractor configuration.
+        """
 
-        main_f.close()
+        for key, contents in self.render_config().items():
+            with __builtin__.open(self.config[key], 'w') as fd:
+                fd.write(contents)
 
     def run(self, file, updateconfig=True, clean=False, path=None):
         """
@@ -577,6 +594,15 @@ class SExtractor:
 
         return c
 
+    def table(self, columns=None):
+        """
+        Read the output catalog produced by the last SExtractor run
+        in a numpy structured array, with one field per parameter.
+        If columns is not None, only those parameters are read.
+        """
+
+        return read_table(self.config['CATALOG_NAME'], columns)
+
     def clean(self, config=True, catalog=False, check=False):
         """
         Remove the generated SExtractor files (if any).
@@ -601,3 +627,222 @@ class SExtractor:
 
 
 # ======================================================================
+
+
+# ======================================================================
+
+class SExtractorJob(object):
+    """
+    The result of a run of SExtractor in a SExtractorSession.
+    Each job has its own directory for the catalog and check image.
+    """
+
+    def __init__(self, jobdir, catalog_name, checkimage_name):
+        self.jobdir = jobdir
+        self.catalog_name = catalog_name
+        self.checkimage_name = checkimage_name
+
+    def catalog(self):
+        """
+        Read the output catalog as a list of dictionaries.
+        """
+        output_f = SExtractorfile(self.catalog_name, 'r')
+        try:
+            return output_f.read()
+        finally:
+            output_f.close()
+
+    def table(self, columns=None):
+        """
+        Read the output catalog in a numpy structured array.
+        """
+        return read_table(self.catalog_name, columns)
+
+    def clean(self):
+        """
+        Remove the directory of the job.
+        """
+        shutil.rmtree(self.jobdir, ignore_errors=True)
+
+
+class SExtractorSession(object):
+    """
+    Run SExtractor several times with the same setup.
+
+    The program is searched once. The configuration files are
+    written in a private directory, once for each different content.
+    Each run uses its own catalog and check image names, runs
+    can be executed concurrently by a pool of nworkers threads.
+    """
+
+    # Keys that change in each run, passed in the command line
+    _job_keys = ['CATALOG_NAME', 'CHECKIMAGE_NAME']
+
+    def __init__(self, path=None, nworkers=1):
+
+        self.program, self.version = SExtractor().setup(path)
+        self.path = path
+        self.nworkers = nworkers
+        self.workdir = tempfile.mkdtemp(prefix='sextractor-')
+        self._files = {}
+        self._njobs = 0
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def store(self, key, ext, write):
+        """
+        Return the file named by key in the private directory,
+        calling write with its name the first time.
+
+        key must identify the contents of the file, such as
+        a hash, so that the file can be reused.
+        """
+        with self._lock:
+            if key not in self._files:
+                filename = os.path.join(self.workdir, key + ext)
+                write(filename)
+                self._files[key] = filename
+            return self._files[key]
+
+    def _store(self, contents, ext):
+        """Write contents in a file named by its hash."""
+        def write(filename):
+            with __builtin__.open(filename, 'w') as fd:
+                fd.write(contents)
+
+        key = hashlib.sha1(contents.encode('utf-8')).hexdigest()
+        return self.store(key, ext, write)
+
+    def config_file(self, config):
+        """
+        Return the main configuration file of config, creating
+        the configuration files if needed.
+        """
+        sex = SExtractor()
+        sex.config = dict(config)
+        files = sex.render_config()
+        for key, ext in [('FILTER_NAME', '.conv'),
+                         ('PARAMETERS_NAME', '.param'),
+                         ('STARNNW_NAME', '.nnw')]:
+            sex.config[key] = self._store(files[key], ext)
+        files = sex.render_config(exclude=self._job_keys)
+        return self._store(files['CONFIG_FILE'], '.sex')
+
+    def _newjob(self, config):
+        with self._lock:
+            self._njobs += 1
+            jobdir = os.path.join(self.workdir, 'job-%05d' % self._njobs)
+        os.mkdir(jobdir)
+        checkimage = config.get('CHECKIMAGE_NAME', 'check.fits')
+        return SExtractorJob(
+            jobdir,
+            os.path.join(jobdir, 'catalog.cat'),
+            os.path.join(jobdir, os.path.basename(checkimage))
+        )
+
+    def run(self, config, file):
+        """
+        Run SExtractor with config on file and return a SExtractorJob.
+
+        config is a dictionary, such as the config attribute
+        of SExtractor.
+        """
+        config_file = self.config_file(config)
+        job = self._newjob(config)
+
+        commandline = [self.program, '-c', config_file, file,
+                       '-CATALOG_NAME', job.catalog_name,
+                       '-CHECKIMAGE_NAME', job.checkimage_name]
+        rcode = subprocess.call(commandline)
+
+        if (rcode):
+            job.clean()
+            raise SExtractorException(
+                "SExtractor command [%s] failed." % " ".join(commandline)
+            )
+        return job
+
+    def map(self, config, files):
+        """
+        Run SExtractor with config on each of files, return
+        a list of SExtractorJob. The runs are executed
+        concurrently by the pool of workers. If a run fails,
+        the jobs already done are removed.
+        """
+        def run(file):
+            try:
+                return self.run(config, file), None
+            except Exception as error:
+                return None, error
+
+        jobs = []
+        done = False
+        try:
+            if self.nworkers <= 1:
+                for file in files:
+                    jobs.append(self.run(config, file))
+            else:
+                if self._pool is None:
+                    self._pool = ThreadPool(self.nworkers)
+                results = self._pool.map(run, files)
+                jobs = [job for job, _ in results if job is not None]
+                for _, error in results:
+                    if error is not None:
+                        raise error
+            done = True
+            return jobs
+        finally:
+            if not done:
+                for job in jobs:
+                    job.clean()
+
+    def close(self):
+        """
+        Stop the workers and remove the private directory.
+        """
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session(path=None, nworkers=None):
+    """
+    Return a SExtractorSession shared by the module.
+
+    The session is created in the first call, with nworkers
+    workers, by default the number of CPUs. Later calls with
+    None in path or nworkers accept the existing session;
+    asking for a different path or number of workers raises
+    SExtractorException.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            if nworkers is None:
+                nworkers = multiprocessing.cpu_count()
+            _session = SExtractorSession(path, nworkers=nworkers)
+            atexit.register(_session.close)
+        else:
+            if path is not None and path != _session.path:
+                raise SExtractorException(
+                    "SExtractor session already running with path %s" %
+                    _session.path
+                )
+            if nworkers is not None and nworkers != _session.nworkers:
+                raise SExtractorException(
+                    "SExtractor session already running with %d workers" %
+                    _session.nworkers
+                )
+        return _session
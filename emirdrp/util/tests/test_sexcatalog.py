@@ -0,0 +1,61 @@
+
+import numpy
+
+from ..sexcatalog import open as sopen, read_table
+
+CATALOG = """\
+#   1 NUMBER                 Running object number
+#   2 X_IMAGE                Object position along x                  [pixel]
+#   3 FLUX_BEST              Best of FLUX_AUTO and FLUX_ISOCOR        [count]
+#   4 FLAGS                  Extraction flags
+         1    100.500      1.5e3   0
+         2     20.250      -12.1  16
+         3     31.000          0   3
+"""
+
+
+def create_catalog(tmpdir, text=CATALOG):
+    filename = str(tmpdir.join('test.cat'))
+    with open(filename, 'w') as fd:
+        fd.write(text)
+    return filename
+
+
+def test_read_table(tmpdir):
+    filename = create_catalog(tmpdir)
+    table = read_table(filename)
+
+    assert table.dtype.names == ('NUMBER', 'X_IMAGE', 'FLUX_BEST', 'FLAGS')
+    assert table['NUMBER'].dtype.kind == 'i'
+    numpy.testing.assert_array_equal(table['NUMBER'], [1, 2, 3])
+    numpy.testing.assert_allclose(table['FLUX_BEST'], [1.5e3, -12.1, 0])
+    numpy.testing.assert_array_equal(table['FLAGS'], [0, 16, 3])
+
+
+def test_read_table_columns(tmpdir):
+    filename = create_catalog(tmpdir)
+    table = read_table(filename, columns=['FLAGS', 'X_IMAGE'])
+
+    assert table.dtype.names == ('FLAGS', 'X_IMAGE')
+    numpy.testing.assert_allclose(table['X_IMAGE'], [100.5, 20.25, 31.0])
+
+
+def test_read_table_empty(tmpdir):
+    header = ''.join(CATALOG.splitlines(True)[:4])
+    filename = create_catalog(tmpdir, header)
+    table = read_table(filename)
+    assert len(table) == 0
+
+
+def test_readline(tmpdir):
+    filename = create_catalog(tmpdir)
+    catalog_f = sopen(filename)
+    try:
+        stars = list(catalog_f)
+    finally:
+        catalog_f.close()
+
+    assert len(stars) == 3
+    assert stars[1] == {'NUMBER': 2, 'X_IMAGE': 20.25,
+                        'FLUX_BEST': -12.1, 'FLAGS': 16}
+    assert isinstance(stars[1]['NUMBER'], int)
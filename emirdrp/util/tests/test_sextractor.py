@@ -0,0 +1,60 @@
+import os
+
+
+import pytest
+
+from .. import sextractor
+from ..sextractor import SExtractor
+
+
+def test_render_config():
+    sex = SExtractor()
+    sex.config['PARAMETERS_LIST'] = ['NUMBER', 'FLUX_BEST']
+    files = sex.render_config(exclude=['CATALOG_NAME'])
+
+    assert sorted(files) == ['CONFIG_FILE', 'FILTER_NAME',
+                             'PARAMETERS_NAME', 'STARNNW_NAME']
+    assert files['PARAMETERS_NAME'] == 'NUMBER\nFLUX_BEST\n'
+    assert files['FILTER_NAME'].startswith('CONV NORM\n')
+    keys = [line.split()[0] for line in files['CONFIG_FILE'].splitlines()]
+    assert 'CATALOG_NAME' not in keys
+    assert 'PARAMETERS_LIST' not in keys
+    assert 'DETECT_THRESH' in keys
+    # The contents do not depend on the order of the keys
+    sex.config = dict(reversed(list(sex.config.items())))
+    assert sex.render_config(exclude=['CATALOG_NAME']) == files
+
+
+def test_get_session_configuration(monkeypatch):
+    monkeypatch.setattr(sextractor.SExtractor, 'setup',
+                        lambda self, path=None: ('sex', '2.19.5'))
+    monkeypatch.setattr(sextractor, '_session', None)
+
+    session = sextractor.get_session(nworkers=3)
+    try:
+        assert session.nworkers == 3
+        assert sextractor.get_session() is session
+        assert sextractor.get_session(nworkers=3) is session
+        with pytest.raises(sextractor.SExtractorException):
+            sextractor.get_session(nworkers=2)
+        with pytest.raises(sextractor.SExtractorException):
+            sextractor.get_session(path='/opt/sex')
+    finally:
+        session.close()
+
+
+@pytest.mark.parametrize('nworkers', [1, 2])
+def test_session_map_cleans_jobs(monkeypatch, nworkers):
+    monkeypatch.setattr(sextractor.SExtractor, 'setup',
+                        lambda self, path=None: ('sex', '2.19.5'))
+    monkeypatch.setattr(sextractor.subprocess, 'call',
+                        lambda commandline: commandline[3] == 'bad.fits')
+
+    with sextractor.SExtractorSession(nworkers=nworkers) as session:
+        config = SExtractor().config
+        files = ['a.fits', 'b.fits', 'bad.fits', 'c.fits']
+        with pytest.raises(sextractor.SExtractorException):
+            session.map(config, files)
+        jobdirs = [name for name in os.listdir(session.workdir)
+                   if name.startswith('job-')]
+        assert jobdirs == []
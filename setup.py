@@ -37,6 +37,9 @@ setup(name='pyemir',
         'numina.pipeline.1': [
             'EMIR = emirdrp.loader:load_drp',
             ],
+        'console_scripts': [
+            'pyemir-preprocess = emirdrp.preprocess:main',
+            ],
         },
       classifiers=[
                    "Programming Language :: Python :: 2.7",